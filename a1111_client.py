@@ -0,0 +1,568 @@
+"""
+HTTP client for the A1111 /sdapi/v1 API.
+
+- Keep-alive connection pools for blocking (requests) and asyncio (aiohttp) callers.
+- Separate connect and read timeouts.
+- Idempotency-aware retries. GETs are retried on connection errors and on
+  502/503/504. POSTs (txt2img, img2img, extras) are retried only when the
+  connection could not be opened, so a transient error never silently reruns
+  a GPU generation.
+- A generation that times out, or whose job is cancelled, is stopped with
+  /interrupt so the GPU is free for the next job right away.
+- Responses are parsed while they stream in (GenerationResponseParser), so a
+  body of several MB of base64 images is never held as bytes, text and parsed
+  JSON at the same time.
+"""
+import asyncio
+import binascii
+import json
+import re
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter, Retry
+from urllib3.exceptions import ReadTimeoutError
+
+DEFAULT_URL = "http://127.0.0.1:3000/sdapi/v1"
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 600
+RETRY_STATUSES = (502, 503, 504)
+CONNECT_RETRIES = 5
+BACKOFF_FACTOR = 0.2
+STREAM_CHUNK_SIZE = 1 << 20
+
+# --- REQUEST BUILDERS ---
+
+def drop_none(payload):
+    return {k: v for k, v in payload.items() if v is not None}
+
+def txt2img_request(prompt, negative_prompt="", width=1024, height=1024, steps=25, cfg_scale=7.0,
+                    sampler_name=None, seed=-1, batch_size=1, n_iter=1, enable_hr=False,
+                    hr_scale=None, hr_upscaler=None, denoising_strength=None,
+                    override_settings=None, alwayson_scripts=None, **extra):
+    """Payload for /txt2img. Extra keyword arguments are passed through unchanged."""
+    payload = drop_none({
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "width": int(width),
+        "height": int(height),
+        "steps": int(steps),
+        "cfg_scale": float(cfg_scale),
+        "sampler_name": sampler_name,
+        "seed": int(seed),
+        "batch_size": int(batch_size),
+        "n_iter": int(n_iter),
+        "enable_hr": bool(enable_hr),
+        "hr_scale": hr_scale,
+        "hr_upscaler": hr_upscaler,
+        "denoising_strength": denoising_strength,
+        "override_settings": override_settings,
+        "alwayson_scripts": alwayson_scripts,
+    })
+    payload.update(extra)
+    return payload
+
+def img2img_request(init_images, prompt, negative_prompt="", denoising_strength=0.75, mask=None,
+                    mask_blur=4, inpainting_fill=1, inpaint_full_res=True, inpaint_full_res_padding=32,
+                    width=None, height=None, steps=25, cfg_scale=7.0, sampler_name=None, seed=-1,
+                    batch_size=1, n_iter=1, override_settings=None, alwayson_scripts=None, **extra):
+    """Payload for /img2img. Passing a base64 `mask` makes it an inpaint request."""
+    payload = drop_none({
+        "init_images": list(init_images),
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "denoising_strength": float(denoising_strength),
+        "width": width,
+        "height": height,
+        "steps": int(steps),
+        "cfg_scale": float(cfg_scale),
+        "sampler_name": sampler_name,
+        "seed": int(seed),
+        "batch_size": int(batch_size),
+        "n_iter": int(n_iter),
+        "override_settings": override_settings,
+        "alwayson_scripts": alwayson_scripts,
+    })
+    if mask is not None:
+        payload.update({
+            "mask": mask,
+            "mask_blur": int(mask_blur),
+            "inpainting_fill": int(inpainting_fill),
+            "inpaint_full_res": bool(inpaint_full_res),
+            "inpaint_full_res_padding": int(inpaint_full_res_padding),
+        })
+    payload.update(extra)
+    return payload
+
+def extra_single_image_request(image, upscaler_1="4x-UltraSharp", upscaling_resize=2.0, upscaler_2="None",
+                               extras_upscaler_2_visibility=0.0, gfpgan_visibility=0.0,
+                               codeformer_visibility=0.0, codeformer_weight=0.0, **extra):
+    """Payload for /extra-single-image (upscale and face restoration)."""
+    payload = {
+        "image": image,
+        "resize_mode": 0,
+        "upscaling_resize": float(upscaling_resize),
+        "upscaler_1": upscaler_1,
+        "upscaler_2": upscaler_2,
+        "extras_upscaler_2_visibility": float(extras_upscaler_2_visibility),
+        "gfpgan_visibility": float(gfpgan_visibility),
+        "codeformer_visibility": float(codeformer_visibility),
+        "codeformer_weight": float(codeformer_weight),
+    }
+    payload.update(extra)
+    return payload
+
+def extra_batch_images_request(images, upscaler_1="4x-UltraSharp", upscaling_resize=2.0, **extra):
+    """Payload for /extra-batch-images. `images` are base64 strings."""
+    payload = extra_single_image_request(None, upscaler_1, upscaling_resize, **extra)
+    del payload["image"]
+    payload["imageList"] = [{"data": image, "name": f"{i}.png"} for i, image in enumerate(images)]
+    return payload
+
+def reactor_image_request(target_image, source_image="", face_model=None, source_faces_index=(0,), face_index=(0,),
+                          model="inswapper_128.onnx", face_restorer="None", restorer_visibility=1.0,
+                          codeformer_weight=0.5, upscaler="None", scale=1.0, upscale_visibility=1.0,
+                          det_thresh=0.5, det_maxnum=0, device="CUDA", **extra):
+    """Payload for ReActor's /reactor/image. With face_model set, the source image is not needed."""
+    payload = {
+        "source_image": source_image,
+        "target_image": target_image,
+        "source_faces_index": [int(i) for i in source_faces_index],
+        "face_index": [int(i) for i in face_index],
+        "upscaler": upscaler,
+        "scale": float(scale),
+        "upscale_visibility": float(upscale_visibility),
+        "face_restorer": face_restorer,
+        "restorer_visibility": float(restorer_visibility),
+        "codeformer_weight": float(codeformer_weight),
+        "restore_first": 1,
+        "model": model,
+        "device": device,
+        "select_source": 1 if face_model else 0,
+        "face_model": face_model or "None",
+        "det_thresh": float(det_thresh),
+        "det_maxnum": int(det_maxnum),
+    }
+    payload.update(extra)
+    return payload
+
+# --- RESPONSE PARSING ---
+
+WHITESPACE = b" \t\r\n"
+STRING_SPECIAL = re.compile(rb'["\\]')
+STRUCTURAL = re.compile(rb'["{}\[\],]')
+
+class ImageSink:
+    """Collects one base64 image string, either as text or decoded to bytes as it arrives."""
+
+    def __init__(self, decode):
+        self.decode = decode
+        self.data = bytearray()
+        self.carry = b""
+
+    def write(self, chunk):
+        # The only escape JSON may put in base64 is "\/"
+        if b"\\" in chunk:
+            chunk = chunk.replace(b"\\", b"")
+        if not self.decode:
+            self.data += chunk
+            return
+        chunk = self.carry + chunk
+        usable = len(chunk) - len(chunk) % 4
+        self.data += binascii.a2b_base64(chunk[:usable])
+        self.carry = chunk[usable:]
+
+    def close(self):
+        if not self.decode:
+            return self.data.decode("ascii")
+        if self.carry:
+            self.data += binascii.a2b_base64(self.carry)
+        return self.data
+
+class GenerationResponseParser:
+    """Push parser for A1111 responses: a JSON object whose "images" (list) and
+    "image" (single) values hold base64 images.
+
+    feed() takes the body in chunks. Images are copied out of each chunk as it
+    arrives, and with decode_images they are base64-decoded on the fly, so the
+    result holds PNG bytes (bytearray) instead of strings. Every other value
+    (info, parameters, html_info) is kept as raw JSON and decoded by result().
+    """
+
+    def __init__(self, decode_images=False):
+        self.decode_images = decode_images
+        self.buffer = bytearray()
+        self.state = "start"
+        self.key = None
+        self.values = {}  # key -> images, or raw JSON for keys in raw_keys
+        self.raw_keys = set()
+        self.sink = None
+        self.depth = 0
+        self.in_string = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        while self.buffer and self.step():
+            pass
+
+    def skip_whitespace(self):
+        start = 0
+        while start < len(self.buffer) and self.buffer[start] in WHITESPACE:
+            start += 1
+        del self.buffer[:start]
+        return bool(self.buffer)
+
+    def expect(self, allowed):
+        if self.buffer[:1] not in allowed:
+            raise ValueError(f"Unexpected {bytes(self.buffer[:20])!r} in A1111 response ({self.state})")
+        token = bytes(self.buffer[:1])
+        del self.buffer[:1]
+        return token
+
+    def step(self):
+        """Consumes what it can of the buffer; returns False when it needs more data."""
+        if self.state in ("image", "images_item"):
+            return self.read_image()
+        if self.state == "raw":
+            return self.read_raw()
+        if not self.skip_whitespace():
+            return False
+        if self.state == "start":
+            self.expect((b"{",))
+            self.state = "key"
+        elif self.state == "key":
+            if self.buffer[:1] == b"}":
+                del self.buffer[:1]
+                self.state = "done"
+                return True
+            if self.buffer[:1] != b'"':
+                self.expect((b'"',))
+            end = self.buffer.find(b'"', 1)
+            if end < 0:
+                return False
+            self.key = json.loads(self.buffer[:end + 1])
+            del self.buffer[:end + 1]
+            self.state = "colon"
+        elif self.state == "colon":
+            self.expect((b":",))
+            self.state = "value"
+        elif self.state == "value":
+            if self.key == "images" and self.buffer[:1] == b"[":
+                del self.buffer[:1]
+                self.values[self.key] = []
+                self.state = "images"
+            elif self.key == "image" and self.buffer[:1] == b'"':
+                del self.buffer[:1]
+                self.sink = ImageSink(self.decode_images)
+                self.state = "image"
+            else:
+                self.values[self.key] = bytearray()
+                self.raw_keys.add(self.key)
+                self.depth, self.in_string = 0, False
+                self.state = "raw"
+        elif self.state == "images":
+            token = self.expect((b'"', b",", b"]"))
+            if token == b'"':
+                self.sink = ImageSink(self.decode_images)
+                self.state = "images_item"
+            elif token == b"]":
+                self.state = "next"
+        elif self.state == "next":
+            self.state = "key" if self.expect((b",", b"}")) == b"," else "done"
+        elif self.state == "done":
+            self.skip_whitespace()
+            if self.buffer:
+                raise ValueError("Trailing data after the A1111 response")
+            return False
+        return True
+
+    def read_image(self):
+        end = self.buffer.find(b'"')
+        # Hold back a trailing backslash until the character it escapes arrives
+        usable = len(self.buffer) - (self.buffer[-1:] == b"\\") if end < 0 else end
+        self.sink.write(bytes(self.buffer[:usable]))
+        del self.buffer[:usable + (end >= 0)]
+        if end < 0:
+            return False
+        if self.state == "image":
+            self.values["image"] = self.sink.close()
+            self.state = "next"
+        else:
+            self.values["images"].append(self.sink.close())
+            self.state = "images"
+        self.sink = None
+        return True
+
+    def read_raw(self):
+        """Copies one JSON value of any other key, tracking strings and nesting to find its end."""
+        buffer, i, complete = self.buffer, 0, False
+        while i < len(buffer):
+            if self.in_string:
+                match = STRING_SPECIAL.search(buffer, i)
+                if match is None:
+                    i = len(buffer)
+                elif buffer[match.start()] == 0x5c:  # backslash
+                    if match.start() + 1 >= len(buffer):
+                        i = match.start()
+                        break
+                    i = match.start() + 2
+                else:
+                    self.in_string = False
+                    i = match.start() + 1
+                    if self.depth == 0:
+                        complete = True
+                        break
+                continue
+            match = STRUCTURAL.search(buffer, i)
+            if match is None:
+                i = len(buffer)
+                break
+            i, char = match.start(), buffer[match.start()]
+            if char == 0x22:  # quote
+                self.in_string = True
+                i += 1
+            elif char in b"{[":
+                self.depth += 1
+                i += 1
+            elif self.depth == 0:
+                # A "," or "}" ends a scalar value
+                complete = True
+                break
+            elif char == 0x2c:  # comma
+                i += 1
+            else:
+                self.depth -= 1
+                i += 1
+                if self.depth == 0:
+                    complete = True
+                    break
+        self.values[self.key] += buffer[:i]
+        del buffer[:i]
+        if complete:
+            self.state = "next"
+        return complete
+
+    def result(self):
+        """The parsed response. Raises ValueError if the body ended early."""
+        if self.state != "done":
+            raise ValueError(f"Truncated A1111 response ({self.state})")
+        return {key: json.loads(value) if key in self.raw_keys else value
+                for key, value in self.values.items()}
+
+# --- CLIENT ---
+
+class A1111Client:
+    """Pooled connections to one A1111 server. base_url may be changed after creation."""
+
+    def __init__(self, base_url=DEFAULT_URL, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, pool_size=8):
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+
+        # Connect errors happen before the request is sent and are retried for any
+        # method; read errors and 5xx statuses only for GET.
+        retries = Retry(
+            total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0, status=3,
+            backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}), raise_on_status=False
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size))
+
+        # Readiness probes and /interrupt must fail fast, never retry
+        self.probe_session = requests.Session()
+        self.probe_session.mount('http://', HTTPAdapter(max_retries=0))
+
+        self.async_session = None
+
+    def url(self, path):
+        """URL of an API path. Paths starting with "/" are relative to the server root
+        (extension routes such as /reactor/image), others to base_url."""
+        if path.startswith("/"):
+            return f"{self.base_url.split('/sdapi/')[0]}{path}"
+        return f"{self.base_url}/{path}"
+
+    # --- blocking ---
+
+    def get_json(self, path, timeout=10):
+        """GETs a path and returns the decoded JSON (None on failure)."""
+        try:
+            response = self.session.get(self.url(path), timeout=(self.connect_timeout, timeout))
+            if response.status_code == 200:
+                return response.json()
+            print(f"Failed to get {path}: {response.status_code}")
+        except Exception as e:
+            print(f"Error getting {path}: {e}")
+        return None
+
+    def probe(self, path, timeout=5):
+        """Single GET attempt without retries. Returns the decoded JSON, or None."""
+        try:
+            response = self.probe_session.get(self.url(path), timeout=(self.connect_timeout, timeout))
+            if response.status_code == 200:
+                return response.json()
+        except Exception:
+            pass
+        return None
+
+    def post(self, path, payload, read_timeout=None, decode_images=False):
+        """POSTs a generation request. Returns the JSON response or {"error": ...}.
+
+        The body is parsed as it streams in; with decode_images the images come
+        back as PNG bytes instead of base64. On a read timeout the generation is
+        interrupted before returning.
+        """
+        try:
+            with self.session.post(
+                self.url(path),
+                json=payload,
+                timeout=(self.connect_timeout, read_timeout or self.read_timeout),
+                stream=True
+            ) as response:
+                if response.status_code != 200:
+                    return {"error": f"A1111 API Error: {response.status_code} - {response.text}"}
+                parser = GenerationResponseParser(decode_images)
+                for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                    parser.feed(chunk)
+                return parser.result()
+        except requests.exceptions.ReadTimeout:
+            return self.timed_out(path, read_timeout)
+        except requests.exceptions.ConnectionError as e:
+            # iter_content raises a read timeout during the body as a ConnectionError
+            if e.args and isinstance(e.args[0], ReadTimeoutError):
+                return self.timed_out(path, read_timeout)
+            return {"error": f"Error calling A1111 API: {str(e)}"}
+        except Exception as e:
+            return {"error": f"Error calling A1111 API: {str(e)}"}
+
+    def timed_out(self, path, read_timeout):
+        """Interrupts a generation whose caller stopped waiting and returns the error."""
+        self.interrupt()
+        return {"error": f"A1111 {path} timed out after {read_timeout or self.read_timeout}s and was interrupted"}
+
+    def set_options(self, options, read_timeout=None):
+        """POSTs /options; setting sd_model_checkpoint loads those weights first. Returns an error message, or None."""
+        try:
+            response = self.session.post(self.url("options"), json=options,
+                                         timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+        except Exception as e:
+            return f"Error setting A1111 options: {str(e)}"
+        if response.status_code != 200:
+            return f"A1111 API Error: {response.status_code} - {response.text}"
+        return None
+
+    def txt2img(self, payload, read_timeout=None):
+        return self.post("txt2img", payload, read_timeout)
+
+    def img2img(self, payload, read_timeout=None):
+        return self.post("img2img", payload, read_timeout)
+
+    def extra_single_image(self, payload, read_timeout=None):
+        return self.post("extra-single-image", payload, read_timeout)
+
+    def extra_batch_images(self, payload, read_timeout=None):
+        return self.post("extra-batch-images", payload, read_timeout)
+
+    def reactor_image(self, payload, read_timeout=None):
+        return self.post("/reactor/image", payload, read_timeout)
+
+    def interrupt(self):
+        """Asks A1111 to stop the generation in progress."""
+        try:
+            self.probe_session.post(self.url("interrupt"), timeout=(self.connect_timeout, 10))
+            print("A1111 generation interrupted")
+        except Exception as e:
+            print(f"Failed to interrupt A1111: {e}")
+
+    # --- asyncio ---
+
+    def get_async_session(self):
+        """Returns the pooled aiohttp session, creating it inside the running event loop."""
+        if self.async_session is None or self.async_session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.async_session = aiohttp.ClientSession(connector=connector)
+        return self.async_session
+
+    async def close_async(self):
+        if self.async_session is not None and not self.async_session.closed:
+            await self.async_session.close()
+
+    async def get_json_async(self, path, params=None, timeout=5, retries=CONNECT_RETRIES):
+        """GETs a path and returns the decoded JSON, or None. Retries 5xx and connection errors."""
+        delay = BACKOFF_FACTOR
+        for attempt in range(retries + 1):
+            try:
+                async with self.get_async_session().get(
+                    self.url(path),
+                    params=params,
+                    timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=timeout)
+                ) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    if response.status not in RETRY_STATUSES:
+                        return None
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, TimeoutError):
+                pass
+            if attempt < retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+        return None
+
+    async def post_raw_async(self, path, payload, read_timeout=None, parser=None):
+        """POSTs a generation request and returns (status, body bytes).
+
+        With a parser, a 200 body is fed to it chunk by chunk as it arrives
+        and None is returned in place of the body. Only connection failures are retried. A read timeout or cancellation
+        interrupts the generation on A1111 before the error propagates, so
+        callers must only use this while they own the GPU.
+        """
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=read_timeout or self.read_timeout)
+        delay = BACKOFF_FACTOR
+        for attempt in range(CONNECT_RETRIES + 1):
+            try:
+                async with self.get_async_session().post(self.url(path), json=payload, timeout=timeout) as response:
+                    if parser is None or response.status != 200:
+                        return response.status, await response.read()
+                    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        parser.feed(chunk)
+                    return response.status, None
+            except aiohttp.ClientConnectorError:
+                if attempt == CONNECT_RETRIES:
+                    raise
+                await asyncio.sleep(delay)
+                delay *= 2
+            except (asyncio.TimeoutError, TimeoutError, aiohttp.ServerTimeoutError):
+                await self.interrupt_async()
+                raise TimeoutError(f"A1111 {path} timed out after {read_timeout or self.read_timeout}s and was interrupted")
+            except asyncio.CancelledError:
+                await asyncio.shield(self.interrupt_async())
+                raise
+
+    async def post_async(self, path, payload, read_timeout=None, decode_images=False):
+        """Async counterpart of post: the JSON response or {"error": ...}."""
+        parser = GenerationResponseParser(decode_images)
+        try:
+            status, body = await self.post_raw_async(path, payload, read_timeout, parser)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return {"error": f"Error calling A1111 API: {str(e)}"}
+        if status != 200:
+            return {"error": f"A1111 API Error: {status} - {body.decode('utf-8', 'replace')}"}
+        try:
+            return await asyncio.to_thread(parser.result)
+        except ValueError as e:
+            return {"error": f"Error calling A1111 API: {str(e)}"}
+
+    async def interrupt_async(self):
+        """Asks A1111 to stop the generation in progress."""
+        try:
+            async with self.get_async_session().post(
+                self.url("interrupt"),
+                timeout=aiohttp.ClientTimeout(total=10)
+            ) as response:
+                await response.read()
+            print("A1111 generation interrupted")
+        except Exception as e:
+            print(f"Failed to interrupt A1111: {e}")
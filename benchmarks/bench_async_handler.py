@@ -0,0 +1,80 @@
+"""
+Throughput of the blocking handler vs. the async handler against the stub A1111.
+
+The stub serialises generations like a single GPU, so any gain comes from
+overlapping post-processing of one job with the generation of the next.
+--postprocess-ms adds a fixed cost per image on top of face detection to
+stand in for S3 uploads on a machine without a bucket.
+
+    python benchmarks/bench_async_handler.py --jobs 20 --latency 1.0 --postprocess-ms 400
+"""
+import argparse
+import asyncio
+import time
+
+from common import start_stub_a1111
+
+import handler as worker
+
+def make_event(i):
+    return {"id": f"bench-{i}", "input": {"prompt": f"portrait {i}", "seed": i, "width": 512, "height": 512}}
+
+def slow_postprocess(postprocess_ms):
+    """Wraps detect_and_save_faces_from_array with a fixed extra cost."""
+    detect = worker.detect_and_save_faces_from_array
+    def wrapped(bgr_img, timings=None, det_size=None):
+        time.sleep(postprocess_ms / 1000.0)
+        return detect(bgr_img, timings, det_size)
+    return wrapped
+
+def run_sync(jobs):
+    start = time.perf_counter()
+    for i in range(jobs):
+        output = worker.handler(make_event(i))
+        assert "error" not in output, output
+    return time.perf_counter() - start
+
+async def run_async(jobs):
+    # RunPod never hands the worker more than concurrency_modifier() jobs at once
+    slots = asyncio.Semaphore(worker.concurrency_modifier(0))
+    async def one(i):
+        async with slots:
+            output = await worker.async_handler(make_event(i))
+            assert "error" not in output, output
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(jobs)))
+    elapsed = time.perf_counter() - start
+    await worker.a1111.close_async()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=1.0, help="stub seconds per image")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--postprocess-ms", type=float, default=400)
+    parser.add_argument("--port", type=int, default=3900)
+    args = parser.parse_args()
+
+    # Jobs use fixed seeds; the async run must not be served from the sync run's results
+    worker.RESULT_CACHE_MAX_MB = 0
+    stub = start_stub_a1111(worker, args.port, args.latency, args.size)
+    try:
+        worker.detect_and_save_faces_from_array = slow_postprocess(args.postprocess_ms)
+
+        sync_elapsed = run_sync(args.jobs)
+        async_elapsed = asyncio.run(run_async(args.jobs))
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    print()
+    print(f"jobs={args.jobs} latency={args.latency}s postprocess={args.postprocess_ms}ms "
+          f"max_concurrent_jobs={worker.MAX_CONCURRENT_JOBS} gpu_concurrency={worker.GPU_CONCURRENCY}")
+    print(f"{'mode':<8}{'total s':>10}{'jobs/s':>10}")
+    print(f"{'sync':<8}{sync_elapsed:>10.2f}{args.jobs / sync_elapsed:>10.2f}")
+    print(f"{'async':<8}{async_elapsed:>10.2f}{args.jobs / async_elapsed:>10.2f}")
+    print(f"speedup: {sync_elapsed / async_elapsed:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Result latency of the Lambda's RunPod client against the fake RunPod API.
+
+Compares the original Lambda loop (POST /run, then a new-connection GET /status
+every 5 s) with runpod_client.py using /runsync, /stream and backoff polling of
+/status. Every mode runs the same --jobs jobs one after another. For each mode,
+the benchmark reports the mean time until the result arrives, how long that is
+beyond the job's own --latency, and the number of API requests made. A batch of
+--batch jobs then goes through run_many on --workers simulated workers. Finally,
+a use_stream client runs a job on a fake that, like a STREAM_HANDLER worker,
+returns the list of chunks from /runsync, and checks the final output is a dict.
+
+    python benchmarks/bench_client.py --jobs 5 --latency 3 --batch 16 --workers 4
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+from common import ROOT, percentile
+
+from runpod_client import RunPodClient
+
+ENDPOINT_ID = "bench"
+
+def legacy_run(base_url, job_input):
+    """The submit-and-poll loop the Lambda used before runpod_client.py."""
+    headers = {"Authorization": "Bearer test", "Content-Type": "application/json"}
+    response = requests.post(f"{base_url}/{ENDPOINT_ID}/run", json={"input": job_input}, headers=headers)
+    response.raise_for_status()
+    job_id = response.json()["id"]
+    while True:
+        job = requests.get(f"{base_url}/{ENDPOINT_ID}/status/{job_id}", headers=headers).json()
+        if job["status"] in ("COMPLETED", "FAILED"):
+            return job
+        time.sleep(5)
+
+def api_requests(base_url):
+    return sum(requests.get(f"{base_url}/stats").json().values()) - 1
+
+def bench_mode(name, run, jobs, base_url):
+    before = api_requests(base_url)
+    latencies = []
+    for i in range(jobs):
+        start = time.perf_counter()
+        job = run({"prompt": f"portrait {i}"})
+        latencies.append(time.perf_counter() - start)
+        assert job["status"] == "COMPLETED", job
+    return name, latencies, api_requests(base_url) - before - 1
+
+def start_fake(port, latency, workers, aggregate_stream=False):
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_runpod.py"), "--port", str(port),
+        "--latency", str(latency), "--workers", str(workers)
+    ] + (["--aggregate-stream"] if aggregate_stream else []))
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/v2/stats", timeout=1)
+            break
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    return fake
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=3.0, help="fake seconds per job")
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4, help="fake RunPod workers")
+    parser.add_argument("--port", type=int, default=3100)
+    args = parser.parse_args()
+
+    fake = start_fake(args.port, args.latency, args.workers)
+    base_url = f"http://127.0.0.1:{args.port}/v2"
+    try:
+        runsync = RunPodClient(ENDPOINT_ID, "test", base_url=base_url)
+        stream = RunPodClient(ENDPOINT_ID, "test", base_url=base_url, use_stream=True)
+        poll = RunPodClient(ENDPOINT_ID, "test", base_url=base_url)
+        results = [
+            bench_mode("legacy /status every 5 s", lambda job_input: legacy_run(base_url, job_input), args.jobs, base_url),
+            bench_mode("/runsync", runsync.run, args.jobs, base_url),
+            bench_mode("/run + /stream backoff", lambda job_input: stream.wait(stream.submit(job_input)), args.jobs, base_url),
+            bench_mode("/run + /status backoff", lambda job_input: poll.wait(poll.submit(job_input)), args.jobs, base_url),
+        ]
+        print(f"{args.jobs} jobs of {args.latency}s each, one at a time")
+        print(f"{'mode':<28}{'mean s':>9}{'p95 s':>9}{'overhead s':>12}{'requests':>10}")
+        for name, latencies, count in results:
+            mean = sum(latencies) / len(latencies)
+            print(f"{name:<28}{mean:>9.2f}{percentile(latencies, 95):>9.2f}{mean - args.latency:>12.2f}{count:>10}")
+
+        start = time.perf_counter()
+        jobs = runsync.run_many([{"prompt": f"batch {i}"} for i in range(args.batch)])
+        elapsed = time.perf_counter() - start
+        completed = sum(job["status"] == "COMPLETED" for job in jobs)
+        ideal = args.latency * -(-args.batch // args.workers)
+        print(f"run_many: {completed}/{args.batch} jobs on {args.workers} workers in {elapsed:.2f}s "
+              f"(queue-bound minimum {ideal:.2f}s)")
+    finally:
+        fake.terminate()
+
+    fake = start_fake(args.port + 1, 0.2, 1, aggregate_stream=True)
+    try:
+        streaming = RunPodClient(ENDPOINT_ID, "test", base_url=f"http://127.0.0.1:{args.port + 1}/v2", use_stream=True)
+        job = streaming.run({"prompt": "streamed"})
+        assert job["status"] == "COMPLETED" and isinstance(job["output"], dict) and "images" in job["output"], job
+        print("streaming worker: /runsync chunk list resolved to the final output")
+    finally:
+        fake.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Lookup latency of the face deduplication index (face_index.py).
+
+Fills an index with random unit vectors and times match_or_add for faces that
+are already stored (a noisy copy of a stored embedding) and for new faces.
+The index lives in a temporary directory; 1M entries take ~2 GB of disk and
+page cache.
+
+    python benchmarks/bench_face_index.py --sizes 10000 100000 1000000 --queries 200 \\
+        --shard-size 100000 --threads 1
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from common import percentile
+
+from face_index import EMBEDDING_DIM, FaceIndex
+
+FILL_CHUNK = 50_000
+
+def random_unit(rng, count):
+    vectors = rng.standard_normal((count, EMBEDDING_DIM), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def fill(index, rng, size):
+    for start in range(0, size, FILL_CHUNK):
+        count = min(FILL_CHUNK, size - start)
+        index.add_many([f"faces/f-{start + i}.png" for i in range(count)], random_unit(rng, count))
+
+def time_lookups(index, queries, threshold):
+    latencies, matches = [], 0
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        existing, _ = index.match_or_add(f"faces/q-{i}.png", query, threshold)
+        if existing is None:
+            index.commit(f"faces/q-{i}.png")
+        latencies.append((time.perf_counter() - start) * 1000)
+        matches += existing is not None
+    return latencies, matches
+
+def bench(size, args, rng):
+    directory = tempfile.mkdtemp(prefix="face-index-")
+    try:
+        index = FaceIndex(directory, shard_size=args.shard_size, search_threads=args.threads)
+        start = time.perf_counter()
+        fill(index, rng, size)
+        fill_s = time.perf_counter() - start
+
+        # Known faces: stored rows plus noise, well above the threshold
+        rows = rng.integers(0, size, args.queries)
+        known = []
+        for row in rows:
+            shard = index.shards[row // args.shard_size]["matrix"]
+            known.append(shard[row % args.shard_size] + random_unit(rng, 1)[0] * 0.3)
+        known_ms, known_matches = time_lookups(index, known, args.threshold)
+        new_ms, new_matches = time_lookups(index, random_unit(rng, args.queries), args.threshold)
+
+        # Allocated size; the last shard is a sparse file until it fills up
+        disk_mb = sum(os.stat(os.path.join(directory, name)).st_blocks * 512 for name in os.listdir(directory)) / 1e6
+        index.close()
+        reopen_start = time.perf_counter()
+        FaceIndex(directory, shard_size=args.shard_size).close()
+        reopen_s = time.perf_counter() - reopen_start
+        return {
+            "size": size, "shards": len(index.shards), "fill_s": fill_s, "reopen_s": reopen_s, "disk_mb": disk_mb,
+            "known": known_ms, "known_matches": known_matches, "new": new_ms, "new_matches": new_matches,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--shard-size", type=int, default=100_000)
+    parser.add_argument("--threads", type=int, default=1, help="FACE_INDEX_SEARCH_THREADS")
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = [bench(size, args, rng) for size in args.sizes]
+
+    print(f"dim={EMBEDDING_DIM} shard_size={args.shard_size} threads={args.threads} "
+          f"queries={args.queries} threshold={args.threshold}")
+    print(f"{'entries':>9}{'shards':>8}{'disk MB':>9}{'fill s':>8}{'open s':>8}"
+          f"{'hit p50':>9}{'hit p95':>9}{'miss p50':>10}{'miss p95':>10}{'hits':>7}{'false':>7}")
+    for r in results:
+        print(f"{r['size']:>9}{r['shards']:>8}{r['disk_mb']:>9.0f}{r['fill_s']:>8.2f}{r['reopen_s']:>8.2f}"
+              f"{percentile(r['known'], 50):>9.2f}{percentile(r['known'], 95):>9.2f}"
+              f"{percentile(r['new'], 50):>10.2f}{percentile(r['new'], 95):>10.2f}"
+              f"{r['known_matches']:>7}{r['new_matches']:>7}")
+    print("latencies in ms; hits = known faces matched, false = new faces wrongly matched")
+
+if __name__ == "__main__":
+    main()
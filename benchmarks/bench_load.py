@@ -0,0 +1,109 @@
+"""
+End-to-end load test of the worker on a CPU-only machine.
+
+Replays a JSONL workload (one RunPod event, or just its "input", per line)
+through the handler against benchmarks/stub_a1111.py and an in-memory S3
+stand-in. Reports throughput, p50/p95/p99 job latency and the mean time per
+stage taken from each job's `timings`.
+
+    python benchmarks/bench_load.py --workload benchmarks/workload.jsonl --repeat 5 \\
+        --mode both --concurrency 4 --latency 1.0 --s3-latency-ms 40
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import time
+from collections import defaultdict
+
+from common import ROOT, InMemoryS3, percentile, start_stub_a1111
+
+import handler as worker
+
+def load_workload(path, repeat):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                event = json.loads(line)
+                events.append(event if "input" in event else {"input": event})
+    return [dict(copy.deepcopy(event), id=f"bench-{i}") for i, event in enumerate(events * repeat)]
+
+def run_sync(events):
+    results = []
+    for event in events:
+        start = time.perf_counter()
+        output = worker.handler(event)
+        results.append((time.perf_counter() - start, output))
+    return results
+
+async def run_async(events, concurrency):
+    # RunPod never hands the worker more jobs at once than it allows
+    slots = asyncio.Semaphore(concurrency)
+    async def one(event):
+        async with slots:
+            start = time.perf_counter()
+            output = await worker.async_handler(event)
+            return time.perf_counter() - start, output
+    results = await asyncio.gather(*(one(event) for event in events))
+    await worker.a1111.close_async()
+    return results
+
+def report(mode, results, elapsed):
+    latencies = [latency * 1000 for latency, _ in results]
+    errors = [output["error"] for _, output in results if "error" in output]
+    stages = defaultdict(list)
+    for _, output in results:
+        for stage, value in (output.get("timings") or {}).items():
+            stages[stage].append(value)
+
+    print(f"\n== {mode}: {len(results)} jobs in {elapsed:.2f}s, {len(results) / elapsed:.2f} jobs/s, {len(errors)} errors")
+    print(f"latency ms  p50={percentile(latencies, 50):.0f}  p95={percentile(latencies, 95):.0f}  "
+          f"p99={percentile(latencies, 99):.0f}  max={max(latencies):.0f}")
+    print(f"{'stage':<24}{'jobs':>6}{'mean ms':>12}{'p95 ms':>12}")
+    for stage in sorted(stages, key=lambda name: -sum(stages[name])):
+        values = stages[stage]
+        print(f"{stage:<24}{len(values):>6}{sum(values) / len(values):>12.1f}{percentile(values, 95):>12.1f}")
+    for error in errors[:5]:
+        print(f"error: {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", default=os.path.join(ROOT, "benchmarks", "workload.jsonl"))
+    parser.add_argument("--repeat", type=int, default=3, help="times the workload is replayed")
+    parser.add_argument("--mode", choices=("sync", "async", "both"), default="both")
+    parser.add_argument("--concurrency", type=int, default=worker.MAX_CONCURRENT_JOBS)
+    parser.add_argument("--latency", type=float, default=1.0, help="stub seconds per image")
+    parser.add_argument("--size", type=int, default=1024, help="stub default image size")
+    parser.add_argument("--s3-latency-ms", type=float, default=30.0)
+    parser.add_argument("--result-cache", action="store_true", help="keep the worker's result cache enabled")
+    parser.add_argument("--port", type=int, default=3901)
+    args = parser.parse_args()
+
+    worker.s3_client = InMemoryS3(args.s3_latency_ms)
+    if not args.result_cache:
+        worker.RESULT_CACHE_MAX_MB = 0
+        worker.RESULT_CACHE_S3_BUCKET = None
+    stub = start_stub_a1111(worker, args.port, args.latency, args.size)
+    try:
+        worker.refresh_model_registry()
+        if args.mode in ("sync", "both"):
+            events = load_workload(args.workload, args.repeat)
+            start = time.perf_counter()
+            results = run_sync(events)
+            report("sync", results, time.perf_counter() - start)
+        if args.mode in ("async", "both"):
+            worker.MAX_CONCURRENT_JOBS = args.concurrency
+            events = load_workload(args.workload, args.repeat)
+            start = time.perf_counter()
+            results = asyncio.run(run_async(events, args.concurrency))
+            report(f"async x{args.concurrency}", results, time.perf_counter() - start)
+    finally:
+        stub.terminate()
+        stub.wait()
+    print(f"\nS3 stand-in holds {len(worker.s3_client.objects)} objects, {worker.s3_client.stored_bytes() / 1e6:.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Session build time and per-image inference latency of the face detector on CPU,
+with and without the optimised-graph cache of onnx_sessions.py.
+
+Modes:
+- plain: an InferenceSession with default options, which is what insightface builds.
+- cold: OnnxSessionFactory with an empty cache. It optimises the graph and saves it.
+- cached: OnnxSessionFactory loading the saved graph.
+
+The cached mode is what later starts of the worker pay. --threads sets
+intra_op_num_threads (0 = ONNX Runtime default). Latency is one session.run at
+--det-size, without insightface's pre- and post-processing, which the cache does not change.
+
+    python benchmarks/bench_onnx_sessions.py --model /root/.insightface/models/buffalo_l/det_10g.onnx
+    python benchmarks/bench_onnx_sessions.py --synthetic --threads 1 0
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+from common import percentile
+
+from onnx_sessions import OnnxSessionFactory
+
+def synthetic_detector(path, blocks=32, channels=128):
+    """Writes a conv/batch-norm/relu stack with five outputs, about the size of det_10g.onnx."""
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+    rng = np.random.default_rng(0)
+    nodes, inits, current, in_channels = [], [], "input.1", 3
+    for i in range(blocks):
+        stride = 2 if i % 4 == 0 else 1
+        weight = numpy_helper.from_array(rng.standard_normal((channels, in_channels, 3, 3), dtype=np.float32) * 0.05, f"w{i}")
+        bn = [numpy_helper.from_array(value, f"bn{i}_{name}") for name, value in (
+            ("scale", np.ones(channels, np.float32)), ("bias", np.zeros(channels, np.float32)),
+            ("mean", np.zeros(channels, np.float32)), ("var", np.ones(channels, np.float32)))]
+        inits += [weight] + bn
+        nodes += [
+            helper.make_node("Conv", [current, f"w{i}"], [f"c{i}"], pads=[1, 1, 1, 1], strides=[stride, stride]),
+            helper.make_node("BatchNormalization", [f"c{i}"] + [t.name for t in bn], [f"b{i}"]),
+            helper.make_node("Relu", [f"b{i}"], [f"r{i}"]),
+        ]
+        current, in_channels = f"r{i}", channels
+    outputs = []
+    for j in range(5):
+        head = numpy_helper.from_array(rng.standard_normal((2, channels, 1, 1), dtype=np.float32) * 0.05, f"head{j}")
+        inits.append(head)
+        nodes.append(helper.make_node("Conv", [current, f"head{j}"], [f"out{j}"]))
+        outputs.append(helper.make_tensor_value_info(f"out{j}", TensorProto.FLOAT, None))
+    graph = helper.make_graph(nodes, "synthetic_detector",
+                              [helper.make_tensor_value_info("input.1", TensorProto.FLOAT, [1, 3, "h", "w"])],
+                              outputs, inits)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+    onnx.save(model, path)
+
+def build(mode, model_path, cache_dir, threads):
+    start = time.perf_counter()
+    if mode == "plain":
+        session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    else:
+        if mode == "cold":
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        factory = OnnxSessionFactory(cache_dir, providers=["CPUExecutionProvider"], intra_op_threads=threads)
+        session = factory.create(model_path)
+        assert factory.timings[os.path.basename(model_path)]["cached"] == (mode == "cached")
+    return session, (time.perf_counter() - start) * 1000
+
+def run_latency(session, det_size, images):
+    feed = {session.get_inputs()[0].name: np.random.default_rng(0).random((1, 3, det_size, det_size), dtype=np.float32)}
+    session.run(None, feed)  # first run allocates buffers
+    latencies = []
+    for _ in range(images):
+        start = time.perf_counter()
+        session.run(None, feed)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="/root/.insightface/models/buffalo_l/det_10g.onnx")
+    parser.add_argument("--synthetic", action="store_true", help="use a generated detector-shaped model")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0], help="intra-op threads to compare")
+    parser.add_argument("--det-size", type=int, default=640)
+    parser.add_argument("--builds", type=int, default=3, help="session builds per mode")
+    parser.add_argument("--images", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="onnx-bench-")
+    try:
+        model_path = args.model
+        if args.synthetic:
+            model_path = os.path.join(workdir, "synthetic_det.onnx")
+            synthetic_detector(model_path)
+        elif not os.path.exists(model_path):
+            raise SystemExit(f"{model_path} not found; pass --model or --synthetic")
+        cache_dir = os.path.join(workdir, "cache")
+
+        print(f"model={os.path.basename(model_path)} onnxruntime={ort.__version__} det_size={args.det_size} "
+              f"cpus={os.cpu_count()} OMP_NUM_THREADS={os.environ.get('OMP_NUM_THREADS', '-')}")
+        print(f"{'mode':<8}{'threads':>8}{'build ms':>10}{'run p50 ms':>12}{'run p95 ms':>12}")
+        for threads in args.threads:
+            for mode in ("plain", "cold", "cached"):
+                if mode == "plain" and threads:
+                    continue
+                builds = [build(mode, model_path, cache_dir, threads) for _ in range(args.builds)]
+                latencies = run_latency(builds[-1][0], args.det_size, args.images)
+                build_ms = min(ms for _, ms in builds)
+                print(f"{mode:<8}{threads or 'default':>8}{build_ms:>10.1f}"
+                      f"{percentile(latencies, 50):>12.1f}{percentile(latencies, 95):>12.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Peak memory of one job while the worker receives and handles a large A1111
+response, against the stub A1111.
+
+Every case runs in a fresh process. The process is warmed up with a small job,
+its peak RSS is reset, and then it handles one txt2img response of --sizes x
+--sizes images at each --batches. The images go to a discarding uploader
+(output_mode s3, PNG, no face detection), so the figure is the memory the
+response itself costs. Modes:
+- legacy: requests' response.json() on the whole body, then a b64decode per image,
+  which is what the worker did before responses were streamed.
+- stream-base64: GenerationResponseParser keeping the images as base64 strings
+  (base64 output mode, upscale and pipeline jobs).
+- stream-bytes: GenerationResponseParser decoding the images while they stream in
+  (s3 output mode).
+
+    python benchmarks/bench_response_memory.py --sizes 1024 2048 --batches 1 8 --noise 0.5
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import requests
+
+from common import ROOT
+
+MODES = ("legacy", "stream-base64", "stream-bytes")
+
+def current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def reset_peak_rss():
+    """Resets the kernel's peak RSS (VmHWM) of this process. Returns False where that is not supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def receive(worker, mode, payload):
+    if mode == "legacy":
+        response = worker.a1111.session.post(worker.a1111.url("txt2img"), json=payload, timeout=(5, 600))
+        response.raise_for_status()
+        return response.json()
+    return worker.a1111.post("txt2img", payload, decode_images=mode == "stream-bytes")
+
+def run_child(args):
+    """One measured job, printed as a JSON line."""
+    import handler as worker
+    worker.a1111.base_url = f"http://127.0.0.1:{args.port}/sdapi/v1"
+    worker.image_uploader = lambda key, body, content_type: None
+    options = {"detect_faces": False, "upscale": None, "det_size": None,
+               "output_mode": "s3", "output_format": "png", "output_quality": 95}
+    payload = {"prompt": "portrait", "steps": 20, "width": args.size, "height": args.size, "batch_size": args.batch}
+
+    worker.postprocess_output(receive(worker, args.mode, dict(payload, width=64, height=64, batch_size=1)), options)
+    exact = reset_peak_rss()
+    baseline = current_rss() if exact else peak_rss()
+    start = time.perf_counter()
+    output = worker.postprocess_output(receive(worker, args.mode, payload), options)
+    elapsed = time.perf_counter() - start
+    assert "error" not in output and len(output["outputs"]) == args.batch, output
+    print(json.dumps({
+        "peak_mb": (peak_rss() - baseline) / 2**20, "ms": elapsed * 1000, "exact": exact,
+        "png_mb": output["outputs"][0]["bytes"] / 2**20,
+    }))
+
+def measure(mode, size, batch, port):
+    result = subprocess.run([
+        sys.executable, os.path.abspath(__file__), "--child", "--mode", mode,
+        "--size", str(size), "--batch", str(batch), "--port", str(port)
+    ], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048])
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--noise", type=float, default=0.5, help="stub PNG noise fraction (0.5 ~ a photo)")
+    parser.add_argument("--port", type=int, default=3930)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--batch", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args)
+
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "stub_a1111.py"), "--port", str(args.port),
+        "--latency", "0", "--noise", str(args.noise)
+    ], stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"http://127.0.0.1:{args.port}/sdapi/v1/progress", timeout=1)
+                break
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.1)
+
+        print(f"{'size':>6}{'batch':>7}{'PNG MB':>8}  " + "".join(f"{mode + ' MB':>18}" for mode in MODES)
+              + f"{'legacy ms':>11}{'bytes ms':>10}")
+        for size in args.sizes:
+            for batch in args.batches:
+                results = {mode: measure(mode, size, batch, args.port) for mode in MODES}
+                print(f"{size:>6}{batch:>7}{results['legacy']['png_mb']:>8.1f}  "
+                      + "".join(f"{results[mode]['peak_mb']:>18.1f}" for mode in MODES)
+                      + f"{results['legacy']['ms']:>11.0f}{results['stream-bytes']['ms']:>10.0f}")
+        if not all(result["exact"] for result in results.values()):
+            print("Peak RSS could not be reset; figures include the process's earlier peak.")
+    finally:
+        stub.terminate()
+        stub.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Priority and deadline scheduling of the async handler against the stub A1111.
+
+Priorities: --bulk jobs of priority -10 arrive first and --interactive jobs of
+the default priority 0 arrive right after. The run is repeated with every job
+at priority 0, and the latency of each class is reported for both runs.
+
+Deadlines: --deadline-jobs jobs arrive at once, each with a deadline --deadline
+seconds away. The report counts the jobs that completed, those rejected up
+front from the generation-time estimate, those dropped while queued and those
+interrupted mid-generation.
+
+    python benchmarks/bench_scheduling.py --latency 0.5 --bulk 8 --interactive 3 --deadline-jobs 8 --deadline 2
+"""
+import argparse
+import asyncio
+import time
+
+from common import percentile, start_stub_a1111
+
+import handler as worker
+import metrics
+
+def make_event(i, **schedule):
+    return {"id": f"sched-{i}", "input": dict({"prompt": f"portrait {i}", "width": 512, "height": 512, "steps": 20}, **schedule)}
+
+async def timed(event, delay=0.0):
+    await asyncio.sleep(delay)
+    start = time.perf_counter()
+    output = await worker.async_handler(event)
+    return time.perf_counter() - start, output
+
+async def priority_run(bulk, interactive, prioritised):
+    low = {"priority": -10} if prioritised else {}
+    jobs = [timed(make_event(i, **low)) for i in range(bulk)]
+    jobs += [timed(make_event(bulk + i), 0.05) for i in range(interactive)]
+    results = await asyncio.gather(*jobs)
+    return [latency for latency, _ in results[:bulk]], [latency for latency, _ in results[bulk:]]
+
+def expired_counts():
+    counters = metrics.snapshot()["counters"]
+    return {stage: counters.get(f'worker_jobs_expired_total{{stage="{stage}"}}', 0)
+            for stage in ("rejected", "queued", "generating")}
+
+async def deadline_run(jobs, deadline):
+    before = expired_counts()
+    deadline_at = time.time() + deadline
+    results = await asyncio.gather(*(timed(make_event(100 + i, deadline=deadline_at)) for i in range(jobs)))
+    after = expired_counts()
+    completed = sum("error" not in output for _, output in results)
+    return completed, {stage: after[stage] - before[stage] for stage in after}, max(latency for latency, _ in results)
+
+async def main_async(args):
+    # One job first, so the scheduler has a generation-time measurement
+    await timed(make_event(-1))
+    rows = []
+    for prioritised in (False, True):
+        bulk, interactive = await priority_run(args.bulk, args.interactive, prioritised)
+        rows.append(("priorities" if prioritised else "arrival order", bulk, interactive))
+    deadline_result = await deadline_run(args.deadline_jobs, args.deadline)
+    await worker.a1111.close_async()
+    return rows, deadline_result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.5, help="stub seconds per image")
+    parser.add_argument("--bulk", type=int, default=8)
+    parser.add_argument("--interactive", type=int, default=3)
+    parser.add_argument("--deadline-jobs", type=int, default=8)
+    parser.add_argument("--deadline", type=float, default=2.0, help="seconds from arrival to deadline")
+    parser.add_argument("--port", type=int, default=3920)
+    args = parser.parse_args()
+
+    worker.RESULT_CACHE_MAX_MB = 0
+    worker.detect_and_save_faces_from_array = lambda bgr_img, timings=None, det_size=None: []
+    stub = start_stub_a1111(worker, args.port, args.latency, 512)
+    try:
+        rows, (completed, expired, slowest) = asyncio.run(main_async(args))
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    print(f"\nlatency={args.latency}s per image, gpu_concurrency={worker.GPU_CONCURRENCY}")
+    print(f"{'order':<16}{'bulk p50 s':>12}{'bulk max s':>12}{'inter. p50 s':>14}{'inter. max s':>14}")
+    for name, bulk, interactive in rows:
+        print(f"{name:<16}{percentile(bulk, 50):>12.2f}{max(bulk):>12.2f}"
+              f"{percentile(interactive, 50):>14.2f}{max(interactive):>14.2f}")
+    print(f"\ndeadline {args.deadline}s, {args.deadline_jobs} jobs: {completed} completed, "
+          f"{expired['rejected']} rejected up front, {expired['queued']} dropped while queued, "
+          f"{expired['generating']} interrupted; last answer after {slowest:.2f}s")
+
+if __name__ == "__main__":
+    main()
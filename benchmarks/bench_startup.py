@@ -0,0 +1,52 @@
+"""
+Import-time and warm-up cost of the worker, measured in fresh interpreters.
+
+Each run starts a new Python process, imports handler.py, runs warm_up() (the
+heavy imports, S3 client, face analyzer and dedup index) and imports runpod,
+then prints the per-phase timings from handler.startup_timings. Before the
+lazy start-up, all of these phases ran ahead of the A1111 launch. Now only
+`import_handler` does, and the rest overlaps with the A1111 boot.
+
+    python benchmarks/bench_startup.py --runs 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from common import ROOT
+
+CHILD = """
+import json
+import handler
+handler.warm_up()
+handler.timed_import("runpod")
+print("PROFILE " + json.dumps(handler.startup_timings))
+"""
+
+def run_once():
+    env = dict(os.environ, METRICS_LOG_INTERVAL="0")
+    result = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=env, capture_output=True, text=True)
+    for line in result.stdout.splitlines():
+        if line.startswith("PROFILE "):
+            return json.loads(line[len("PROFILE "):])
+    sys.exit(f"child failed:\n{result.stdout}\n{result.stderr}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    phases = sorted({phase for run in runs for phase in run}, key=lambda phase: -max(run.get(phase, 0) for run in runs))
+    print(f"{'phase':<28}{'min ms':>10}{'max ms':>10}")
+    for phase in phases:
+        values = [run[phase] for run in runs if phase in run]
+        print(f"{phase[:-len('_ms')]:<28}{min(values):>10.1f}{max(values):>10.1f}")
+    critical = min(run["import_handler_ms"] for run in runs)
+    background = min(run["warm_up_ms"] + run.get("import_runpod_ms", 0) for run in runs)
+    print(f"before the A1111 launch: {critical:.0f} ms; overlapped with the A1111 boot: {background:.0f} ms")
+
+if __name__ == "__main__":
+    main()
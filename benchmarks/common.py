@@ -0,0 +1,66 @@
+"""Shared helpers for the benchmark scripts: stub A1111 process, in-memory S3, percentiles."""
+import io
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+def start_stub_a1111(worker, port, latency, size):
+    """Launches benchmarks/stub_a1111.py and points the worker module at it."""
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "stub_a1111.py"),
+        "--port", str(port), "--latency", str(latency), "--size", str(size)
+    ])
+    worker.LOCAL_URL = f"http://127.0.0.1:{port}/sdapi/v1"
+    worker.a1111.base_url = worker.LOCAL_URL
+    # The watchdog and handler treat this process as the A1111 subprocess
+    worker.a1111_process = stub
+    if not worker.wait_for_service(f"{worker.LOCAL_URL}/progress", max_wait=30):
+        stub.terminate()
+        sys.exit("stub A1111 did not start")
+    return stub
+
+class NoSuchKey(Exception):
+    pass
+
+class InMemoryS3:
+    """Stand-in for the boto3 S3 client calls the worker makes, with a fixed per-call latency."""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    def get_object(self, Bucket, Key):
+        time.sleep(self.latency)
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise NoSuchKey(Key)
+            return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def stored_bytes(self):
+        with self.lock:
+            return sum(len(body) for body in self.objects.values())
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers (q in 0..100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100.0 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
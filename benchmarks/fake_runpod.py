@@ -0,0 +1,155 @@
+"""
+Fake of the RunPod serverless API (/v2/<endpoint>/...) for exercising the
+Lambda client (runpod_client.py) without an account.
+
+Jobs run on --workers simulated workers and take --latency seconds each
+(optionally +/- --jitter). While running they produce a progress chunk every
+quarter of their run time, and their final output is the last chunk, like a
+worker with STREAM_HANDLER=true. With --aggregate-stream, /runsync and /status
+return the list of all chunks as the output, as RunPod does for a streaming
+worker started with return_aggregate_stream. Supported routes: POST run, runsync (?wait=ms),
+cancel/<id>; GET status/<id>, stream/<id>.
+
+    python benchmarks/fake_runpod.py --port 3100 --latency 4 --workers 2
+"""
+import argparse
+import json
+import queue
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+jobs = {}
+jobs_lock = threading.Condition()
+# Requests served per route, reported by GET /stats
+stats = {}
+
+def new_job(job_input, config):
+    job = {
+        "id": f"fake-{uuid.uuid4().hex[:12]}", "status": "IN_QUEUE", "input": job_input,
+        "latency": max(config.latency + random.uniform(-config.jitter, config.jitter), 0.0),
+        "chunks": [], "read": 0, "output": None,
+    }
+    with jobs_lock:
+        jobs[job["id"]] = job
+    return job
+
+def run_worker(job_queue, config):
+    """One simulated GPU worker: takes queued jobs in order and runs them."""
+    while True:
+        job = job_queue.get()
+        with jobs_lock:
+            if job["status"] != "IN_QUEUE":
+                continue
+            job["status"] = "IN_PROGRESS"
+        for step in range(1, 4):
+            time.sleep(job["latency"] / 4)
+            with jobs_lock:
+                job["chunks"].append({"status": "generating", "progress": step / 4})
+                jobs_lock.notify_all()
+        time.sleep(job["latency"] / 4)
+        output = job["input"].get("fake_output") or {"images": ["iVBORw0KGgo="], "info": json.dumps({"seed": 1})}
+        with jobs_lock:
+            if job["status"] == "IN_PROGRESS":
+                job["output"] = output
+                job["chunks"].append(output)
+                job["status"] = "COMPLETED"
+            jobs_lock.notify_all()
+
+def public(job, aggregate_stream=False, **extra):
+    result = {"id": job["id"], "status": job["status"]}
+    if job["status"] == "COMPLETED":
+        result["output"] = list(job["chunks"]) if aggregate_stream else job["output"]
+    result.update(extra)
+    return result
+
+class FakeRunPodHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+    queue = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        """Returns (action, job id or None, query) for /v2/<endpoint>/<action>[/<id>]."""
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        route = parts[2] if len(parts) >= 3 and parts[0] == "v2" else parts[-1]
+        with jobs_lock:
+            stats[route] = stats.get(route, 0) + 1
+        return route, (parts[3] if len(parts) > 3 else None), parse_qs(url.query)
+
+    def do_GET(self):
+        action, job_id, _ = self.route()
+        if action == "stats":
+            with jobs_lock:
+                return self.send_json(dict(stats))
+        job = jobs.get(job_id)
+        if job is None:
+            return self.send_json({"error": "job not found"}, status=404)
+        if action == "status":
+            self.send_json(public(job, self.config.aggregate_stream))
+        elif action == "stream":
+            with jobs_lock:
+                chunks, job["read"] = job["chunks"][job["read"]:], len(job["chunks"])
+            self.send_json({"id": job["id"], "status": job["status"], "stream": [{"output": c} for c in chunks]})
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        action, job_id, query = self.route()
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if action in ("run", "runsync"):
+            job = new_job(body.get("input", {}), self.config)
+            self.queue.put(job)
+            if action == "run":
+                return self.send_json({"id": job["id"], "status": "IN_QUEUE"})
+            deadline = time.monotonic() + int(query.get("wait", ["90000"])[0]) / 1000
+            with jobs_lock:
+                while job["status"] in ("IN_QUEUE", "IN_PROGRESS") and time.monotonic() < deadline:
+                    jobs_lock.wait(deadline - time.monotonic())
+            self.send_json(public(job, self.config.aggregate_stream))
+        elif action == "cancel":
+            job = jobs.get(job_id)
+            if job is None:
+                return self.send_json({"error": "job not found"}, status=404)
+            with jobs_lock:
+                if job["status"] in ("IN_QUEUE", "IN_PROGRESS"):
+                    job["status"] = "CANCELLED"
+            self.send_json(public(job))
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+def serve(port=3100, latency=4.0, workers=1, jitter=0.0, aggregate_stream=False):
+    """Runs the fake API until interrupted."""
+    FakeRunPodHandler.config = argparse.Namespace(latency=latency, jitter=jitter, aggregate_stream=aggregate_stream)
+    FakeRunPodHandler.queue = queue.Queue()
+    for _ in range(workers):
+        threading.Thread(target=run_worker, args=(FakeRunPodHandler.queue, FakeRunPodHandler.config), daemon=True).start()
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeRunPodHandler)
+    server.daemon_threads = True
+    print(f"Fake RunPod API listening on http://127.0.0.1:{port}/v2 (latency={latency}s, workers={workers})")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=3100)
+    parser.add_argument("--latency", type=float, default=4.0, help="seconds per job")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- random seconds per job")
+    parser.add_argument("--workers", type=int, default=1, help="jobs run at the same time")
+    parser.add_argument("--aggregate-stream", action="store_true", help="return chunk lists as the output")
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.workers, args.jitter, args.aggregate_stream)
@@ -0,0 +1,178 @@
+"""
+Stub of the A1111 /sdapi/v1 API for running the worker on a CPU-only machine.
+
+Generations are serialised behind a lock, like a single GPU, and take
+--latency seconds each. Images are grey PNGs of --size x --size. With --noise,
+that fraction of each row is random, which sets the PNG size: about 3 bytes per
+pixel times --noise. A generated photo is about 1.5 bytes per pixel.
+
+    python benchmarks/stub_a1111.py --port 3000 --latency 1.5 --size 1024
+"""
+import argparse
+import base64
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+gpu_lock = threading.Lock()
+png_cache = {}
+# Generation currently holding gpu_lock, reported by /progress
+current_job = {"start": None, "duration": 0.0, "steps": 0}
+# Settings changed through POST /options
+options = {"sd_model_checkpoint": "ultimaterealismo.safetensors"}
+
+def make_png(width, height, noise=0.0):
+    """Builds an RGB PNG without any imaging dependency: grey, with a noise fraction of random pixels per row."""
+    key = (width, height, noise)
+    if key not in png_cache:
+        def chunk(tag, data):
+            return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+        random_bytes = int(width * noise) * 3
+        raw = b"".join(b"\x00" + random.randbytes(random_bytes) + b"\x80" * (width * 3 - random_bytes)
+                       for _ in range(height))
+        png_cache[key] = (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1))
+            + chunk(b"IEND", b"")
+        )
+    return png_cache[key]
+
+def png_size(image_b64):
+    header = base64.b64decode(image_b64[:32])
+    return struct.unpack(">II", header[16:24])
+
+class StubA1111Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def progress(self):
+        start, duration, steps = current_job["start"], current_job["duration"], current_job["steps"]
+        if start is None or not duration:
+            return {"progress": 0.0, "eta_relative": 0.0, "state": {"job_count": 0}, "current_image": None}
+        done = min((time.time() - start) / duration, 1.0)
+        skip_image = "skip_current_image=false" not in self.path
+        return {
+            "progress": done,
+            "eta_relative": max(duration - (time.time() - start), 0.0),
+            "state": {"job_count": 1, "sampling_step": int(done * steps), "sampling_steps": steps},
+            "current_image": None if skip_image else base64.b64encode(make_png(64, 64)).decode("ascii"),
+        }
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/sdapi/v1/progress":
+            self.send_json(self.progress())
+        elif path == "/sdapi/v1/controlnet/version":
+            self.send_json({"version": 2})
+        elif path == "/sdapi/v1/controlnet/model_list":
+            self.send_json({"model_list": ["ip-adapter_sdxl [7d943a46]"]})
+        elif path == "/sdapi/v1/scripts":
+            self.send_json({"txt2img": ["reactor"], "img2img": ["reactor"]})
+        elif path == "/sdapi/v1/options":
+            self.send_json(options)
+        elif path == "/sdapi/v1/sd-models":
+            self.send_json([
+                {"title": name, "model_name": name.rsplit(".", 1)[0], "filename": f"/models/Stable-diffusion/{name}"}
+                for name in ("ultimaterealismo.safetensors", "sd_xl_refiner_1.0.safetensors")
+            ])
+        elif path == "/sdapi/v1/loras":
+            self.send_json([{"name": "epiCRealnessRC1", "alias": "epiCRealnessRC1",
+                             "path": "/models/Lora/epiCRealnessRC1.safetensors"}])
+        elif path == "/sdapi/v1/upscalers":
+            self.send_json([{"name": name} for name in ("None", "Lanczos", "R-ESRGAN 4x+", "4x-UltraSharp")])
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+    def do_POST(self):
+        payload = self.read_json()
+        if self.path == "/sdapi/v1/txt2img":
+            self.send_json(self.generate(payload))
+        elif self.path == "/sdapi/v1/img2img":
+            width, height = png_size(payload["init_images"][0])
+            self.send_json(self.generate(dict({"width": width, "height": height}, **payload)))
+        elif self.path == "/sdapi/v1/extra-single-image":
+            self.send_json({"image": self.upscale([payload["image"]], payload)[0], "html_info": ""})
+        elif self.path == "/sdapi/v1/extra-batch-images":
+            images = [item["data"] for item in payload["imageList"]]
+            self.send_json({"images": self.upscale(images, payload), "html_info": ""})
+        elif self.path == "/reactor/image":
+            with gpu_lock:
+                time.sleep(self.config.latency * 0.1)
+            self.send_json({"image": payload["target_image"]})
+        elif self.path == "/sdapi/v1/options":
+            with gpu_lock:
+                if payload.get("sd_model_checkpoint", options["sd_model_checkpoint"]) != options["sd_model_checkpoint"]:
+                    time.sleep(self.config.latency)  # loading weights
+                options.update(payload)
+            self.send_json(None)
+        elif self.path == "/sdapi/v1/interrupt":
+            self.send_json({})
+        else:
+            self.send_json({"detail": "Not Found"}, status=404)
+
+    def upscale(self, images, payload):
+        """Extras: returns PNGs scaled by upscaling_resize, at a tenth of --latency per output megapixel."""
+        scale = float(payload.get("upscaling_resize", 2))
+        sizes = [(int(w * scale), int(h * scale)) for w, h in map(png_size, images)]
+        with gpu_lock:
+            time.sleep(self.config.latency * 0.1 * sum(w * h for w, h in sizes) / 1e6)
+        return [base64.b64encode(make_png(w, h, self.config.noise)).decode("ascii") for w, h in sizes]
+
+    def generate(self, payload):
+        count = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        width = int(payload.get("width") or self.config.size)
+        height = int(payload.get("height") or self.config.size)
+        with gpu_lock:
+            current_job.update(start=time.time(), duration=self.config.latency * count, steps=int(payload.get("steps", 20)))
+            time.sleep(self.config.latency * count)
+            current_job.update(start=None, duration=0.0, steps=0)
+        image = base64.b64encode(make_png(width, height, self.config.noise)).decode("ascii")
+        seed = payload.get("seed", -1)
+        if seed is None or int(seed) == -1:
+            seed = random.randint(0, 2**32 - 1)
+        seeds = [int(seed) + i for i in range(count)]
+        prompt = payload.get("prompt", "")
+        info = {
+            "prompt": prompt, "all_prompts": [prompt] * count,
+            "seed": seeds[0], "all_seeds": seeds,
+            "infotexts": [f"{prompt}\nSeed: {s}" for s in seeds],
+            "batch_size": int(payload.get("batch_size", 1)), "index_of_first_image": 0,
+        }
+        return {"images": [image] * count, "parameters": payload, "info": json.dumps(info)}
+
+def serve(port=3000, latency=1.0, size=512, noise=0.0):
+    """Runs the stub server until interrupted."""
+    StubA1111Handler.config = argparse.Namespace(latency=latency, size=size, noise=noise)
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubA1111Handler)
+    server.daemon_threads = True
+    print(f"Stub A1111 listening on http://127.0.0.1:{port}/sdapi/v1 (latency={latency}s, size={size})")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per generated image")
+    parser.add_argument("--size", type=int, default=512, help="default image width/height")
+    parser.add_argument("--noise", type=float, default=0.0, help="fraction of random pixels per row (0-1)")
+    args = parser.parse_args()
+    serve(args.port, args.latency, args.size, args.noise)
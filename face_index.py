@@ -0,0 +1,201 @@
+"""
+Nearest-neighbour index of face embeddings, used to deduplicate saved faces.
+
+Embeddings are L2-normalised and stored as rows of float32 matrices, so cosine
+similarity is a single matrix-vector product. Rows live in memory-mapped files
+of at most `shard_size` rows each (shard-00000.f32, shard-00001.f32, ...); the
+key of each row is appended to a matching .keys file once the row is written,
+so a killed worker never leaves a key without its embedding. One process at a time
+owns a directory: opening it while another holds it raises BlockingIOError. Only
+numpy is required.
+
+A face that did not match is only reserved in memory until commit() stores it,
+e.g. once its crop is uploaded; a later match on a reserved face waits for that.
+
+    index = FaceIndex("/tmp/face-index")
+    key, similarity = index.match_or_add("faces/f-1.png", embedding, threshold=0.6)
+    if key is None:
+        upload(...)
+        index.commit("faces/f-1.png")   # or index.remove("faces/f-1.png") if it failed
+"""
+import fcntl
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class FaceIndex:
+    """Shards of memory-mapped embeddings searched by brute-force dot product."""
+
+    def __init__(self, directory, dim=EMBEDDING_DIM, shard_size=100_000, search_threads=1):
+        self.directory = directory
+        self.dim = dim
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        self.resolved = threading.Condition(self.lock)
+        self.shards = []      # [{"matrix": memmap, "keys": [...], "keys_file": file}]
+        self.locations = {}   # key -> (shard number, row)
+        self.pending = {}     # key -> vector, reserved by match_or_add until commit()
+        # Shards are searched in parallel when there are several (numpy releases the GIL)
+        self.executor = ThreadPoolExecutor(max_workers=search_threads) if search_threads > 1 else None
+        os.makedirs(directory, exist_ok=True)
+        # The shards have a single writer, e.g. when several workers share a network volume
+        self.lock_file = open(os.path.join(directory, "lock"), "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise
+        self.load()
+
+    def shard_path(self, number, extension):
+        return os.path.join(self.directory, f"shard-{number:05d}{extension}")
+
+    def load(self):
+        """Opens the shards already on disk."""
+        number = 0
+        while os.path.exists(self.shard_path(number, ".f32")):
+            rows = os.path.getsize(self.shard_path(number, ".f32")) // (self.dim * 4)
+            keys = []
+            if os.path.exists(self.shard_path(number, ".keys")):
+                with open(self.shard_path(number, ".keys")) as f:
+                    keys = f.read().splitlines()[:rows]
+            self.open_shard(number, rows, keys)
+            number += 1
+        if self.shards:
+            print(f"Face index loaded: {len(self)} faces in {len(self.shards)} shard(s)")
+
+    def open_shard(self, number, rows, keys):
+        path = self.shard_path(number, ".f32")
+        mode = "r+" if os.path.exists(path) else "w+"
+        matrix = np.memmap(path, dtype=np.float32, mode=mode, shape=(rows, self.dim))
+        shard = {"matrix": matrix, "keys": keys, "keys_file": open(self.shard_path(number, ".keys"), "a")}
+        for row, key in enumerate(keys):
+            self.locations[key] = (number, row)
+        self.shards.append(shard)
+        return shard
+
+    def __len__(self):
+        return len(self.locations)
+
+    def writable_shard(self):
+        if not self.shards or len(self.shards[-1]["keys"]) >= self.shards[-1]["matrix"].shape[0]:
+            return self.open_shard(len(self.shards), self.shard_size, [])
+        return self.shards[-1]
+
+    def search_shard(self, shard, query):
+        count = len(shard["keys"])
+        if count == 0:
+            return -1.0, None
+        similarities = shard["matrix"][:count] @ query
+        row = int(np.argmax(similarities))
+        return float(similarities[row]), shard["keys"][row]
+
+    def best_match(self, query, shards):
+        if self.executor is not None and len(shards) > 1:
+            results = list(self.executor.map(lambda shard: self.search_shard(shard, query), shards))
+        else:
+            results = [self.search_shard(shard, query) for shard in shards]
+        similarity, key = max(results, key=lambda result: result[0], default=(-1.0, None))
+        return key, similarity
+
+    def search(self, embedding):
+        """Most similar stored face. Returns (key, cosine similarity); key is None if empty."""
+        with self.lock:
+            shards = list(self.shards)
+        return self.best_match(normalize(embedding), shards)
+
+    def add(self, key, embedding):
+        with self.lock:
+            self.add_locked(key, normalize(embedding))
+
+    def add_locked(self, key, vector):
+        shard = self.writable_shard()
+        row = len(shard["keys"])
+        shard["matrix"][row] = vector
+        shard["keys_file"].write(f"{key}\n")
+        shard["keys_file"].flush()
+        shard["keys"].append(key)
+        self.locations[key] = (len(self.shards) - 1, row)
+
+    def add_many(self, keys, embeddings):
+        """Bulk insert of pre-normalised rows (index seeding, benchmarks)."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self.lock:
+            start = 0
+            while start < len(keys):
+                shard = self.writable_shard()
+                row = len(shard["keys"])
+                count = min(shard["matrix"].shape[0] - row, len(keys) - start)
+                shard["matrix"][row:row + count] = embeddings[start:start + count]
+                shard["keys_file"].write("".join(f"{key}\n" for key in keys[start:start + count]))
+                shard["keys_file"].flush()
+                number = len(self.shards) - 1
+                for offset, key in enumerate(keys[start:start + count]):
+                    self.locations[key] = (number, row + offset)
+                shard["keys"].extend(keys[start:start + count])
+                start += count
+
+    def best_pending(self, query):
+        similarity, key = max(((float(vector @ query), key) for key, vector in self.pending.items()),
+                              key=lambda result: result[0], default=(-1.0, None))
+        return key, similarity
+
+    def match_or_add(self, key, embedding, threshold):
+        """Returns (existing key, similarity) for a face at or above threshold, or
+        (None, best similarity) after reserving it under `key`; commit() or remove()
+        the reservation afterwards. Atomic, so concurrent crops of the same identity
+        are stored once: a match on a reserved face waits until it is resolved."""
+        vector = normalize(embedding)
+        with self.lock:
+            while True:
+                existing, similarity = self.best_match(vector, self.shards)
+                pending, pending_similarity = self.best_pending(vector)
+                if pending is not None and pending_similarity >= threshold and pending_similarity > similarity:
+                    self.resolved.wait()
+                    continue
+                if existing is not None and similarity >= threshold:
+                    return existing, similarity
+                self.pending[key] = vector
+                return None, max(similarity, pending_similarity)
+
+    def commit(self, key):
+        """Stores a face reserved by match_or_add, so later faces can match it."""
+        with self.lock:
+            vector = self.pending.pop(key, None)
+            if vector is not None:
+                self.add_locked(key, vector)
+                self.resolved.notify_all()
+
+    def remove(self, key):
+        """Forgets a key. A reservation is dropped; a stored row is zeroed, so it can never match again."""
+        with self.lock:
+            if self.pending.pop(key, None) is not None:
+                self.resolved.notify_all()
+            location = self.locations.pop(key, None)
+            if location is not None:
+                number, row = location
+                self.shards[number]["matrix"][row] = 0.0
+
+    def flush(self):
+        with self.lock:
+            for shard in self.shards:
+                shard["matrix"].flush()
+
+    def close(self):
+        """Flushes the shards and releases the directory."""
+        self.flush()
+        with self.lock:
+            for shard in self.shards:
+                shard["keys_file"].close()
+            self.lock_file.close()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -1,18 +1,23 @@
 import time
-import runpod
+MODULE_START = time.perf_counter()
+import asyncio
+import json
+import hashlib
+import importlib
+import math
+import contextvars
+from collections import OrderedDict
 import requests
 import subprocess
 import os
 import signal
 import sys
 import threading
-from requests.adapters import HTTPAdapter, Retry
-import cv2
-import insightface
-import numpy as np
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 import base64 
+import metrics
+from a1111_client import A1111Client, GenerationResponseParser, img2img_request, extra_batch_images_request, reactor_image_request
 
 # --- CONFIGURATION ---
 LOCAL_URL = "http://127.0.0.1:3000/sdapi/v1"
@@ -26,117 +31,627 @@ A1111_COMMAND = [
     "--api-log", "--cors-allow-origins=*"
 ]
 
+# --- STARTUP PROFILE ---
+# cv2, numpy, insightface, boto3 and runpod take seconds to import. They are
+# imported on first use or by the warm-up thread, which runs while A1111 boots,
+# so nothing heavy sits in front of the A1111 launch. Every phase is recorded in
+# startup_timings and printed by print_startup_profile.
+startup_timings = {}
+
+def timed_import(name):
+    """Imports a module, recording how long the first import took."""
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    startup_timings.setdefault(f"import_{name.split('.')[0]}_ms", elapsed_ms(start))
+    return module
+
+def print_startup_profile(title):
+    """Prints startup_timings, slowest phase first, and exports them as gauges."""
+    print(f"=== Startup profile: {title} ===")
+    for phase, value in sorted(startup_timings.items(), key=lambda item: -item[1]):
+        print(f"  {phase[:-len('_ms')]:<32}{value:>10.1f} ms")
+        metrics.set_gauge("worker_cold_start_ms", value, {"phase": phase[:-len("_ms")]},
+                          "Duration of the last start-up of each phase (ms)")
+
 # --- S3 Client (for saving cropped faces) ---
-s3_client = boto3.client('s3')
+# S3_ENDPOINT_URL points the client at an S3-compatible stand-in (MinIO, moto server)
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+FACE_UPLOAD_WORKERS = int(os.environ.get('FACE_UPLOAD_WORKERS', '8'))
+# Created on first use; tests may assign a stand-in directly
+s3_client = None
+s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """Returns the shared boto3 S3 client, creating it on first use."""
+    global s3_client
+    if s3_client is None:
+        with s3_client_lock:
+            if s3_client is None:
+                boto3 = timed_import("boto3")
+                from botocore.config import Config as BotoConfig
+                start = time.perf_counter()
+                s3_client = boto3.client(
+                    's3',
+                    endpoint_url=S3_ENDPOINT_URL,
+                    config=BotoConfig(max_pool_connections=max(10, FACE_UPLOAD_WORKERS * 2))
+                )
+                startup_timings["s3_client_ms"] = elapsed_ms(start)
+    return s3_client
+
+# Shared by all jobs so concurrent jobs cannot oversubscribe encode/upload threads
+face_upload_executor = ThreadPoolExecutor(max_workers=FACE_UPLOAD_WORKERS, thread_name_prefix="face-upload")
+
+# Images of a batch are decoded and run through the detector in parallel
+FACE_DETECT_WORKERS = int(os.environ.get('FACE_DETECT_WORKERS', '2'))
+face_detect_executor = ThreadPoolExecutor(max_workers=FACE_DETECT_WORKERS, thread_name_prefix="face-detect")
+
+# --- Face crop encoding ---
+FACE_CROP_FORMAT = os.environ.get('FACE_CROP_FORMAT', 'png').lower()
+FACE_CROP_QUALITY = int(os.environ.get('FACE_CROP_QUALITY', '90'))
+IMAGE_FORMATS = {
+    # format: (file extension, content type, name of the OpenCV quality flag)
+    "png": (".png", "image/png", None),
+    "webp": (".webp", "image/webp", "IMWRITE_WEBP_QUALITY"),
+    "jpeg": (".jpg", "image/jpeg", "IMWRITE_JPEG_QUALITY"),
+}
+
+def elapsed_ms(start):
+    """Milliseconds since a time.perf_counter() reading."""
+    return round((time.perf_counter() - start) * 1000, 2)
+
+def encode_image(bgr_img, image_format=FACE_CROP_FORMAT, quality=FACE_CROP_QUALITY):
+    """Encodes a BGR array. Returns (bytes, file extension, content type)."""
+    import cv2
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    extension, content_type, quality_flag = IMAGE_FORMATS[image_format]
+    params = [getattr(cv2, quality_flag), quality] if quality_flag is not None else []
+    ok, buffer = cv2.imencode(extension, bgr_img, params)
+    if not ok:
+        raise ValueError(f"Could not encode image as {image_format}")
+    return buffer.tobytes(), extension, content_type
+
+def upload_to_s3(key, body, content_type):
+    """Default face uploader: writes the object to S3_BUCKET_NAME."""
+    get_s3_client().put_object(
+        Bucket=S3_BUCKET_NAME, 
+        Key=key, 
+        Body=body, 
+        ContentType=content_type
+    )
+
+# Replace with any callable(key, body, content_type) to store crops elsewhere
+face_uploader = upload_to_s3
+
+# --- Output images ---
+# With output_mode "s3" the worker uploads the generated images itself and returns
+# their keys instead of base64, so multi-MB images are not copied through RunPod
+# and decoded again by the client.
+OUTPUT_MODE = os.environ.get('OUTPUT_MODE', 'base64').lower()
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'png').lower()
+OUTPUT_QUALITY = int(os.environ.get('OUTPUT_QUALITY', '95'))
+S3_IMAGES_BUCKET_NAME = os.environ.get('S3_IMAGES_BUCKET_NAME', S3_BUCKET_NAME)
+# Set for jobs whose images only go to image_uploader: A1111 responses are then
+# base64-decoded while they stream in, and `images` holds PNG bytes
+current_job_decode_images = contextvars.ContextVar("current_job_decode_images", default=False)
+
+def upload_image_to_s3(key, body, content_type):
+    """Default image uploader: writes the object to S3_IMAGES_BUCKET_NAME."""
+    get_s3_client().put_object(
+        Bucket=S3_IMAGES_BUCKET_NAME,
+        Key=key,
+        Body=body,
+        ContentType=content_type
+    )
+
+# Replace with any callable(key, body, content_type) to store images elsewhere
+image_uploader = upload_image_to_s3
 
 # --- Face Analysis Setup ---
-try:
-    face_analyzer = insightface.app.FaceAnalysis(name='buffalo_l', providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-    face_analyzer.prepare(ctx_id=0, det_size=(640, 640))
-    print("Face analyzer initialized successfully")
-except Exception as e:
-    print(f"Warning: Face analyzer initialization failed: {e}")
-    face_analyzer = None
-
-def detect_and_save_faces(image_bytes):
+# FACE_ANALYSIS_PROFILE picks which buffalo_l models are loaded. Face cataloguing
+# only needs bounding boxes, so the default loads the detector alone.
+FACE_ANALYSIS_PROFILES = {
+    "detection": ['detection'],
+    "recognition": ['detection', 'recognition'],
+    "full": None,
+}
+FACE_ANALYSIS_PROFILE = os.environ.get('FACE_ANALYSIS_PROFILE', 'detection').lower()
+FACE_DET_SIZE = int(os.environ.get('FACE_DET_SIZE', '640'))
+FACE_DET_MIN_SIZE = 320
+FACE_DET_MAX_SIZE = int(os.environ.get('FACE_DET_MAX_SIZE', '1024'))
+# ONNX Runtime tuning for the face models. Optimised graphs are saved in
+# ONNX_CACHE_DIR on first use and loaded from there on later starts (empty = off).
+# The default is on the network volume when one is attached, since the container
+# disk starts empty on every cold start.
+# Thread counts of 0 keep the ONNX Runtime defaults; OMP_NUM_THREADS does not apply.
+FACE_MODELS_DIR = os.environ.get('FACE_MODELS_DIR', '/root/.insightface/models/buffalo_l')
+RUNPOD_VOLUME_DIR = '/runpod-volume'
+ONNX_CACHE_DIR = os.environ.get(
+    'ONNX_CACHE_DIR',
+    f"{RUNPOD_VOLUME_DIR}/.cache/onnx-optimized" if os.path.isdir(RUNPOD_VOLUME_DIR) else '/root/.cache/onnx-optimized'
+)
+ONNX_PROVIDERS = [p for p in os.environ.get('ONNX_PROVIDERS', 'CUDAExecutionProvider,CPUExecutionProvider').split(',') if p]
+ONNX_INTRA_OP_THREADS = int(os.environ.get('ONNX_INTRA_OP_THREADS', '0'))
+ONNX_INTER_OP_THREADS = int(os.environ.get('ONNX_INTER_OP_THREADS', '0'))
+ONNX_OPTIMIZATION = os.environ.get('ONNX_OPTIMIZATION', 'all').lower()
+
+# Built once, by the warm-up thread or the first job that needs it
+face_analyzer = None
+face_analyzer_lock = threading.Lock()
+face_analyzer_loaded = False
+
+def get_face_analyzer():
+    """Returns the shared FaceAnalysis, or None if it could not be initialized."""
+    global face_analyzer, face_analyzer_loaded
+    if face_analyzer_loaded:
+        return face_analyzer
+    with face_analyzer_lock:
+        if face_analyzer_loaded:
+            return face_analyzer
+        try:
+            timed_import("numpy")
+            timed_import("cv2")
+            timed_import("insightface")
+            onnx_sessions = timed_import("onnx_sessions")
+            start = time.perf_counter()
+            factory = onnx_sessions.OnnxSessionFactory(
+                ONNX_CACHE_DIR or None, providers=ONNX_PROVIDERS, intra_op_threads=ONNX_INTRA_OP_THREADS,
+                inter_op_threads=ONNX_INTER_OP_THREADS, optimization=ONNX_OPTIMIZATION
+            )
+            analyzer = onnx_sessions.FaceModels(
+                FACE_MODELS_DIR, factory,
+                allowed_modules=FACE_ANALYSIS_PROFILES.get(FACE_ANALYSIS_PROFILE, ['detection'])
+            )
+            analyzer.prepare(ctx_id=0, det_size=(FACE_DET_SIZE, FACE_DET_SIZE))
+            startup_timings["face_analyzer_ms"] = elapsed_ms(start)
+            face_analyzer = analyzer
+            print(f"Face analyzer initialized successfully (profile={FACE_ANALYSIS_PROFILE}, "
+                  f"models={sorted(face_analyzer.models)}, providers={factory.providers}, "
+                  f"{startup_timings['face_analyzer_ms']} ms, sessions={json.dumps(factory.timings)})")
+        except Exception as e:
+            print(f"Warning: Face analyzer initialization failed: {e}")
+        face_analyzer_loaded = True
+    return face_analyzer
+
+def resolve_det_size(det_size, image_shape):
+    """Turns a per-request det size (int, [w, h] or 'auto') into a (w, h) tuple."""
+    if det_size is None:
+        return (FACE_DET_SIZE, FACE_DET_SIZE)
+    if det_size == "auto":
+        # Detector input roughly matching the image, in multiples of 32
+        height, width = image_shape[:2]
+        clamp = lambda v: int(min(max(round(v / 32) * 32, FACE_DET_MIN_SIZE), FACE_DET_MAX_SIZE))
+        return (clamp(width), clamp(height))
+    if isinstance(det_size, (list, tuple)):
+        return (int(det_size[0]), int(det_size[1]))
+    return (int(det_size), int(det_size))
+
+def analyze_faces(rgb_img, det_size):
+    """FaceAnalysis.get with a per-call detector input size.
+
+    The size is passed to the detector instead of being set on the shared
+    analyzer, so concurrent jobs can use different sizes.
+    """
+    from insightface.app.common import Face
+    analyzer = get_face_analyzer()
+    bboxes, kpss = analyzer.det_model.detect(rgb_img, input_size=det_size, max_num=0, metric='default')
+    faces = []
+    for i in range(bboxes.shape[0]):
+        face = Face(
+            bbox=bboxes[i, 0:4],
+            kps=kpss[i] if kpss is not None else None,
+            det_score=bboxes[i, 4]
+        )
+        for taskname, model in analyzer.models.items():
+            if taskname != 'detection':
+                model.get(rgb_img, face)
+        faces.append(face)
+    return faces
+
+# --- Face deduplication ---
+# With FACE_DEDUP_THRESHOLD set, a detected face whose embedding is at least that
+# similar (cosine) to a face this worker saved before reuses the saved face_id
+# instead of uploading a new crop. Needs the recognition model for embeddings.
+FACE_DEDUP_THRESHOLD = float(os.environ.get('FACE_DEDUP_THRESHOLD', '0'))
+# On the network volume the index outlives cold starts; a worker that cannot use it
+# (another worker holds it, read-only volume) falls back to FACE_INDEX_FALLBACK_DIR.
+FACE_INDEX_FALLBACK_DIR = '/tmp/face-index'
+FACE_INDEX_DIR = os.environ.get(
+    'FACE_INDEX_DIR',
+    f"{RUNPOD_VOLUME_DIR}/face-index" if os.path.isdir(RUNPOD_VOLUME_DIR) else FACE_INDEX_FALLBACK_DIR
+)
+FACE_INDEX_SHARD_SIZE = int(os.environ.get('FACE_INDEX_SHARD_SIZE', '100000'))
+FACE_INDEX_SEARCH_THREADS = int(os.environ.get('FACE_INDEX_SEARCH_THREADS', '1'))
+
+face_dedup_index = None
+face_dedup_index_lock = threading.Lock()
+face_dedup_index_loaded = False
+
+def open_face_index(directory):
+    """Opens the FaceIndex in directory, or returns None when it cannot be used."""
+    from face_index import FaceIndex
+    try:
+        return FaceIndex(directory, shard_size=FACE_INDEX_SHARD_SIZE, search_threads=FACE_INDEX_SEARCH_THREADS)
+    except OSError as e:
+        print(f"Warning: face index at {directory} unavailable: {e}")
+        return None
+
+def get_face_dedup_index():
+    """Returns the shared FaceIndex, or None when deduplication is off."""
+    global face_dedup_index, face_dedup_index_loaded
+    if face_dedup_index_loaded:
+        return face_dedup_index
+    with face_dedup_index_lock:
+        if not face_dedup_index_loaded and FACE_DEDUP_THRESHOLD > 0:
+            analyzer = get_face_analyzer()
+            if analyzer and 'recognition' in analyzer.models:
+                start = time.perf_counter()
+                face_dedup_index = open_face_index(FACE_INDEX_DIR)
+                if face_dedup_index is None and FACE_INDEX_DIR != FACE_INDEX_FALLBACK_DIR:
+                    face_dedup_index = open_face_index(FACE_INDEX_FALLBACK_DIR)
+                if face_dedup_index is None:
+                    print("Warning: no face index could be opened, deduplication is off")
+                startup_timings["face_index_ms"] = elapsed_ms(start)
+            else:
+                print("Warning: FACE_DEDUP_THRESHOLD needs FACE_ANALYSIS_PROFILE=recognition or full, deduplication is off")
+        face_dedup_index_loaded = True
+    return face_dedup_index
+
+def find_duplicate_face(face, s3_key):
+    """Returns (existing s3 key, similarity) for a known face, or (None, None) after reserving
+    this one under s3_key in the index; the caller commits or removes the reservation."""
+    if face.get('embedding') is None or get_face_dedup_index() is None:
+        return None, None
+    return face_dedup_index.match_or_add(s3_key, face.embedding, FACE_DEDUP_THRESHOLD)
+
+def save_face_crop(bgr_img, i, face):
+    """Crops, encodes and uploads one face. Returns (face entry, encode ms, upload ms)."""
+    bbox = face.bbox.astype(int)
+    # Add some padding to the bounding box
+    padding = 20
+    y1 = max(0, bbox[1] - padding)
+    y2 = min(bgr_img.shape[0], bbox[3] + padding)
+    x1 = max(0, bbox[0] - padding)
+    x2 = min(bgr_img.shape[1], bbox[2] + padding)
+    
+    cropped_img = bgr_img[y1:y2, x1:x2]
+    
+    # Generate unique face ID
+    face_id = f"f-{uuid.uuid4()}"
+    extension = IMAGE_FORMATS.get(FACE_CROP_FORMAT, IMAGE_FORMATS["png"])[0]
+    s3_key = f"faces/{face_id}{extension}"
+
+    existing_key, similarity = find_duplicate_face(face, s3_key)
+    if existing_key is not None:
+        face_entry = {
+            "face_id": os.path.splitext(os.path.basename(existing_key))[0],
+            "face_index": i,
+            "bbox": bbox.tolist(),
+            "s3_key": existing_key,
+            "duplicate": True,
+            "similarity": round(similarity, 4),
+        }
+        return face_entry, 0.0, 0.0
+
+    try:
+        # Encode image
+        start = time.perf_counter()
+        face_bytes, extension, content_type = encode_image(cropped_img)
+        encode_ms = elapsed_ms(start)
+
+        # Upload to S3
+        start = time.perf_counter()
+        face_uploader(s3_key, face_bytes, content_type)
+        upload_ms = elapsed_ms(start)
+    except Exception:
+        if face_dedup_index is not None:
+            # Never point later duplicates at a crop that was not stored
+            face_dedup_index.remove(s3_key)
+        raise
+    if face_dedup_index is not None:
+        face_dedup_index.commit(s3_key)
+
+    cache_source_face(face_id, face_bytes, face)
+
+    face_entry = {
+        "face_id": face_id, 
+        "face_index": i,
+        "bbox": bbox.tolist(),
+        "s3_key": s3_key
+    }
+    return face_entry, encode_ms, upload_ms
+
+def decode_image(image_bytes, timings=None):
+    """Decodes encoded image bytes to a BGR array (None if they cannot be decoded)."""
+    import cv2
+    import numpy as np
+    start = time.perf_counter()
+    bgr_img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if timings is not None:
+        timings["decode_ms"] = elapsed_ms(start)
+    return bgr_img
+
+def detect_and_save_faces(image_bytes, timings=None, det_size=None):
     """Detects faces in an image, crops them, and uploads them to S3."""
-    if not face_analyzer:
+    bgr_img = decode_image(image_bytes, timings)
+    if bgr_img is None:
+        print("Error: could not decode image.")
+        return []
+    return detect_and_save_faces_from_array(bgr_img, timings, det_size)
+
+def detect_and_save_faces_from_array(bgr_img, timings=None, det_size=None):
+    """Detects faces in an already decoded BGR image, crops them, and uploads them to S3.
+
+    Crops are encoded and uploaded in parallel on face_upload_executor. If a
+    timings dict is given it is filled with detect/encode/upload ms.
+    det_size overrides FACE_DET_SIZE (see resolve_det_size).
+    """
+    import cv2
+    timings = {} if timings is None else timings
+    if not get_face_analyzer():
         print("Face analyzer not available, skipping face detection")
         return []
         
     try:
-        # Decode image
-        bgr_img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
-        if bgr_img is None:
-            print("Error: could not decode image.")
-            return []
-
         # Convert BGR to RGB for face analysis
         rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
 
         # Detect faces
-        faces = face_analyzer.get(rgb_img)
+        start = time.perf_counter()
+        faces = analyze_faces(rgb_img, resolve_det_size(det_size, rgb_img.shape))
+        timings["detect_ms"] = elapsed_ms(start)
         if not faces:
             print("No faces detected in image")
             return []
 
+        # Encode and upload all crops concurrently
+        start = time.perf_counter()
+        futures = [face_upload_executor.submit(save_face_crop, bgr_img, i, face) for i, face in enumerate(faces)]
         detected_faces = []
-        for i, face in enumerate(faces):
+        encode_ms = upload_ms = 0.0
+        for i, future in enumerate(futures):
             try:
-                bbox = face.bbox.astype(int)
-                # Add some padding to the bounding box
-                padding = 20
-                y1 = max(0, bbox[1] - padding)
-                y2 = min(bgr_img.shape[0], bbox[3] + padding)
-                x1 = max(0, bbox[0] - padding)
-                x2 = min(bgr_img.shape[1], bbox[2] + padding)
-                
-                cropped_img = bgr_img[y1:y2, x1:x2]
-                
-                # Encode image
-                _, buffer = cv2.imencode('.png', cropped_img)
-                face_bytes = buffer.tobytes()
-
-                # Generate unique face ID
-                face_id = f"f-{uuid.uuid4()}"
-                s3_key = f"faces/{face_id}.png"
-
-                # Upload to S3
-                s3_client.put_object(
-                    Bucket=S3_BUCKET_NAME, 
-                    Key=s3_key, 
-                    Body=face_bytes, 
-                    ContentType='image/png'
-                )
-
-                detected_faces.append({
-                    "face_id": face_id, 
-                    "face_index": i,
-                    "bbox": bbox.tolist()
-                })
-                print(f"Saved face {i} as {face_id}")
-                
+                face_entry, face_encode_ms, face_upload_ms = future.result()
             except Exception as e:
                 print(f"Error processing face {i}: {e}")
                 continue
+            encode_ms += face_encode_ms
+            upload_ms += face_upload_ms
+            detected_faces.append(face_entry)
+            print(f"Saved face {i} as {face_entry['face_id']}")
 
+        # encode/upload are summed over faces; save_wall_ms is the elapsed time for all of them
+        timings["encode_ms"] = round(encode_ms, 2)
+        timings["upload_ms"] = round(upload_ms, 2)
+        timings["save_wall_ms"] = elapsed_ms(start)
         return detected_faces
     except Exception as e:
         print(f"Error in face detection: {e}")
         return []
 
+# --- SOURCE FACES (ReActor) ---
+# Jobs can name a saved face with source_face_id instead of shipping it as base64.
+# Saved crops are kept in an LRU cache together with their insightface embedding.
+# When an embedding is available it is written once as a ReActor face model, so
+# ReActor swaps from it without decoding, detecting and embedding the source again.
+# Embeddings need the recognition model (FACE_ANALYSIS_PROFILE=recognition or full).
+SOURCE_FACE_CACHE_SIZE = int(os.environ.get('SOURCE_FACE_CACHE_SIZE', '256'))
+S3_FACES_BUCKET_NAME = os.environ.get('S3_FACES_BUCKET_NAME', S3_BUCKET_NAME)
+REACTOR_FACE_MODELS_DIR = os.environ.get('REACTOR_FACE_MODELS_DIR', '/stable-diffusion-webui/models/reactor/faces')
+
+source_face_lock = threading.Lock()
+source_face_cache = OrderedDict()  # face_id -> {"bytes": crop bytes, "face": Face or None}
+
+class SourceFaceNotFound(ValueError):
+    """No saved face crop exists for a source_face_id; returned with error_code "face_not_found"."""
+
+def cache_source_face(face_id, face_bytes, face=None):
+    """Adds a saved face crop (and the Face it was cut from, if it has an embedding)."""
+    if SOURCE_FACE_CACHE_SIZE <= 0:
+        return
+    if face is not None and face.get('embedding') is None:
+        face = None
+    with source_face_lock:
+        source_face_cache[face_id] = {"bytes": face_bytes, "face": face}
+        source_face_cache.move_to_end(face_id)
+        while len(source_face_cache) > SOURCE_FACE_CACHE_SIZE:
+            source_face_cache.popitem(last=False)
+
+def fetch_source_face_bytes(face_id):
+    """Downloads a saved face crop, trying the configured crop format before PNG."""
+    extensions = [IMAGE_FORMATS.get(FACE_CROP_FORMAT, IMAGE_FORMATS["png"])[0], ".png"]
+    s3 = get_s3_client()
+    for extension in dict.fromkeys(extensions):
+        try:
+            s3_object = s3.get_object(Bucket=S3_FACES_BUCKET_NAME, Key=f"faces/{face_id}{extension}")
+            return s3_object['Body'].read()
+        except s3.exceptions.NoSuchKey:
+            continue
+    raise SourceFaceNotFound(f"Face with ID '{face_id}' not found.")
+
+def embed_source_face(face_bytes):
+    """Runs detection + recognition on a face crop. Returns its largest Face, or None."""
+    import cv2
+    analyzer = get_face_analyzer()
+    if not analyzer or 'recognition' not in analyzer.models:
+        return None
+    bgr_img = decode_image(face_bytes)
+    if bgr_img is None:
+        return None
+    rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+    faces = analyze_faces(rgb_img, resolve_det_size("auto", rgb_img.shape))
+    if not faces:
+        return None
+    return max(faces, key=lambda f: (f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]))
+
+def resolve_source_face(face_id):
+    """Returns the cached entry for a face id, downloading and embedding it on a miss."""
+    with source_face_lock:
+        entry = source_face_cache.get(face_id)
+        if entry is not None:
+            source_face_cache.move_to_end(face_id)
+    if entry is None:
+        print(f"Source face {face_id} not cached, downloading...")
+        face_bytes = fetch_source_face_bytes(face_id)
+        cache_source_face(face_id, face_bytes, embed_source_face(face_bytes))
+        entry = source_face_cache.get(face_id) or {"bytes": face_bytes, "face": None}
+    return entry
+
+def reactor_face_model(face_id, face):
+    """Writes the Face as a ReActor face model (once). Returns its file name, or None."""
+    filename = f"{face_id}.safetensors"
+    path = os.path.join(REACTOR_FACE_MODELS_DIR, filename)
+    if os.path.exists(path):
+        return filename
+    try:
+        import numpy as np
+        from safetensors.numpy import save_file
+        tensors = {
+            key: np.ascontiguousarray(np.asarray(face[key], dtype=np.float32))
+            for key in ("bbox", "kps", "det_score", "embedding", "gender", "age")
+            if face.get(key) is not None
+        }
+        os.makedirs(REACTOR_FACE_MODELS_DIR, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        save_file(tensors, tmp_path)
+        os.replace(tmp_path, path)
+        return filename
+    except Exception as e:
+        print(f"Could not write ReActor face model for {face_id}: {e}")
+        return None
+
+def pop_reactor_options(inference_request):
+    """Pops the ReActor options from a job. Defaults match the client Lambda."""
+    return {
+        key: inference_request.pop(key, default) for key, default in (
+            ("reactor_model", "inswapper_128.onnx"),
+            ("restore_face_model", "CodeFormer"),
+            ("gfpgan_visibility", 1),
+            ("codeformer_weight", 0.5),
+            ("upscaler", "4x-UltraSharp"),
+            ("upscaler_scale", 1.5),
+            ("upscaler_visibility", 0.8),
+            ("face_detection_threshold", 0.6),
+            ("max_faces", 1),
+            ("source_face_index", "0"),
+            ("target_face_index", "0"),
+        )
+    }
+
+def reactor_source(face_id):
+    """Returns (source image base64, select_source, face model name) for a saved face."""
+    entry = resolve_source_face(face_id)
+    face_model = reactor_face_model(face_id, entry["face"]) if entry["face"] is not None else None
+    if face_model:
+        # select_source=1: swap from the saved face model, no source image needed
+        print(f"Using cached ReActor face model {face_model}")
+        return "", 1, face_model
+    return base64.b64encode(entry["bytes"]).decode('utf-8'), 0, ""
+
+def build_reactor_args(inference_request):
+    """Pops source_face_id and the ReActor options from a job and returns ReActor's args list."""
+    face_id = inference_request.pop("source_face_id")
+    options = pop_reactor_options(inference_request)
+    source_image, select_source, face_model = reactor_source(face_id)
+
+    return [
+        source_image,
+        True,
+        str(options["source_face_index"]),
+        str(options["target_face_index"]),
+        options["reactor_model"],
+        options["restore_face_model"],
+        float(options["gfpgan_visibility"]),
+        True,
+        options["upscaler"],
+        float(options["upscaler_scale"]),
+        float(options["upscaler_visibility"]),
+        False,
+        True,
+        1,
+        0, 0, False, float(options["codeformer_weight"]), False, False, "CUDA", True,
+        select_source, face_model, "", None, False, False,
+        float(options["face_detection_threshold"]),
+        int(options["max_faces"])
+    ]
+
 a1111_process = None
 shutdown_flag = threading.Event()
 
 # --- NETWORK FUNCTIONS ---
-automatic_session = requests.Session()
-retries = Retry(total=10, backoff_factor=0.2, status_forcelist=[502, 503, 504])
-automatic_session.mount('http://', HTTPAdapter(max_retries=retries))
+# All A1111 traffic goes through one pooled client. Generation POSTs are only retried
+# on connect errors and are interrupted on read timeout or job cancellation.
+A1111_CONNECT_TIMEOUT = float(os.environ.get('A1111_CONNECT_TIMEOUT', '5'))
+A1111_READ_TIMEOUT = float(os.environ.get('A1111_READ_TIMEOUT', '600'))
+a1111 = A1111Client(LOCAL_URL, connect_timeout=A1111_CONNECT_TIMEOUT, read_timeout=A1111_READ_TIMEOUT)
+
+READY_POLL_INITIAL = 0.25
+READY_POLL_MAX = 2.0
+# Comma-separated checks that must pass before jobs are accepted: controlnet, reactor, checkpoint
+READY_REQUIREMENTS = [r.strip() for r in os.environ.get('READY_REQUIREMENTS', 'reactor,checkpoint').split(',') if r.strip()]
+EXTENSIONS_MAX_WAIT = float(os.environ.get('EXTENSIONS_MAX_WAIT', '60'))
 
 def wait_for_service(url, max_wait=300):
-    """Waits for the A1111 service to be ready."""
+    """Waits for the A1111 service to be ready, polling with exponential backoff."""
     start_time = time.time()
+    delay = READY_POLL_INITIAL
     while not shutdown_flag.is_set() and (time.time() - start_time) < max_wait:
+        if a1111_process is not None and a1111_process.poll() is not None:
+            print(f"A1111 process exited with code {a1111_process.returncode} during startup")
+            return False
         try:
-            response = requests.get(url, timeout=10)
+            response = a1111.probe_session.get(url, timeout=(a1111.connect_timeout, 5))
             if response.status_code == 200:
                 print("A1111 service is ready.")
                 return True
         except requests.exceptions.RequestException as e:
-            print(f"Waiting for A1111 service... ({e})")
-            time.sleep(5)
+            if delay >= READY_POLL_MAX:
+                print(f"Waiting for A1111 service... ({e})")
         except Exception as e:
             print(f"Unexpected error while waiting for service: {e}")
-            time.sleep(5)
+        shutdown_flag.wait(delay)
+        delay = min(delay * 1.5, READY_POLL_MAX)
     
     print(f"Service failed to start within {max_wait} seconds")
     return False
 
+def check_ready_requirement(requirement):
+    """Whether one READY_REQUIREMENTS entry is satisfied."""
+    if requirement == "controlnet":
+        return a1111.probe("controlnet/version") is not None
+    if requirement == "reactor":
+        scripts = a1111.probe("scripts") or {}
+        return "reactor" in [name.lower() for name in scripts.get("txt2img", [])]
+    if requirement == "checkpoint":
+        options = a1111.probe("options") or {}
+        return bool(options.get("sd_model_checkpoint"))
+    print(f"Warning: unknown readiness requirement '{requirement}'")
+    return True
+
+def wait_for_extensions(max_wait=EXTENSIONS_MAX_WAIT):
+    """Waits until every READY_REQUIREMENTS check passes, instead of sleeping a fixed time."""
+    start_time = time.time()
+    pending = list(READY_REQUIREMENTS)
+    delay = READY_POLL_INITIAL
+    while pending and not shutdown_flag.is_set():
+        pending = [r for r in pending if not check_ready_requirement(r)]
+        if not pending:
+            break
+        if time.time() - start_time >= max_wait:
+            print(f"Warning: still not ready after {max_wait:.0f}s: {pending}. Continuing anyway.")
+            return False
+        shutdown_flag.wait(delay)
+        delay = min(delay * 1.5, READY_POLL_MAX)
+    print(f"A1111 extensions ready: {READY_REQUIREMENTS}")
+    return True
+
 def check_controlnet_available():
     """Check if ControlNet extension is available."""
     try:
-        response = automatic_session.get(f'{LOCAL_URL}/controlnet/version', timeout=10)
+        response = a1111.session.get(a1111.url('controlnet/version'), timeout=(a1111.connect_timeout, 10))
         if response.status_code == 200:
             version_info = response.json()
             print(f"ControlNet version: {version_info}")
@@ -151,9 +666,11 @@ def check_controlnet_available():
 def get_controlnet_models():
     """Get available ControlNet models."""
     try:
-        response = automatic_session.get(f'{LOCAL_URL}/controlnet/model_list', timeout=10)
+        response = a1111.session.get(a1111.url('controlnet/model_list'), timeout=(a1111.connect_timeout, 10))
         if response.status_code == 200:
             models = response.json()
+            if isinstance(models, dict):
+                models = models.get("model_list", [])
             print(f"Available ControlNet models: {models}")
             return models
         else:
@@ -163,13 +680,326 @@ def get_controlnet_models():
         print(f"Error getting ControlNet models: {e}")
         return []
 
-def run_inference(inference_request):
-    """Runs inference with the provided payload."""
-    print(f"Starting inference with keys: {list(inference_request.keys())}")
+# --- MODEL REGISTRY ---
+# Extension capabilities and model lists only change when A1111 restarts. They are
+# fetched once at startup, refreshed by the watchdog every REGISTRY_REFRESH_INTERVAL
+# seconds or after a lookup miss, and resolved from in-memory dicts.
+REGISTRY_REFRESH_INTERVAL = float(os.environ.get('REGISTRY_REFRESH_INTERVAL', '300'))
+REGISTRY_MISS_REFRESH_INTERVAL = 30
+
+BASE_CHECKPOINT = "ultimaterealismo.safetensors"
+REFINER_CHECKPOINT = "sd_xl_refiner_1.0.safetensors"
+BASE_LORA = "epiCRealnessRC1"
+DEFAULT_IP_ADAPTER_MODEL = "ip-adapter_sdxl [7d943a46]"
+
+registry_refresh_lock = threading.Lock()
+model_registry = {
+    "controlnet": False,
+    "controlnet_models": {},
+    "checkpoints": {},
+    "loras": {},
+    "upscalers": {},
+    "ip_adapter_model": None,
+    "refreshed_at": 0.0,
+}
+
+def asset_keys(name):
+    """Lookup keys for an asset name: as given, without ' [hash]', without extension."""
+    key = os.path.basename(str(name)).lower()
+    unhashed = key.split(" [")[0]
+    return (key, unhashed, os.path.splitext(unhashed)[0])
+
+def index_assets(entries, value_field, alias_fields=()):
+    """Maps every lower-cased name variant of an asset to the name A1111 expects."""
+    index = {}
+    for entry in entries or []:
+        if isinstance(entry, str):
+            entry = {value_field: entry}
+        value = entry.get(value_field)
+        if not value:
+            continue
+        for field in (value_field,) + tuple(alias_fields):
+            if entry.get(field):
+                for key in asset_keys(entry[field]):
+                    index.setdefault(key, value)
+    return index
+
+def refresh_model_registry():
+    """Reloads ControlNet, checkpoint, LoRA and upscaler lists from A1111.
+
+    Lists that cannot be fetched keep their previous contents.
+    """
+    registry = {"controlnet": check_controlnet_available(), "refreshed_at": time.time()}
+    if registry["controlnet"]:
+        controlnet_models = get_controlnet_models()
+        registry["controlnet_models"] = index_assets(controlnet_models, "name")
+        registry["ip_adapter_model"] = next(
+            (model for model in controlnet_models if 'ip-adapter' in model.lower() and 'sdxl' in model.lower()),
+            None
+        )
+    for kind, path, value_field, alias_fields in (
+        ("checkpoints", "sd-models", "title", ("model_name", "filename")),
+        ("loras", "loras", "name", ("alias", "path")),
+        ("upscalers", "upscalers", "name", ()),
+    ):
+        entries = a1111.get_json(path)
+        if entries is not None:
+            registry[kind] = index_assets(entries, value_field, alias_fields)
+    model_registry.update(registry)
+    options = a1111.get_json("options") or {}
+    if options.get("sd_model_checkpoint") and loaded_models["checkpoint"] is None:
+        # Only right after a (re)start; later on, switch_checkpoint keeps it current
+        loaded_models["checkpoint"] = options["sd_model_checkpoint"]
+    print(f"Model registry refreshed: controlnet={model_registry['controlnet']}, "
+          f"ip_adapter={model_registry['ip_adapter_model']}, "
+          f"{len(model_registry['checkpoints'])} checkpoint keys, {len(model_registry['loras'])} LoRA keys, "
+          f"{len(model_registry['upscalers'])} upscaler keys")
+
+def refresh_on_miss():
+    """Refreshes the registry after a lookup miss, at most every REGISTRY_MISS_REFRESH_INTERVAL seconds."""
+    if time.time() - model_registry["refreshed_at"] < REGISTRY_MISS_REFRESH_INTERVAL:
+        return False
+    if not registry_refresh_lock.acquire(blocking=False):
+        return False
+    try:
+        refresh_model_registry()
+        return True
+    finally:
+        registry_refresh_lock.release()
+
+def resolve_asset(kind, name):
+    """Resolves a checkpoint/LoRA/upscaler/ControlNet model name. Returns None when A1111 lacks it."""
+    for attempt in range(2):
+        index = model_registry[kind]
+        for key in asset_keys(name):
+            if key in index:
+                return index[key]
+        if attempt == 0 and not refresh_on_miss():
+            break
+    print(f"Warning: {kind} entry '{name}' not found in A1111")
+    return None
+
+def get_ip_adapter_model():
+    """The SDXL IP-Adapter ControlNet model, or None when ControlNet is unavailable."""
+    if not model_registry["controlnet"] or not model_registry["ip_adapter_model"]:
+        refresh_on_miss()
+    if not model_registry["controlnet"]:
+        return None
+    if not model_registry["ip_adapter_model"]:
+        print("Warning: No IP-Adapter SDXL model found. Available models:", sorted(set(model_registry["controlnet_models"].values())))
+        return DEFAULT_IP_ADAPTER_MODEL
+    return model_registry["ip_adapter_model"]
+
+def update_gpu_memory_metrics():
+    """Publishes CUDA memory usage reported by A1111's /memory endpoint."""
+    memory = a1111.get_json("memory") or {}
+    cuda = (memory.get("cuda") or {}).get("system") or {}
+    for kind in ("used", "free", "total"):
+        if kind in cuda:
+            metrics.set_gauge("worker_gpu_memory_bytes", cuda[kind], {"kind": kind}, "CUDA memory as seen by A1111")
+
+# --- LOADED MODEL STATE ---
+# A generation's checkpoint is made resident through /options before it runs
+# (switch_checkpoint), so it stays loaded after the job while the job's other
+# override_settings are restored. Tracking it lets the async scheduler serve
+# same-model jobs back to back and lets callers route by resident model.
+loaded_models = {"checkpoint": None, "refiner": None}
+
+def payload_model_key(payload):
+    """(checkpoint, refiner) a payload needs; refiner is None when it is not used."""
+    checkpoint = (payload.get("override_settings") or {}).get("sd_model_checkpoint")
+    return (checkpoint, payload.get("refiner_checkpoint"))
+
+def loaded_model_key():
+    return (loaded_models["checkpoint"], loaded_models["refiner"])
+
+def note_loaded_models(payload):
+    """Records the models A1111 has resident after successfully running a payload."""
+    checkpoint, refiner = payload_model_key(payload)
+    if checkpoint:
+        if checkpoint != loaded_models["checkpoint"]:
+            print(f"Resident checkpoint is now {checkpoint}")
+        loaded_models["checkpoint"] = checkpoint
+    loaded_models["refiner"] = refiner
+
+def switch_checkpoint(payload, timings=None):
+    """Makes the payload's checkpoint the resident one. Returns an error message, or None.
+
+    The checkpoint also stays in the payload's override_settings, so a request
+    that A1111 runs after another switch still gets its own model. If a timings
+    dict is given, the time of a switch is recorded as checkpoint_switch_ms.
+    """
+    checkpoint = payload_model_key(payload)[0]
+    if not checkpoint or checkpoint == loaded_models["checkpoint"]:
+        return None
+    print(f"Switching resident checkpoint to {checkpoint}...")
+    start = time.perf_counter()
+    error_msg = a1111.set_options({"sd_model_checkpoint": checkpoint})
+    if error_msg is None:
+        loaded_models["checkpoint"] = checkpoint
+        if timings is not None:
+            timings["checkpoint_switch_ms"] = elapsed_ms(start)
+    return error_msg
+
+def worker_state():
+    """Snapshot of this worker's resident models, attached to job output for upstream routing."""
+    return {
+        "worker_id": os.environ.get('RUNPOD_POD_ID'),
+        "loaded_checkpoint": loaded_models["checkpoint"],
+        "loaded_refiner": loaded_models["refiner"],
+        "result_cache": result_cache_snapshot(),
+    }
+
+# --- WORKER LIFECYCLE ---
+# In warm mode the A1111 subprocess and the face analyzer stay loaded across jobs.
+# The worker is recycled after MAX_JOBS_PER_WORKER jobs (0 = unlimited) or after
+# IDLE_TIMEOUT seconds without a job (0 = never).
+WARM_MODE = os.environ.get('WARM_MODE', 'true').lower() in ('1', 'true', 'yes')
+MAX_JOBS_PER_WORKER = int(os.environ.get('MAX_JOBS_PER_WORKER', '0'))
+IDLE_TIMEOUT = float(os.environ.get('IDLE_TIMEOUT', '0'))
+WATCHDOG_INTERVAL = float(os.environ.get('WATCHDOG_INTERVAL', '10'))
+# Load the face analyzer, S3 client and dedup index in the background while A1111
+# boots; otherwise they are loaded by the first job that needs them
+STARTUP_WARM_UP = os.environ.get('STARTUP_WARM_UP', 'true').lower() in ('1', 'true', 'yes')
+
+a1111_lock = threading.Lock()
+a1111_restarts = 0
+job_state_lock = threading.Lock()
+jobs_completed = 0
+active_jobs = 0
+last_job_time = time.time()
+
+def launch_a1111():
+    """Starts the A1111 subprocess without waiting for it. Returns the launch time."""
+    global a1111_process
+    print("Starting A1111 server...")
+    start = time.perf_counter()
+    # A new process has nothing resident yet; wait_for_a1111 reads its checkpoint from /options
+    loaded_models.update(checkpoint=None, refiner=None)
+    a1111_process = subprocess.Popen(
+        A1111_COMMAND, 
+        preexec_fn=os.setsid,
+        stdout=sys.stdout,
+        stderr=sys.stderr
+    )
+    startup_timings["a1111_launch_ms"] = elapsed_ms(start)
+    return start
+
+def start_a1111():
+    """Launches the A1111 subprocess and waits for it to be ready."""
+    return wait_for_a1111(launch_a1111())
+
+def wait_for_a1111(start):
+    """Waits for a launched A1111 to serve its API, extensions and model registry.
+
+    Phase durations are recorded in startup_timings.
+    """
+    print("Waiting for A1111 service to be ready...")
+    if not wait_for_service(url=a1111.url('progress'), max_wait=300):
+        return False
+    startup_timings["a1111_api_ready_ms"] = elapsed_ms(start)
+    
+    phase = time.perf_counter()
+    wait_for_extensions()
+    startup_timings["a1111_extensions_ready_ms"] = elapsed_ms(phase)
+    
+    phase = time.perf_counter()
+    refresh_model_registry()
+    startup_timings["model_registry_ms"] = elapsed_ms(phase)
+    startup_timings["a1111_startup_ms"] = elapsed_ms(start)
+    print(f"Startup timings: {json.dumps(startup_timings)}")
+    return True
+
+def warm_up():
+    """Imports the heavy modules and builds the face analyzer, S3 client and dedup index.
+
+    Runs on a background thread while A1111 boots. Everything it loads is also
+    loaded on first use, so jobs that do not need a component never wait for it.
+    """
+    start = time.perf_counter()
+    try:
+        for name in ("numpy", "cv2", "boto3", "insightface"):
+            timed_import(name)
+        get_s3_client()
+        get_face_analyzer()
+        get_face_dedup_index()
+    except Exception as e:
+        print(f"Warning: warm-up failed: {e}")
+    startup_timings["warm_up_ms"] = elapsed_ms(start)
+    print(f"Warm-up finished in {startup_timings['warm_up_ms']} ms")
+    if "worker_ready_ms" in startup_timings:
+        # The profile printed at ready time did not include the warm-up yet
+        print_startup_profile("warm-up finished")
+
+def stop_a1111():
+    """Terminates the A1111 process group if it is still running."""
+    if a1111_process and a1111_process.poll() is None:
+        print("Terminating A1111 process...")
+        try:
+            os.killpg(os.getpgid(a1111_process.pid), signal.SIGTERM)
+            a1111_process.wait(timeout=30)
+        except:
+            print("Force killing A1111 process...")
+            os.killpg(os.getpgid(a1111_process.pid), signal.SIGKILL)
+
+def ensure_a1111_running():
+    """Restarts A1111 if the subprocess has died. Returns True when it is up."""
+    global a1111_restarts
+    with a1111_lock:
+        if a1111_process is not None and a1111_process.poll() is None:
+            return True
+        if shutdown_flag.is_set():
+            return False
+        exit_code = a1111_process.poll() if a1111_process else None
+        print(f"A1111 process is not running (exit code {exit_code}), restarting...")
+        a1111_restarts += 1
+        metrics.inc("worker_a1111_restarts_total", description="A1111 subprocess restarts after it died")
+        return start_a1111()
+
+def a1111_watchdog():
+    """Background health check: restarts A1111 only when it dies and enforces the idle timeout."""
+    while not shutdown_flag.wait(WATCHDOG_INTERVAL):
+        with job_state_lock:
+            idle_for = time.time() - last_job_time if active_jobs == 0 else 0
+        if IDLE_TIMEOUT and idle_for > IDLE_TIMEOUT:
+            print(f"Worker idle for {idle_for:.0f}s, shutting down...")
+            shutdown_flag.set()
+            stop_a1111()
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        if ensure_a1111_running() and REGISTRY_REFRESH_INTERVAL and \
+                time.time() - model_registry["refreshed_at"] > REGISTRY_REFRESH_INTERVAL:
+            refresh_model_registry()
+        update_gpu_memory_metrics()
+
+def begin_job():
+    """Marks a job as in flight so the idle timeout does not fire during it. Returns its start time."""
+    global active_jobs
+    with job_state_lock:
+        active_jobs += 1
+        metrics.set_gauge("worker_active_jobs", active_jobs, description="Jobs currently in flight")
+    return time.perf_counter()
+
+def end_job():
+    """Records a finished job. Returns True when the worker should be recycled."""
+    global active_jobs, jobs_completed, last_job_time
+    with job_state_lock:
+        active_jobs -= 1
+        metrics.set_gauge("worker_active_jobs", active_jobs)
+        jobs_completed += 1
+        last_job_time = time.time()
+        if not WARM_MODE:
+            return True
+        return bool(MAX_JOBS_PER_WORKER) and jobs_completed >= MAX_JOBS_PER_WORKER
+
+def build_payload(inference_request):
+    """Turns the job input into the final A1111 txt2img payload (modified in place)."""
+    print(f"Building payload with keys: {list(inference_request.keys())}")
     
     # 1. Apply LoRA to the positive prompt
     lora_level = inference_request.get("lora_level", 0.6)
-    lora_prompt = f"<lora:epiCRealnessRC1:{lora_level}>"
+    lora_name = resolve_asset("loras", BASE_LORA) or BASE_LORA
+    lora_prompt = f"<lora:{lora_name}:{lora_level}>"
     inference_request["prompt"] = f"{inference_request.get('prompt', '')}, {lora_prompt}"
     
     # 2. Apply negative embeddings
@@ -177,43 +1007,39 @@ def run_inference(inference_request):
     inference_request["negative_prompt"] = f"{inference_request.get('negative_prompt', '')}, {negative_embeddings}"
 
     # 3. Set base model and CLIP Skip via override_settings
+    checkpoint = inference_request.pop("checkpoint", None) or BASE_CHECKPOINT
     override_settings = {
-        "sd_model_checkpoint": "ultimaterealismo.safetensors",
+        "sd_model_checkpoint": resolve_asset("checkpoints", checkpoint) or checkpoint,
         "CLIP_stop_at_last_layers": inference_request.get("clip_skip", 1)
     }
     
     # 4. Add SDXL Refiner Logic if requested
     if inference_request.get("use_refiner", False):
         print("Refiner enabled for this request.")
-        inference_request["refiner_checkpoint"] = "sd_xl_refiner_1.0.safetensors"
+        inference_request["refiner_checkpoint"] = resolve_asset("checkpoints", REFINER_CHECKPOINT) or REFINER_CHECKPOINT
         inference_request["refiner_switch_at"] = inference_request.get("refiner_switch_at", 0.8)
 
+    if inference_request.get("hr_upscaler"):
+        inference_request["hr_upscaler"] = resolve_asset("upscalers", inference_request["hr_upscaler"]) or inference_request["hr_upscaler"]
+
     if "override_settings" not in inference_request:
         inference_request["override_settings"] = {}
     inference_request["override_settings"].update(override_settings)
 
-    # 5. Handle IP-Adapter through ControlNet
+    # 5. Resolve a saved source face for ReActor face swap
+    if inference_request.get("source_face_id"):
+        print(f"Source face ID '{inference_request['source_face_id']}' provided. Building ReActor args...")
+        reactor_args = build_reactor_args(inference_request)
+        inference_request.setdefault("alwayson_scripts", {})["reactor"] = {"args": reactor_args}
+
+    # 6. Handle IP-Adapter through ControlNet
     if 'ip_adapter_image_b64' in inference_request:
         print("IP-Adapter image detected. Setting up ControlNet...")
         
-        # Check if ControlNet is available
-        if not check_controlnet_available():
+        ip_adapter_model = get_ip_adapter_model()
+        if not ip_adapter_model:
             print("Warning: ControlNet not available, IP-Adapter will be skipped")
         else:
-            # Get available models
-            available_models = get_controlnet_models()
-            
-            # Find IP-Adapter model
-            ip_adapter_model = None
-            for model in available_models:
-                if 'ip-adapter' in model.lower() and 'sdxl' in model.lower():
-                    ip_adapter_model = model
-                    break
-            
-            if not ip_adapter_model:
-                print("Warning: No IP-Adapter SDXL model found. Available models:", available_models)
-                ip_adapter_model = "ip-adapter_sdxl [7d943a46]"  # Default fallback
-            
             print(f"Using IP-Adapter model: {ip_adapter_model}")
             
             # Set up ControlNet args for IP-Adapter
@@ -248,111 +1074,1454 @@ def run_inference(inference_request):
         if 'ip_adapter_weight' in inference_request:
             del inference_request['ip_adapter_weight']
     
-    # 6. Send request to A1111
-    print("Sending request to A1111...")
+    return inference_request
+
+# Calls that run a checkpoint; the extras and ReActor endpoints use whatever is loaded
+GENERATION_PATHS = ("txt2img", "img2img")
+
+# --- JOB SCHEDULING ---
+# Jobs may carry a `priority` (an integer, higher goes first, clamped to
+# MIN_JOB_PRIORITY..MAX_JOB_PRIORITY, default DEFAULT_JOB_PRIORITY)
+# and a `deadline` (unix time in seconds after which nobody waits for the result).
+# A job whose deadline passes is dropped from the GPU queue, or interrupted with
+# /interrupt while it generates. A generation is rejected before it queues when
+# the work ahead of it plus its own estimated time already ends past the deadline.
+# Estimates come from the measured time per step and megapixel of each model.
+# DEFAULT_JOB_DEADLINE gives jobs without a deadline one that many seconds after
+# they arrive (0 = none).
+DEFAULT_JOB_PRIORITY = int(os.environ.get('DEFAULT_JOB_PRIORITY', '0'))
+MIN_JOB_PRIORITY = int(os.environ.get('MIN_JOB_PRIORITY', '-10'))
+MAX_JOB_PRIORITY = int(os.environ.get('MAX_JOB_PRIORITY', '0'))
+DEFAULT_JOB_DEADLINE = float(os.environ.get('DEFAULT_JOB_DEADLINE', '0'))
+# Weight of the newest measurement in the moving average of generation speed
+GENERATION_SPEED_ALPHA = 0.2
+
+# {"priority", "deadline"} of the job running in the current task or thread
+current_job_schedule = contextvars.ContextVar("current_job_schedule", default=None)
+generation_speed_lock = threading.Lock()
+generation_speed = {}  # model key -> ms per step-megapixel
+
+def pop_schedule_options(input_data):
+    """Removes priority and deadline from the job input. Returns (the job's schedule, error message)."""
+    priority = input_data.pop("priority", None)
+    deadline = input_data.pop("deadline", None)
+    if priority is None:
+        priority = DEFAULT_JOB_PRIORITY
+    else:
+        try:
+            priority = max(MIN_JOB_PRIORITY, min(int(priority), MAX_JOB_PRIORITY))
+        except (TypeError, ValueError):
+            return None, "priority must be an integer"
+    if deadline is None:
+        if DEFAULT_JOB_DEADLINE > 0:
+            deadline = time.time() + DEFAULT_JOB_DEADLINE
+    else:
+        try:
+            deadline = float(deadline)
+        except (TypeError, ValueError):
+            deadline = math.nan
+        if not math.isfinite(deadline):
+            return None, "deadline must be a unix time in seconds"
+    return {"priority": priority, "deadline": deadline}, None
+
+def merge_schedules(schedules):
+    """Schedule of one call serving several jobs: it is only late once every job is."""
+    deadlines = [schedule["deadline"] for schedule in schedules]
+    return {
+        "priority": max(schedule["priority"] for schedule in schedules),
+        "deadline": None if None in deadlines else max(deadlines),
+    }
+
+def time_left(schedule):
+    """Seconds until the schedule's deadline, or None without one."""
+    if not schedule or schedule.get("deadline") is None:
+        return None
+    return schedule["deadline"] - time.time()
+
+def generation_work(payload):
+    """Size of a generation in step-megapixels, including the hires pass and every image."""
+    images = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+    megapixels = int(payload.get("width") or 512) * int(payload.get("height") or 512) / 1e6
+    steps = int(payload.get("steps") or 20)
+    if payload.get("init_images"):
+        # img2img only runs the denoised part of the schedule
+        steps *= float(payload.get("denoising_strength") or 0.75)
+    work = steps * megapixels
+    if payload.get("enable_hr"):
+        scale = float(payload.get("hr_scale") or 2)
+        work += int(payload.get("hr_second_pass_steps") or steps) * megapixels * scale * scale
+    return work * images
+
+def record_generation_time(payload, generation_ms):
+    """Updates the generation speed of the payload's model."""
+    work = generation_work(payload)
+    if work <= 0:
+        return
+    key = payload_model_key(payload)
+    with generation_speed_lock:
+        rate = generation_ms / work
+        previous = generation_speed.get(key)
+        generation_speed[key] = rate if previous is None else previous + GENERATION_SPEED_ALPHA * (rate - previous)
+
+def estimate_generation_ms(payload):
+    """Estimated GPU time of a generation, or None before anything has been measured."""
+    with generation_speed_lock:
+        rate = generation_speed.get(payload_model_key(payload))
+        if rate is None and generation_speed:
+            # Unmeasured model: the fastest known one, so jobs are never rejected on a guess
+            rate = min(generation_speed.values())
+    return None if rate is None else rate * generation_work(payload)
+
+def check_deadline(schedule, estimate_ms=None, queued_ms=0):
+    """Returns an error message when a call cannot finish by the job's deadline, else None."""
+    left = time_left(schedule)
+    if left is None:
+        return None
+    if left <= 0:
+        count_expired_job("rejected")
+        return f"Job deadline passed {-left:.1f}s ago"
+    if estimate_ms is not None and (queued_ms + estimate_ms) / 1000 > left:
+        count_expired_job("rejected")
+        return (f"Job cannot finish before its deadline: about {(queued_ms + estimate_ms) / 1000:.1f}s "
+                f"of generation ahead, {left:.1f}s left")
+    return None
+
+def count_expired_job(stage):
+    metrics.inc("worker_jobs_expired_total", labels={"stage": stage},
+                description="Jobs dropped because their deadline passed or could not be met")
+
+def send_a1111(path, payload):
+    """Sends a payload to an A1111 API path and returns the JSON response.
+
+    The read timeout is cut to the job's deadline; A1111 is interrupted when it expires.
+    """
+    schedule = current_job_schedule.get()
+    generation = path in GENERATION_PATHS
+    error_msg = check_deadline(schedule, estimate_generation_ms(payload) if generation else None)
+    if error_msg:
+        print(error_msg)
+        return {"error": error_msg}
+    timings = {}
+    error_msg = switch_checkpoint(payload, timings) if generation else None
+    if error_msg:
+        print(error_msg)
+        return {"error": error_msg}
+    left = time_left(schedule)
+    print(f"Sending {path} request to A1111...")
+    start = time.perf_counter()
+    result = a1111.post(path, payload, min(left, A1111_READ_TIMEOUT) if left is not None else None,
+                        decode_images=generation and current_job_decode_images.get())
+    if "error" in result:
+        if time_left(schedule) is not None and time_left(schedule) <= 0:
+            count_expired_job("generating")
+        print(result["error"])
+        return result
+    result["timings"] = dict(timings, generation_ms=elapsed_ms(start))
+    if generation:
+        note_loaded_models(payload)
+        record_generation_time(payload, result["timings"]["generation_ms"])
+    print("A1111 request completed successfully")
+    return result
+
+def send_txt2img(payload):
+    """Sends a txt2img payload to A1111 and returns the JSON response."""
+    return send_a1111("txt2img", payload)
+
+def run_inference(inference_request):
+    """Runs inference with the provided payload."""
+    print(f"Starting inference with keys: {list(inference_request.keys())}")
+    return send_txt2img(build_payload(inference_request))
+
+# --- ASYNC INFERENCE ---
+# The async handler lets RunPod hand this worker several jobs at once. Only
+# GPU_CONCURRENCY of them generate on A1111 at a time; the others overlap their
+# CPU work (payload prep, base64 decode, face detection, S3 uploads) with it.
+ASYNC_HANDLER = os.environ.get('ASYNC_HANDLER', 'true').lower() in ('1', 'true', 'yes')
+MAX_CONCURRENT_JOBS = int(os.environ.get('MAX_CONCURRENT_JOBS', '2'))
+GPU_CONCURRENCY = int(os.environ.get('GPU_CONCURRENCY', '1'))
+
+# Progress dict of the job running in the current task, set by the streaming handler
+current_job_progress = contextvars.ContextVar("current_job_progress", default=None)
+
+# Jobs waiting for the GPU. When it frees up, the waiters with the highest priority
+# are considered. Among them, the oldest one needing the resident model goes
+# first, unless an older one has been passed over AFFINITY_MAX_SKIPS times.
+AFFINITY_MAX_SKIPS = int(os.environ.get('AFFINITY_MAX_SKIPS', '4'))
+gpu_waiters = []
+gpu_active = 0
+# {"started", "estimate_ms"} of every call holding the GPU
+gpu_running = []
+
+def pick_gpu_waiter():
+    """Chooses the next waiter to admit to the GPU."""
+    # Background work (upscales) only runs when no generation is waiting
+    candidates = [waiter for waiter in gpu_waiters if not waiter["background"]] or gpu_waiters
+    top = max(waiter["priority"] for waiter in candidates)
+    # A waiter passed over too often goes first, unless a higher priority is queued
+    starved = next((waiter for waiter in gpu_waiters
+                    if waiter["skipped"] >= AFFINITY_MAX_SKIPS and waiter["priority"] >= top), None)
+    if starved is not None:
+        return starved
+    candidates = [waiter for waiter in candidates if waiter["priority"] == top]
+    loaded = loaded_model_key()
+    return next((waiter for waiter in candidates if waiter["model_key"] == loaded), candidates[0])
+
+def gpu_work_ahead_ms(priority):
+    """Estimated GPU time before a new waiter of this priority could start, per slot."""
+    now = time.perf_counter()
+    ahead = sum(max(call["estimate_ms"] - (now - call["started"]) * 1000, 0) for call in gpu_running)
+    ahead += sum(waiter["estimate_ms"] for waiter in gpu_waiters
+                 if not waiter["background"] and waiter["priority"] >= priority)
+    return ahead / GPU_CONCURRENCY
+
+async def acquire_gpu(model_key, background=False, priority=0, deadline=None, estimate_ms=0):
+    """Waits for one of the GPU_CONCURRENCY generation slots.
+
+    Raises asyncio.TimeoutError if `deadline` (unix time) passes first.
+    """
+    global gpu_active
+    if gpu_active < GPU_CONCURRENCY and not gpu_waiters:
+        gpu_active += 1
+        return
+    waiter = {
+        "model_key": model_key,
+        "background": background,
+        "priority": priority,
+        "estimate_ms": estimate_ms,
+        "future": asyncio.get_running_loop().create_future(),
+        "skipped": 0,
+    }
+    gpu_waiters.append(waiter)
     try:
-        response = automatic_session.post(
-            url=f'{LOCAL_URL}/txt2img', 
-            json=inference_request, 
-            timeout=600
-        )
-        
-        if response.status_code != 200:
-            error_msg = f"A1111 API Error: {response.status_code} - {response.text}"
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+        await asyncio.wait_for(asyncio.shield(waiter["future"]), timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError, TimeoutError):
+        if waiter in gpu_waiters:
+            gpu_waiters.remove(waiter)
+        elif waiter["future"].done() and not waiter["future"].cancelled():
+            # The slot was granted just as we gave up, hand it on
+            release_gpu()
+        raise
+
+def release_gpu():
+    """Frees a generation slot and admits the next waiter(s)."""
+    global gpu_active
+    gpu_active -= 1
+    while gpu_waiters and gpu_active < GPU_CONCURRENCY:
+        waiter = pick_gpu_waiter()
+        for other in gpu_waiters[:gpu_waiters.index(waiter)]:
+            other["skipped"] += 1
+        gpu_waiters.remove(waiter)
+        if waiter["future"].done():
+            continue
+        if waiter["model_key"] != loaded_model_key():
+            print(f"Switching models for next job: {loaded_model_key()} -> {waiter['model_key']}")
+        gpu_active += 1
+        waiter["future"].set_result(None)
+
+async def send_a1111_async(path, payload, progress_states=None, schedule=None, decode_images=None):
+    """Async counterpart of send_a1111: waits for a GPU slot, then calls A1111.
+
+    progress_states are the streaming progress dicts of the jobs in this call
+    (default: the current job's); they are flagged once generation starts.
+    schedule is the priority and deadline of the call (default: the current job's).
+    decode_images returns the images as PNG bytes (default: the current job's choice).
+    """
+    schedule = schedule or current_job_schedule.get() or {"priority": DEFAULT_JOB_PRIORITY, "deadline": None}
+    generation = path in GENERATION_PATHS
+    if decode_images is None:
+        decode_images = current_job_decode_images.get()
+    parser = GenerationResponseParser(generation and decode_images)
+    estimate_ms = estimate_generation_ms(payload) if generation else None
+    error_msg = check_deadline(schedule, estimate_ms, gpu_work_ahead_ms(schedule["priority"]))
+    if error_msg:
+        print(error_msg)
+        return {"error": error_msg}
+    start = time.perf_counter()
+    try:
+        # Extras and face swaps run on any resident model, so they never cause a switch
+        await acquire_gpu(payload_model_key(payload) if generation else loaded_model_key(),
+                          priority=schedule["priority"], deadline=schedule["deadline"], estimate_ms=estimate_ms or 0)
+    except (asyncio.TimeoutError, TimeoutError):
+        count_expired_job("queued")
+        error_msg = f"Job deadline passed after {elapsed_ms(start)} ms waiting for the GPU"
+        print(error_msg)
+        return {"error": error_msg}
+    timings = {"queue_wait_ms": elapsed_ms(start)}
+    start = time.perf_counter()
+    for state in progress_states if progress_states is not None else [current_job_progress.get()]:
+        if state is not None:
+            state["generating"] = True
+    running = {"started": start, "estimate_ms": estimate_ms or 0}
+    gpu_running.append(running)
+    try:
+        if generation:
+            error_msg = await asyncio.to_thread(switch_checkpoint, payload, timings)
+            if error_msg:
+                print(error_msg)
+                return {"error": error_msg}
+            start = time.perf_counter()
+        print(f"Sending {path} request to A1111...")
+        # Holding the GPU here means an interrupt on timeout/cancel only stops this job
+        try:
+            left = time_left(schedule)
+            status, body = await asyncio.wait_for(a1111.post_raw_async(path, payload, parser=parser),
+                                                  None if left is None else max(left, 0))
+        except Exception as e:
+            if isinstance(e, (asyncio.TimeoutError, TimeoutError)) and time_left(schedule) is not None and time_left(schedule) <= 0:
+                # wait_for cancelled the request, which interrupts A1111
+                count_expired_job("generating")
+                error_msg = f"Job deadline passed during {path} after {elapsed_ms(start)} ms, generation interrupted"
+            else:
+                error_msg = f"Error calling A1111 API: {str(e)}"
             print(error_msg)
             return {"error": error_msg}
-        
-        result = response.json()
-        print("A1111 request completed successfully")
-        return result
-        
-    except Exception as e:
+        timings["generation_ms"] = elapsed_ms(start)
+        if status == 200 and generation:
+            note_loaded_models(payload)
+            record_generation_time(payload, timings["generation_ms"])
+    finally:
+        gpu_running.remove(running)
+        release_gpu()
+
+    if status != 200:
+        error_msg = f"A1111 API Error: {status} - {body.decode('utf-8', 'replace')}"
+        print(error_msg)
+        return {"error": error_msg}
+    # The images were taken out while the body streamed in; the rest is parsed off the event loop
+    start = time.perf_counter()
+    try:
+        result = await asyncio.to_thread(parser.result)
+    except ValueError as e:
         error_msg = f"Error calling A1111 API: {str(e)}"
         print(error_msg)
         return {"error": error_msg}
+    timings["response_parse_ms"] = elapsed_ms(start)
+    result["timings"] = timings
+    print("A1111 request completed successfully")
+    return result
+
+async def send_txt2img_async(payload, progress_states=None, schedule=None, decode_images=None):
+    """Async counterpart of send_txt2img."""
+    return await send_a1111_async("txt2img", payload, progress_states, schedule, decode_images)
+
+# --- MICRO-BATCHING ---
+# Jobs that differ only by seed are held for BATCH_WINDOW_MS and generated in a
+# single A1111 call with batch_size > 1. A1111 takes one prompt per call and seeds
+# a batch as seed, seed+1, ..., so a batch is formed from jobs sharing the whole
+# payload except the seed, whose seeds are random (-1) or consecutive.
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', '0'))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '4'))
+BATCH_INFO_LIST_KEYS = ("all_prompts", "all_negative_prompts", "all_seeds", "all_subseeds", "infotexts")
+
+pending_batches = {}
+
+def payload_signature(payload, exclude=("seed",)):
+    """Stable hash of a payload, ignoring the given keys."""
+    canonical = {k: v for k, v in payload.items() if k not in exclude}
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def is_batchable(payload):
+    """Only single-image jobs are merged into a batch."""
+    return int(payload.get("batch_size", 1)) == 1 and int(payload.get("n_iter", 1)) == 1
+
+def payload_seed(payload):
+    """The payload's seed as an int, -1 meaning random."""
+    seed = payload.get("seed")
+    return -1 if seed is None else int(seed)
+
+def plan_batches(jobs):
+    """Splits (payload, future, progress state, schedule) jobs into runs that one A1111 call can generate."""
+    runs = []
+    random_seed = [job for job in jobs if payload_seed(job[0]) == -1]
+    for i in range(0, len(random_seed), MAX_BATCH_SIZE):
+        runs.append(random_seed[i:i + MAX_BATCH_SIZE])
+
+    fixed_seed = sorted((job for job in jobs if payload_seed(job[0]) != -1),
+                        key=lambda job: payload_seed(job[0]))
+    run = []
+    for job in fixed_seed:
+        if run and (payload_seed(job[0]) != payload_seed(run[0][0]) + len(run) or len(run) >= MAX_BATCH_SIZE):
+            runs.append(run)
+            run = []
+        run.append(job)
+    if run:
+        runs.append(run)
+    return runs
+
+def split_batch_result(result, payloads):
+    """Splits a batched A1111 response back into one response per job."""
+    count = len(payloads)
+    info = json.loads(result.get("info") or "{}")
+    indices = generated_image_indices(result)
+    outputs = []
+    for i, payload in enumerate(payloads):
+        job_info = dict(info)
+        for key in BATCH_INFO_LIST_KEYS:
+            if isinstance(info.get(key), list) and len(info[key]) >= count:
+                job_info[key] = [info[key][i]]
+        if job_info.get("all_seeds"):
+            job_info["seed"] = job_info["all_seeds"][0]
+        if job_info.get("all_subseeds"):
+            job_info["subseed"] = job_info["all_subseeds"][0]
+        if job_info.get("all_prompts"):
+            job_info["prompt"] = job_info["all_prompts"][0]
+        job_info["batch_size"] = 1
+        job_info["index_of_first_image"] = 0
+        outputs.append({
+            "images": [result["images"][indices[i]]],
+            "parameters": payload,
+            "info": json.dumps(job_info),
+            "timings": dict(result.get("timings") or {})
+        })
+    return outputs
+
+async def send_batch(run, decode_images=False):
+    """Generates one planned run in a single call and resolves each job's future."""
+    payloads = [job[0] for job in run]
+    progress_states = [job[2] for job in run]
+    schedule = merge_schedules([job[3] for job in run])
+    if len(run) == 1:
+        results = [await send_txt2img_async(payloads[0], progress_states, schedule, decode_images)]
+    else:
+        print(f"Sending batch of {len(run)} compatible jobs to A1111...")
+        batch_payload = dict(payloads[0], batch_size=len(run))
+        result = await send_txt2img_async(batch_payload, progress_states, schedule, decode_images)
+        if "error" in result:
+            results = [dict(result) for _ in run]
+        elif len(generated_image_indices(result)) < len(run):
+            error_msg = f"A1111 returned {len(generated_image_indices(result))} images for a batch of {len(run)}"
+            print(error_msg)
+            results = [{"error": error_msg} for _ in run]
+        else:
+            results = split_batch_result(result, payloads)
+
+    for (_, future, _, _), job_result in zip(run, results):
+        if not future.done():
+            future.set_result(job_result)
+
+async def flush_batch(signature):
+    """Sends every job collected under a signature."""
+    group = pending_batches.pop(signature, None)
+    if not group:
+        return
+    group["timer"].cancel()
+    runs = plan_batches(group["jobs"])
+    try:
+        await asyncio.gather(*(send_batch(run, group["decode_images"]) for run in runs))
+    except Exception as e:
+        error_msg = f"Error sending batch to A1111: {str(e)}"
+        print(error_msg)
+        for _, future, _, _ in group["jobs"]:
+            if not future.done():
+                future.set_result({"error": error_msg})
+
+async def submit_txt2img(payload):
+    """Sends a txt2img payload, batching it with compatible jobs when BATCH_WINDOW_MS is set."""
+    if BATCH_WINDOW_MS <= 0 or not is_batchable(payload):
+        return await send_txt2img_async(payload)
+
+    loop = asyncio.get_running_loop()
+    # Jobs wanting PNG bytes and jobs wanting base64 are batched apart
+    decode_images = current_job_decode_images.get()
+    signature = (payload_signature(payload), decode_images)
+    future = loop.create_future()
+    group = pending_batches.get(signature)
+    if group is None:
+        timer = loop.call_later(BATCH_WINDOW_MS / 1000.0, lambda: asyncio.ensure_future(flush_batch(signature)))
+        group = pending_batches[signature] = {"jobs": [], "timer": timer, "decode_images": decode_images}
+    schedule = current_job_schedule.get() or {"priority": DEFAULT_JOB_PRIORITY, "deadline": None}
+    group["jobs"].append((payload, future, current_job_progress.get(), schedule))
+    if len(group["jobs"]) >= MAX_BATCH_SIZE:
+        asyncio.ensure_future(flush_batch(signature))
+    return await future
+
+def concurrency_modifier(current_concurrency):
+    """Tells RunPod how many jobs this worker accepts at once."""
+    if not WARM_MODE or a1111_lock.locked():
+        # Single-job workers, or A1111 is being restarted
+        return 1
+    return MAX_CONCURRENT_JOBS
+
+# --- UPSCALE STAGE ---
+# Upscaling and face restoration run as their own extras calls after txt2img has
+# released the GPU, instead of inside the txt2img call. Upscale calls wait for the
+# GPU as background work: queued generations go first. Pieces that pile up
+# meanwhile from several jobs are sent together to /extra-batch-images. Each call
+# produces at most UPSCALE_MAX_MEGAPIXELS of output; bigger images are upscaled in
+# overlapping tiles and stitched back in the worker.
+UPSCALE_MAX_MEGAPIXELS = float(os.environ.get('UPSCALE_MAX_MEGAPIXELS', '16'))
+UPSCALE_MAX_BATCH = int(os.environ.get('UPSCALE_MAX_BATCH', '8'))
+UPSCALE_TILE_OVERLAP = 32
+# Move ReActor's upscaler out of the txt2img call into this stage
+REACTOR_UPSCALE_STAGE = os.environ.get('REACTOR_UPSCALE_STAGE', 'true').lower() in ('1', 'true', 'yes')
+
+pending_upscales = {}
+
+def upscale_spec(raw):
+    """Normalizes a job's upscale options."""
+    upscaler = raw.get("upscaler", "4x-UltraSharp")
+    return {
+        "upscaler": resolve_asset("upscalers", upscaler) or upscaler,
+        "scale": float(raw.get("scale", 2.0)),
+        "visibility": float(raw.get("visibility", 1.0)),
+        "restore_face_model": raw.get("restore_face_model"),
+        "restore_visibility": float(raw.get("restore_visibility", 1.0)),
+        "codeformer_weight": float(raw.get("codeformer_weight", 0.5)),
+    }
+
+def upscale_payload(images, spec):
+    """/extra-batch-images payload for a list of base64 images."""
+    restorer = spec["restore_face_model"]
+    if spec["visibility"] < 1:
+        # Blend the upscaler over a plain resize, as ReActor does with upscaler_visibility
+        upscalers = {"upscaler_1": "Lanczos", "upscaler_2": spec["upscaler"], "extras_upscaler_2_visibility": spec["visibility"]}
+    else:
+        upscalers = {"upscaler_1": spec["upscaler"]}
+    return extra_batch_images_request(
+        images,
+        upscaling_resize=spec["scale"],
+        gfpgan_visibility=spec["restore_visibility"] if restorer == "GFPGAN" else 0.0,
+        codeformer_visibility=spec["restore_visibility"] if restorer == "CodeFormer" else 0.0,
+        codeformer_weight=spec["codeformer_weight"],
+        **upscalers
+    )
+
+def output_pixels(image_b64, scale):
+    size = png_size(image_b64)
+    return int(size[0] * scale) * int(size[1] * scale) if size else 0
+
+def split_tiles(image_b64, scale):
+    """Cuts an image whose upscaled size exceeds the ceiling into overlapping tiles.
+
+    Returns (tile images, layout); layout is None when the image fits in one call.
+    """
+    max_pixels = UPSCALE_MAX_MEGAPIXELS * 1_000_000
+    if output_pixels(image_b64, scale) <= max_pixels:
+        return [image_b64], None
+    bgr_img = decode_image(base64.b64decode(image_b64))
+    height, width = bgr_img.shape[:2]
+    # Tile side (including overlap) whose upscaled area fits under the ceiling
+    side = int((max_pixels ** 0.5) / scale)
+    core = max(side - 2 * UPSCALE_TILE_OVERLAP, 64)
+    tiles, boxes = [], []
+    for y in range(0, height, core):
+        for x in range(0, width, core):
+            box = (max(x - UPSCALE_TILE_OVERLAP, 0), max(y - UPSCALE_TILE_OVERLAP, 0),
+                   min(x + core + UPSCALE_TILE_OVERLAP, width), min(y + core + UPSCALE_TILE_OVERLAP, height))
+            body, _, _ = encode_image(bgr_img[box[1]:box[3], box[0]:box[2]], "png")
+            tiles.append(base64.b64encode(body).decode('utf-8'))
+            boxes.append((box, (x, y, min(x + core, width), min(y + core, height))))
+    print(f"Upscaling {width}x{height} x{scale} in {len(tiles)} tiles")
+    return tiles, {"width": width, "height": height, "boxes": boxes}
+
+def stitch_tiles(tiles, layout, scale):
+    """Pastes the core of every upscaled tile into the full-size image. Returns base64 PNG."""
+    import cv2
+    import numpy as np
+    canvas = np.zeros((int(layout["height"] * scale), int(layout["width"] * scale), 3), np.uint8)
+    for tile_b64, (box, core) in zip(tiles, layout["boxes"]):
+        tile = decode_image(base64.b64decode(tile_b64))
+        # Every size and offset comes from canvas coordinates, so the cores tile the canvas exactly
+        bx0, by0, bx1, by1 = (int(v * scale) for v in box)
+        if (tile.shape[1], tile.shape[0]) != (bx1 - bx0, by1 - by0):
+            # Fractional scales can round the upscaler's output differently
+            tile = cv2.resize(tile, (bx1 - bx0, by1 - by0), interpolation=cv2.INTER_LANCZOS4)
+        cx0, cy0, cx1, cy1 = (int(v * scale) for v in core)
+        canvas[cy0:cy1, cx0:cx1] = tile[cy0 - by0:cy1 - by0, cx0 - bx0:cx1 - bx0]
+    body, _, _ = encode_image(canvas, "png")
+    return base64.b64encode(body).decode('utf-8')
+
+def chunk_pieces(pieces, scale):
+    """Groups pieces into calls of at most UPSCALE_MAX_BATCH images and UPSCALE_MAX_MEGAPIXELS of output."""
+    max_pixels = UPSCALE_MAX_MEGAPIXELS * 1_000_000
+    chunks, chunk, chunk_pixels = [], [], 0
+    for piece in pieces:
+        pixels = output_pixels(piece, scale)
+        if chunk and (len(chunk) >= UPSCALE_MAX_BATCH or chunk_pixels + pixels > max_pixels):
+            chunks.append(chunk)
+            chunk, chunk_pixels = [], 0
+        chunk.append(piece)
+        chunk_pixels += pixels
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def run_upscale_pieces(pieces, spec, send):
+    """Upscales pieces with blocking calls. Returns (images, summed timings)."""
+    upscaled, timings = [], {}
+    for chunk in chunk_pieces(pieces, spec["scale"]):
+        result = send("extra-batch-images", upscale_payload(chunk, spec))
+        if "error" in result:
+            raise ValueError(f"Upscale failed: {result['error']}")
+        upscaled.extend(result["images"])
+        timings["gpu_ms"] = round(timings.get("gpu_ms", 0) + result["timings"]["generation_ms"], 2)
+    return upscaled, timings
+
+def upscale_images(images, spec, run_pieces):
+    """Upscales (and restores) images. run_pieces(pieces, spec) returns (images, timings).
+
+    Tiled images are restored at their original size first, so faces are never
+    cut by a tile edge, and their tiles are then only upscaled.
+    """
+    results = []
+    timings = {}
+    def merge(step_timings):
+        for key, value in step_timings.items():
+            timings[f"upscale_{key}"] = round(timings.get(f"upscale_{key}", 0) + value, 2)
+
+    start = time.perf_counter()
+    for image in images:
+        tiles, layout = split_tiles(image, spec["scale"])
+        if layout is None:
+            upscaled, step_timings = run_pieces(tiles, spec)
+            merge(step_timings)
+            results.append(upscaled[0])
+            continue
+        tile_spec = spec
+        if spec["restore_face_model"]:
+            restored, step_timings = run_pieces([image], dict(spec, scale=1.0, upscaler="None", visibility=1.0))
+            merge(step_timings)
+            tiles, layout = split_tiles(restored[0], spec["scale"])
+            tile_spec = dict(spec, restore_face_model=None)
+        upscaled, step_timings = run_pieces(tiles, tile_spec)
+        merge(step_timings)
+        results.append(stitch_tiles(upscaled, layout, spec["scale"]))
+    timings["upscale_ms"] = elapsed_ms(start)
+    return results, timings
+
+async def upscale_pieces_async(pieces, spec):
+    """Queues pieces for a background extras call shared with other jobs' pieces."""
+    loop = asyncio.get_running_loop()
+    signature = payload_signature(spec, exclude=())
+    futures = [loop.create_future() for _ in pieces]
+    group = pending_upscales.get(signature)
+    if group is None:
+        group = pending_upscales[signature] = {"spec": spec, "pieces": []}
+        asyncio.ensure_future(flush_upscales(signature))
+    group["pieces"].extend(zip(pieces, futures))
+    results = await asyncio.gather(*futures)
+    timings = {
+        "queue_wait_ms": max(queue_wait_ms for _, queue_wait_ms, _ in results),
+        "gpu_ms": round(sum(gpu_ms for _, _, gpu_ms in results), 2),
+    }
+    return [image for image, _, _ in results], timings
+
+async def flush_upscales(signature):
+    """Sends queued pieces one call at a time, each time the GPU is free of generations."""
+    group = pending_upscales[signature]
+    try:
+        while group["pieces"]:
+            start = time.perf_counter()
+            await acquire_gpu(loaded_model_key(), background=True)
+            queue_wait_ms = elapsed_ms(start)
+            # Everything queued while waiting for the GPU joins this call, up to the limits
+            chunk = chunk_pieces([piece for piece, _ in group["pieces"]], group["spec"]["scale"])[0]
+            taken, group["pieces"] = group["pieces"][:len(chunk)], group["pieces"][len(chunk):]
+            print(f"Upscaling {len(taken)} image(s) in one extras call...")
+            start = time.perf_counter()
+            try:
+                result = await a1111.post_async("extra-batch-images", upscale_payload(chunk, group["spec"]))
+            finally:
+                release_gpu()
+            # Each piece is charged an equal share of the call
+            gpu_ms = round(elapsed_ms(start) / len(taken), 2)
+            for i, (_, future) in enumerate(taken):
+                if future.done():
+                    continue
+                if "error" in result:
+                    future.set_exception(ValueError(f"Upscale failed: {result['error']}"))
+                else:
+                    future.set_result((result["images"][i], queue_wait_ms, gpu_ms))
+    except BaseException as e:
+        for _, future in group["pieces"]:
+            if not future.done():
+                future.set_exception(e if isinstance(e, Exception) else ValueError("Upscale cancelled"))
+        raise
+    finally:
+        pending_upscales.pop(signature, None)
+
+def run_upscale_pieces_sync(pieces, spec):
+    """run_pieces for the sync handler."""
+    return run_upscale_pieces(pieces, spec, send_a1111)
+
+def upscale_runner_for_thread(loop):
+    """run_pieces for code running in a worker thread: bridges to upscale_pieces_async on loop."""
+    def run_pieces(pieces, spec):
+        return asyncio.run_coroutine_threadsafe(upscale_pieces_async(pieces, spec), loop).result()
+    return run_pieces
+
+def upscale_generated_images(json_output, upscale, run_pieces):
+    """Replaces the generated images of a txt2img response with their upscaled versions."""
+    indices = generated_image_indices(json_output)
+    upscaled, timings = upscale_images([json_output["images"][i] for i in indices], upscale_spec(upscale), run_pieces)
+    for i, image in zip(indices, upscaled):
+        json_output["images"][i] = image
+    json_output.setdefault("timings", {}).update(timings)
+    return json_output
+
+# --- RESULT CACHE ---
+# A fixed seed with the same final payload gives the same image, so finished job
+# outputs are cached under a hash of the payload (after LoRA/embedding injection)
+# and the job options. The disk tier is LRU-evicted above RESULT_CACHE_MAX_MB;
+# RESULT_CACHE_S3_BUCKET adds a shared object-store tier behind it.
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '/tmp/result-cache')
+RESULT_CACHE_MAX_MB = float(os.environ.get('RESULT_CACHE_MAX_MB', '1024'))
+RESULT_CACHE_S3_BUCKET = os.environ.get('RESULT_CACHE_S3_BUCKET')
+RESULT_CACHE_S3_PREFIX = os.environ.get('RESULT_CACHE_S3_PREFIX', 'result-cache/')
+# Per-run values that must not be replayed from the cache
+UNCACHED_OUTPUT_KEYS = ("timings", "worker", "refresh_worker", "result_cache")
+
+result_cache_lock = threading.Lock()
+result_cache_index = OrderedDict()  # key -> size in bytes, least recently used first
+result_cache_bytes = 0
+result_cache_stats = {"hits": 0, "disk_hits": 0, "object_store_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+def count_result_cache(stat):
+    with result_cache_lock:
+        result_cache_stats[stat] += 1
+
+def result_cache_snapshot():
+    with result_cache_lock:
+        return dict(result_cache_stats)
+
+def result_cache_enabled():
+    return RESULT_CACHE_MAX_MB > 0 or bool(RESULT_CACHE_S3_BUCKET)
+
+def result_cache_path(key):
+    return os.path.join(RESULT_CACHE_DIR, f"{key}.json")
+
+def load_result_cache_index():
+    """Rebuilds the LRU index from the files left in RESULT_CACHE_DIR, oldest first."""
+    global result_cache_bytes
+    if RESULT_CACHE_MAX_MB <= 0:
+        return
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    entries = []
+    for name in os.listdir(RESULT_CACHE_DIR):
+        if name.endswith(".json"):
+            stat = os.stat(os.path.join(RESULT_CACHE_DIR, name))
+            entries.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+    with result_cache_lock:
+        for _, key, size in sorted(entries):
+            result_cache_index[key] = size
+            result_cache_bytes += size
+    evict_result_cache()
+
+def evict_result_cache():
+    """Deletes least recently used entries until the disk tier fits RESULT_CACHE_MAX_MB."""
+    global result_cache_bytes
+    limit = RESULT_CACHE_MAX_MB * 1024 * 1024
+    evicted = []
+    with result_cache_lock:
+        while result_cache_index and result_cache_bytes > limit:
+            key, size = result_cache_index.popitem(last=False)
+            result_cache_bytes -= size
+            result_cache_stats["evictions"] += 1
+            evicted.append(key)
+    for key in evicted:
+        try:
+            os.remove(result_cache_path(key))
+        except OSError:
+            pass
+
+def result_cache_key(payload, options):
+    """Cache key for a job; None when its output is not deterministic."""
+    if not result_cache_enabled() or payload_seed(payload) == -1:
+        return None
+    return payload_signature({"payload": payload, "options": options}, exclude=())
+
+def write_result_cache_file(key, data):
+    """Adds an entry to the disk tier."""
+    global result_cache_bytes
+    tmp_path = f"{result_cache_path(key)}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, result_cache_path(key))
+    with result_cache_lock:
+        result_cache_bytes += len(data) - result_cache_index.pop(key, 0)
+        result_cache_index[key] = len(data)
+    evict_result_cache()
+
+def get_cached_result(key):
+    """Returns the cached output for a key, or None."""
+    data = None
+    if RESULT_CACHE_MAX_MB > 0:
+        with result_cache_lock:
+            on_disk = key in result_cache_index
+            if on_disk:
+                result_cache_index.move_to_end(key)
+        if on_disk:
+            try:
+                with open(result_cache_path(key), "rb") as f:
+                    data = f.read()
+                os.utime(result_cache_path(key))
+                count_result_cache("disk_hits")
+            except OSError:
+                # Evicted by a concurrent job between the index check and the read
+                data = None
+
+    if data is None and RESULT_CACHE_S3_BUCKET:
+        s3 = get_s3_client()
+        try:
+            s3_object = s3.get_object(Bucket=RESULT_CACHE_S3_BUCKET, Key=f"{RESULT_CACHE_S3_PREFIX}{key}.json")
+            data = s3_object['Body'].read()
+            count_result_cache("object_store_hits")
+            if RESULT_CACHE_MAX_MB > 0:
+                write_result_cache_file(key, data)
+        except s3.exceptions.NoSuchKey:
+            pass
+        except Exception as e:
+            print(f"Result cache object store lookup failed: {e}")
+
+    if data is None:
+        count_result_cache("misses")
+        return None
+    count_result_cache("hits")
+    return json.loads(data)
+
+def store_cached_result(key, output):
+    """Saves a successful job output in every configured tier."""
+    data = json.dumps({k: v for k, v in output.items() if k not in UNCACHED_OUTPUT_KEYS}).encode('utf-8')
+    try:
+        if RESULT_CACHE_MAX_MB > 0:
+            write_result_cache_file(key, data)
+        if RESULT_CACHE_S3_BUCKET:
+            get_s3_client().put_object(
+                Bucket=RESULT_CACHE_S3_BUCKET,
+                Key=f"{RESULT_CACHE_S3_PREFIX}{key}.json",
+                Body=data,
+                ContentType='application/json'
+            )
+        count_result_cache("stores")
+    except Exception as e:
+        print(f"Failed to store result in cache: {e}")
+
+try:
+    load_result_cache_index()
+except OSError as e:
+    print(f"Warning: result cache disabled, cannot use {RESULT_CACHE_DIR}: {e}")
+    RESULT_CACHE_MAX_MB = 0
+
+# --- PIPELINE MODE ---
+# A job with a "pipeline" list runs its stages back to back in one job instead of
+# one RunPod round trip per stage:
+#   txt2img      regular job fields (enable_hr/hr_scale/hr_upscaler for hires fix)
+#   img2img      denoising_strength, optional mask_b64 for inpainting; prompt defaults to the last one
+#   upscale      upscaler, scale and optional face restoration (see UPSCALE STAGE)
+#   face_swap    source_face_id and ReActor options through /reactor/image
+#   detect_faces optional det_size; crops are saved as in a regular job
+# Images stay base64 strings between A1111 stages, which is what every endpoint
+# takes and returns, so nothing is decoded or re-encoded in between. Only the final
+# images go through postprocess_output.
+PIPELINE_STAGES = ("txt2img", "img2img", "upscale", "face_swap", "detect_faces")
+
+def png_size(image_b64):
+    """(width, height) of a base64 PNG, read from its header without decoding the image."""
+    header = base64.b64decode(image_b64[:32])
+    if header[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    return int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+
+def face_indices(value):
+    return [int(i) for i in str(value).split(",") if i.strip()]
+
+def run_generation_stage(name, stage, images, state, send):
+    """txt2img or img2img. img2img runs once per current image."""
+    prompt = stage.get("prompt", state.get("prompt", ""))
+    state["prompt"] = prompt
+    if name == "txt2img":
+        results = [send("txt2img", build_payload(dict(stage, prompt=prompt)))]
+    else:
+        mask = stage.pop("mask_b64", None)
+        results = []
+        for image in images:
+            payload = build_payload(dict(stage, prompt=prompt))
+            size = png_size(image)
+            if "width" not in payload and size:
+                # A1111 would otherwise resize the input to its 512x512 default
+                payload["width"], payload["height"] = size
+            results.append(send("img2img", img2img_request([image], mask=mask, **payload)))
+            if "error" in results[-1]:
+                break
+
+    output_images = []
+    for result in results:
+        if "error" in result:
+            return None, result
+        output_images.extend(result["images"][i] for i in generated_image_indices(result))
+        if "info" not in state:
+            # Seeds of the first generation; the grid, if any, is not returned
+            info = json.loads(result.get("info") or "{}")
+            info["index_of_first_image"] = 0
+            state["info"] = json.dumps(info)
+    return output_images, results
+
+def run_face_swap_stage(stage, images, send):
+    face_id = stage.pop("source_face_id", None)
+    if not face_id:
+        raise ValueError("face_swap stage needs a source_face_id")
+    options = pop_reactor_options(stage)
+    source_image, _, face_model = reactor_source(face_id)
+    results = []
+    for image in images:
+        payload = reactor_image_request(
+            image,
+            source_image=source_image,
+            face_model=face_model,
+            source_faces_index=face_indices(options["source_face_index"]),
+            face_index=face_indices(options["target_face_index"]),
+            model=options["reactor_model"],
+            face_restorer=options["restore_face_model"],
+            restorer_visibility=options["gfpgan_visibility"],
+            codeformer_weight=options["codeformer_weight"],
+            upscaler=options["upscaler"],
+            scale=options["upscaler_scale"],
+            upscale_visibility=options["upscaler_visibility"],
+            det_thresh=options["face_detection_threshold"],
+            det_maxnum=options["max_faces"],
+        )
+        results.append(send("/reactor/image", payload))
+        if "error" in results[-1]:
+            return None, results[-1]
+    return [result["image"] for result in results], results
+
+def run_detect_faces_stage(stage, images, det_size):
+    """Detects and saves faces on the current images. Returns (faces by index, timings)."""
+    detected_faces = {}
+    timings = {}
+    for i, image in enumerate(images):
+        image_timings = {}
+        bgr_img = decode_image(base64.b64decode(image), image_timings)
+        detected_faces[str(i)] = [] if bgr_img is None else detect_and_save_faces_from_array(
+            bgr_img, image_timings, stage.get("det_size", det_size)
+        )
+        for key, value in image_timings.items():
+            timings[key] = round(timings.get(key, 0) + value, 2)
+    return detected_faces, timings
+
+def run_pipeline(input_data, options, send, run_pieces, cancelled=None):
+    """Runs a pipeline job. send(path, payload) performs one A1111 call and
+    run_pieces(pieces, spec) one upscale (see upscale_images).
+
+    Returns the final images with per-stage timings, or {"error": ...}.
+    """
+    stages = input_data.pop("pipeline")
+    if not isinstance(stages, list) or not stages:
+        return {"error": "pipeline must be a non-empty list of stages"}
+    images = list(input_data.pop("input_images", None) or [])
+    state = {}
+    stage_timings = []
+    timings = {}
+    detected_faces = None
+
+    for i, stage in enumerate(stages):
+        stage = dict(stage)
+        name = stage.pop("stage", None)
+        if name not in PIPELINE_STAGES:
+            return {"error": f"Unknown pipeline stage {i}: {name}. Expected one of {list(PIPELINE_STAGES)}"}
+        if name != "txt2img" and not images:
+            return {"error": f"Pipeline stage {i} ({name}) has no input image; start with txt2img or pass input_images"}
+        if cancelled is not None and cancelled.is_set():
+            return {"error": "Pipeline cancelled"}
+
+        print(f"Pipeline stage {i}: {name}")
+        start = time.perf_counter()
+        stage_detail = {"stage": name}
+        if name == "detect_faces":
+            detected_faces, detail_timings = run_detect_faces_stage(stage, images, options["det_size"])
+            stage_detail.update(detail_timings)
+        elif name == "upscale":
+            try:
+                images, detail_timings = upscale_images(images, upscale_spec(stage), run_pieces)
+            except ValueError as e:
+                return {"error": f"Pipeline stage {i} ({name}) failed: {e}"}
+            stage_detail.update(detail_timings)
+        else:
+            if name in GENERATION_PATHS:
+                output_images, results = run_generation_stage(name, stage, images, state, send)
+            else:
+                output_images, results = run_face_swap_stage(stage, images, send)
+            if output_images is None:
+                return {"error": f"Pipeline stage {i} ({name}) failed: {results['error']}"}
+            images = output_images
+            for result in results:
+                for key, value in (result.get("timings") or {}).items():
+                    stage_detail[key] = round(stage_detail.get(key, 0) + value, 2)
+        stage_detail["ms"] = elapsed_ms(start)
+        stage_timings.append(stage_detail)
+        timings[f"{name}_stage_ms"] = round(timings.get(f"{name}_stage_ms", 0) + stage_detail["ms"], 2)
+
+    json_output = {"images": images, "stages": stage_timings, "timings": timings}
+    if "info" in state:
+        json_output["info"] = state["info"]
+    if detected_faces is not None:
+        json_output["detected_faces"] = detected_faces
+    # Face detection already ran as a stage if it was asked for
+    return postprocess_output(json_output, dict(options, detect_faces=False))
+
+async def run_pipeline_async(input_data, options):
+    """Runs run_pipeline in a worker thread; its A1111 calls go through the GPU scheduler."""
+    loop = asyncio.get_running_loop()
+    progress_state = current_job_progress.get()
+    cancelled = threading.Event()
+
+    def send(path, payload):
+        future = asyncio.run_coroutine_threadsafe(send_a1111_async(path, payload, [progress_state]), loop)
+        return future.result()
+
+    try:
+        return await asyncio.to_thread(run_pipeline, input_data, options, send, upscale_runner_for_thread(loop), cancelled)
+    except asyncio.CancelledError:
+        # The thread cannot be killed; stop it before its next stage
+        cancelled.set()
+        raise
 
 # --- RUNPOD HANDLER ---
-def handler(event):
-    """Main function called by RunPod to process a job."""
+def wants_face_detection(input_data):
+    """Face detection is skipped for jobs driven by an IP-Adapter reference image."""
+    return "ip_adapter_image_b64" not in input_data
+
+def generated_image_indices(json_output):
+    """Positions in `images` holding generated images.
+
+    A1111 puts a grid first for batches (index_of_first_image) and extensions
+    such as ControlNet append their maps after the generated images.
+    """
+    images = json_output.get("images") or []
+    try:
+        info = json.loads(json_output.get("info") or "{}")
+    except (TypeError, ValueError):
+        info = {}
+    first = int(info.get("index_of_first_image", 0) or 0)
+    count = len(info.get("all_seeds") or []) or len(images) - first
+    return list(range(first, min(first + count, len(images))))
+
+def pop_upscale_option(input_data):
+    """The job's upscale options, or None.
+
+    With REACTOR_UPSCALE_STAGE, ReActor's upscaler is taken out of the face swap
+    and run in the upscale stage instead, after txt2img has freed the GPU.
+    """
+    upscale = input_data.pop("upscale", None)
+    if upscale is None and REACTOR_UPSCALE_STAGE and input_data.get("source_face_id"):
+        upscaler = input_data.get("upscaler", "4x-UltraSharp")
+        scale = float(input_data.get("upscaler_scale", 1.5))
+        if upscaler and upscaler != "None" and scale > 1:
+            upscale = {"upscaler": upscaler, "scale": scale, "visibility": input_data.get("upscaler_visibility", 0.8)}
+            input_data["upscaler"], input_data["upscaler_scale"] = "None", 1
+    return upscale
+
+def wants_decoded_images(options):
+    """Whether the job's images may arrive as PNG bytes: with s3 output and no upscale, nothing needs their base64."""
+    return options["output_mode"] == "s3" and not options["upscale"]
+
+def extract_job_options(input_data):
+    """Removes worker-only options from the job input before it becomes an A1111 payload."""
+    return {
+        "detect_faces": wants_face_detection(input_data),
+        "upscale": pop_upscale_option(input_data),
+        "det_size": input_data.pop("face_det_size", None),
+        "output_mode": str(input_data.pop("output_mode", OUTPUT_MODE)).lower(),
+        "output_format": str(input_data.pop("output_format", OUTPUT_FORMAT)).lower(),
+        "output_quality": int(input_data.pop("output_quality", OUTPUT_QUALITY)),
+    }
+
+def save_output_image(image_bytes, bgr_img, options):
+    """Uploads one generated image, re-encoding it when a non-PNG format is requested."""
+    timings = {}
+    if options["output_format"] != "png" and bgr_img is not None:
+        start = time.perf_counter()
+        body, extension, content_type = encode_image(bgr_img, options["output_format"], options["output_quality"])
+        timings["image_encode_ms"] = elapsed_ms(start)
+    else:
+        # A1111 already returns PNG, upload it untouched
+        body, extension, content_type = image_bytes, ".png", "image/png"
+
+    key = f"images/{uuid.uuid4()}{extension}"
+    start = time.perf_counter()
+    image_uploader(key, body, content_type)
+    timings["image_upload_ms"] = elapsed_ms(start)
+
+    image_entry = {"bucket": S3_IMAGES_BUCKET_NAME, "s3_key": key, "content_type": content_type, "bytes": len(body)}
+    if bgr_img is not None:
+        image_entry["height"], image_entry["width"] = bgr_img.shape[:2]
+    return image_entry, timings
+
+def process_generated_image(image, options):
+    """Decodes one generated image once, then uploads it and/or runs face detection on it.
+
+    image is base64, or PNG bytes when the response was decoded as it streamed in.
+    Returns (detected faces, timings, output entry or None). The upload runs on
+    face_upload_executor while faces are detected on the same decoded array.
+    """
+    timings = {}
+    upload = options["output_mode"] == "s3"
+    image_bytes = image
+    if isinstance(image, str):
+        start = time.perf_counter()
+        image_bytes = base64.b64decode(image)
+        timings["b64decode_ms"] = elapsed_ms(start)
+
+    bgr_img = None
+    if options["detect_faces"] or (upload and options["output_format"] != "png"):
+        bgr_img = decode_image(image_bytes, timings)
+        if bgr_img is None:
+            print("Error: could not decode image.")
+
+    upload_future = face_upload_executor.submit(save_output_image, image_bytes, bgr_img, options) if upload else None
+
+    faces = []
+    if options["detect_faces"] and bgr_img is not None:
+        faces = detect_and_save_faces_from_array(bgr_img, timings, options["det_size"])
+
+    image_entry = None
+    if upload_future is not None:
+        image_entry, upload_timings = upload_future.result()
+        timings.update(upload_timings)
+    return faces, timings, image_entry
+
+def postprocess_output(json_output, options):
+    """Runs face detection on every generated image and uploads them in s3 output mode.
+
+    detected_faces is keyed by the image's index in `images`. Timings are
+    summed over images; postprocess_wall_ms is the elapsed time for all.
+    """
+    upload = options["output_mode"] == "s3"
+    if not (options["detect_faces"] or upload) or not json_output.get("images"):
+        return json_output
+
+    indices = generated_image_indices(json_output)
+    print(f"Post-processing {len(indices)} generated image(s)...")
+    start = time.perf_counter()
+    futures = {
+        i: face_detect_executor.submit(process_generated_image, json_output['images'][i], options)
+        for i in indices
+    }
+    detected_faces = {}
+    outputs = []
+    timings = {}
+    for i, future in futures.items():
+        try:
+            faces, image_timings, image_entry = future.result()
+        except Exception as e:
+            print(f"Post-processing failed for image {i}: {e}")
+            if upload:
+                return {"error": f"Failed to upload image {i}: {str(e)}"}
+            faces, image_timings, image_entry = [], {}, None
+        detected_faces[str(i)] = faces
+        if image_entry is not None:
+            outputs.append(dict(image_entry, index=i))
+        for key, value in image_timings.items():
+            timings[key] = round(timings.get(key, 0) + value, 2)
+    timings["postprocess_wall_ms"] = elapsed_ms(start)
+
+    if options["detect_faces"]:
+        json_output['detected_faces'] = detected_faces
+        print(f"Face detection completed. Found {sum(len(f) for f in detected_faces.values())} faces.")
+    if upload:
+        # Only keys and metadata are returned; the request echo can hold large base64 inputs
+        del json_output['images']
+        json_output.pop('parameters', None)
+        json_output['outputs'] = outputs
+    json_output.setdefault('timings', {}).update(timings)
+    return json_output
+
+def prepare_job(event):
+    """Validates the job input, takes the worker-only options out of it and sets up the
+    job's context. Returns (input data, options, error output or None)."""
     print(f"=== RunPod Job Started ===")
     print(f"Event keys: {list(event.keys()) if event else 'None'}")
-    
+    if not event or "input" not in event:
+        return None, None, {"error": "No input provided in event"}
+
+    input_data = event["input"]
+    print(f"Input data keys: {list(input_data.keys())}")
+    options = extract_job_options(input_data)
+    # Pipeline stages pass images on as base64
+    current_job_decode_images.set(wants_decoded_images(options) and "pipeline" not in input_data)
+    schedule, error_msg = pop_schedule_options(input_data)
+    if not error_msg:
+        current_job_schedule.set(schedule)
+        error_msg = check_deadline(schedule)
+    if error_msg:
+        return None, None, {"error": error_msg}
+    return input_data, options, None
+
+def cached_job_output(payload, options, payload_build_ms):
+    """Returns (result cache key or None, the cached output on a hit or None)."""
+    cache_key = result_cache_key(payload, options)
+    cached = get_cached_result(cache_key) if cache_key else None
+    if cached is None:
+        return cache_key, None
+    print("=== RunPod Job Served From Result Cache ===")
+    return cache_key, dict(cached, result_cache="hit", timings={"payload_build_ms": payload_build_ms})
+
+def finish_job(json_output, options, cache_key, payload_build_ms, run_pieces):
+    """Upscales, post-processes and caches the txt2img output of a job."""
+    if "error" in json_output:
+        print(f"Inference failed: {json_output['error']}")
+        return json_output
+
+    json_output.setdefault('timings', {})["payload_build_ms"] = payload_build_ms
+    if options["upscale"]:
+        json_output = upscale_generated_images(json_output, options["upscale"], run_pieces)
+    json_output = postprocess_output(json_output, options)
+    if cache_key and "error" not in json_output:
+        store_cached_result(cache_key, json_output)
+        json_output["result_cache"] = "miss"
+
+    print("=== RunPod Job Completed Successfully ===")
+    return json_output
+
+def failed_job_output(e):
+    """Output of a job that raised."""
+    print(f"=== RunPod Job Failed ===")
+    if isinstance(e, SourceFaceNotFound):
+        print(str(e))
+        return {"error": str(e), "error_code": "face_not_found"}
+    error_msg = f"Handler error: {str(e)}"
+    print(error_msg)
+    return {"error": error_msg}
+
+def process_job(event):
+    """Validates the job input, runs inference and face detection."""
     try:
-        # Validate input
-        if not event or "input" not in event:
-            return {"error": "No input provided in event"}
-        
-        input_data = event["input"]
-        print(f"Input data keys: {list(input_data.keys())}")
-        
+        input_data, options, error_output = prepare_job(event)
+        if error_output:
+            return error_output
+        if "pipeline" in input_data:
+            json_output = run_pipeline(input_data, options, send_a1111, run_upscale_pieces_sync)
+            print("=== RunPod Pipeline Job Finished ===")
+            return json_output
+
         # Run inference
         print("Starting inference...")
-        json_output = run_inference(input_data)
-        
-        # Check for errors
-        if "error" in json_output:
-            print(f"Inference failed: {json_output['error']}")
+        start = time.perf_counter()
+        payload = build_payload(input_data)
+        payload_build_ms = elapsed_ms(start)
+        cache_key, cached = cached_job_output(payload, options, payload_build_ms)
+        if cached is not None:
+            return cached
+        json_output = send_txt2img(payload)
+        return finish_job(json_output, options, cache_key, payload_build_ms, run_upscale_pieces_sync)
+    except Exception as e:
+        return failed_job_output(e)
+
+async def process_job_async(event):
+    """Async counterpart of process_job; blocking steps run in worker threads."""
+    try:
+        input_data, options, error_output = prepare_job(event)
+        if error_output:
+            return error_output
+        if "pipeline" in input_data:
+            json_output = await run_pipeline_async(input_data, options)
+            print("=== RunPod Pipeline Job Finished ===")
             return json_output
-        
-        # Run face detection only if we're not using IP-Adapter input
-        if "ip_adapter_image_b64" not in input_data and "images" in json_output:
-            print("Running face detection on generated image...")
-            try:
-                image_bytes = base64.b64decode(json_output['images'][0])
-                detected_faces = detect_and_save_faces(image_bytes)
-                json_output['detected_faces'] = detected_faces
-                print(f"Face detection completed. Found {len(detected_faces)} faces.")
-            except Exception as e:
-                print(f"Face detection failed: {e}")
-                json_output['detected_faces'] = []
-        
-        print("=== RunPod Job Completed Successfully ===")
-        return json_output
-        
+
+        print("Starting inference...")
+        start = time.perf_counter()
+        payload = await asyncio.to_thread(build_payload, input_data)
+        payload_build_ms = elapsed_ms(start)
+        cache_key, cached = await asyncio.to_thread(cached_job_output, payload, options, payload_build_ms)
+        if cached is not None:
+            return cached
+        json_output = await submit_txt2img(payload)
+        return await asyncio.to_thread(
+            finish_job, json_output, options, cache_key, payload_build_ms,
+            upscale_runner_for_thread(asyncio.get_running_loop())
+        )
     except Exception as e:
-        error_msg = f"Handler error: {str(e)}"
-        print(f"=== RunPod Job Failed ===")
-        print(error_msg)
-        return {"error": error_msg}
-    
-    finally:
-        # Signal shutdown after job completion
+        return failed_job_output(e)
+
+def record_job_metrics(output, total_ms):
+    """Feeds a finished job's outcome and per-stage timings into the metrics histograms."""
+    if "error" in output:
+        status = "error"
+    elif output.get("result_cache") == "hit":
+        status = "cache_hit"
+    else:
+        status = "ok"
+    metrics.inc("worker_jobs_total", labels={"status": status}, description="Jobs handled, by outcome")
+    metrics.observe("worker_job_total_ms", total_ms, description="Time from job start to output (ms)")
+    for stage, value in (output.get("timings") or {}).items():
+        if stage.endswith("_ms") and stage != "total_ms":
+            metrics.observe("worker_job_stage_ms", value, {"stage": stage[:-len("_ms")]},
+                            "Per-job time spent in each stage (ms)")
+
+def finalize_output(output, recycle, started):
+    """Attaches timings and worker state, and asks RunPod to stop the worker when it is due for recycling."""
+    total_ms = elapsed_ms(started)
+    record_job_metrics(output, total_ms)
+    if "error" not in output:
+        output.setdefault("timings", {})["total_ms"] = total_ms
+        output["worker"] = worker_state()
+    if recycle:
         print("Signaling worker shutdown...")
-        shutdown_flag.set()
+        output["refresh_worker"] = True
+    return output
+
+def handler(event):
+    """Main function called by RunPod to process a job."""
+    started = begin_job()
+    try:
+        if not ensure_a1111_running():
+            return {"error": "A1111 service is not available"}
+        output = process_job(event)
+    finally:
+        recycle = end_job()
+    return finalize_output(output, recycle, started)
+
+async def async_handler(event):
+    """Async entry point used when ASYNC_HANDLER is enabled."""
+    started = begin_job()
+    try:
+        if not await asyncio.to_thread(ensure_a1111_running):
+            return {"error": "A1111 service is not available"}
+        output = await process_job_async(event)
+    finally:
+        recycle = end_job()
+    return finalize_output(output, recycle, started)
+
+# --- STREAMING ---
+# With STREAM_HANDLER the worker registers a generator handler. Callers can use
+# /stream to get queue/step progress, the ETA and optional low-res previews from
+# A1111's /progress while the job runs, then the final output as the last chunk.
+STREAM_HANDLER = os.environ.get('STREAM_HANDLER', 'false').lower() in ('1', 'true', 'yes')
+PROGRESS_POLL_INTERVAL = float(os.environ.get('PROGRESS_POLL_INTERVAL', '0.5'))
+PREVIEW_MAX_SIZE = int(os.environ.get('PREVIEW_MAX_SIZE', '256'))
+
+def shrink_preview(preview_b64):
+    """Downscales an A1111 live preview to PREVIEW_MAX_SIZE and re-encodes it as JPEG base64."""
+    import cv2
+    bgr_img = decode_image(base64.b64decode(preview_b64))
+    if bgr_img is None:
+        return None
+    height, width = bgr_img.shape[:2]
+    scale = PREVIEW_MAX_SIZE / max(height, width)
+    if scale < 1:
+        bgr_img = cv2.resize(bgr_img, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    body, _, _ = encode_image(bgr_img, "jpeg", 70)
+    return base64.b64encode(body).decode('utf-8')
+
+async def poll_progress(previews, last_preview_id=None):
+    """Reads A1111's /progress. Returns a progress chunk, or None if it cannot be read."""
+    # The next poll is the retry
+    progress = await a1111.get_json_async(
+        "progress",
+        params={"skip_current_image": "false" if previews else "true"},
+        retries=0
+    )
+    if progress is None:
+        return None
+
+    job_state = progress.get("state") or {}
+    update = {
+        "status": "generating",
+        "progress": round(progress.get("progress") or 0.0, 4),
+        "eta_relative": round(progress.get("eta_relative") or 0.0, 2),
+        "step": job_state.get("sampling_step"),
+        "sampling_steps": job_state.get("sampling_steps"),
+    }
+    preview = progress.get("current_image")
+    if previews and preview:
+        preview_id = hashlib.md5(preview.encode('utf-8')).hexdigest()
+        if preview_id != last_preview_id:
+            update["preview"] = await asyncio.to_thread(shrink_preview, preview)
+            update["preview_id"] = preview_id
+    return update
+
+async def run_job_with_progress(event, state):
+    """Runs process_job_async in its own task with the job's progress dict in context."""
+    current_job_progress.set(state)
+    return await process_job_async(event)
+
+async def stream_handler(event):
+    """Generator entry point used when STREAM_HANDLER is enabled."""
+    started = begin_job()
+    task = None
+    try:
+        if not await asyncio.to_thread(ensure_a1111_running):
+            output = {"error": "A1111 service is not available"}
+        else:
+            input_data = event.get("input") if event else None
+            previews = bool(input_data.pop("stream_previews", False)) if isinstance(input_data, dict) else False
+            state = {"generating": False}
+            task = asyncio.ensure_future(run_job_with_progress(event, state))
+            last_chunk = None
+            last_preview_id = None
+            while not task.done():
+                await asyncio.wait({task}, timeout=PROGRESS_POLL_INTERVAL)
+                if task.done():
+                    break
+                chunk = await poll_progress(previews, last_preview_id) if state["generating"] else {"status": "queued"}
+                if chunk is None or chunk == last_chunk:
+                    continue
+                last_chunk = dict(chunk)
+                last_preview_id = chunk.pop("preview_id", last_preview_id)
+                yield chunk
+            output = task.result()
+    finally:
+        if task is not None and not task.done():
+            # The caller went away; stop waiting for the job
+            task.cancel()
+        recycle = end_job()
+    yield finalize_output(output, recycle, started)
+
+# --- METRICS ---
+# Per-stage job timings, restarts, start-up phases and GPU memory are exported by
+# metrics.py on METRICS_PORT (/metrics) and/or logged every METRICS_LOG_INTERVAL seconds.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '60'))
+
+startup_timings["import_handler_ms"] = elapsed_ms(MODULE_START)
 
 # --- MAIN ENTRY POINT ---
 if __name__ == "__main__":
     print("=== RunPod Worker Starting ===")
+    print(f"Warm mode: {WARM_MODE}, max jobs per worker: {MAX_JOBS_PER_WORKER or 'unlimited'}, "
+          f"idle timeout: {IDLE_TIMEOUT or 'disabled'}")
     
     try:
-        print("Starting A1111 server...")
-        a1111_process = subprocess.Popen(
-            A1111_COMMAND, 
-            preexec_fn=os.setsid,
-            stdout=sys.stdout,
-            stderr=sys.stderr
-        )
-        
-        print("Waiting for A1111 service to be ready...")
-        if wait_for_service(url=f'{LOCAL_URL}/progress', max_wait=300):
+        # A1111 takes longest to boot, so it is launched before anything else is loaded
+        a1111_start = launch_a1111()
+        warm_up_thread = None
+        if STARTUP_WARM_UP:
+            warm_up_thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+            warm_up_thread.start()
+        runpod = timed_import("runpod")
+        if wait_for_a1111(a1111_start):
             print("A1111 service is ready!")
+            startup_timings["worker_ready_ms"] = elapsed_ms(MODULE_START)
+            print_startup_profile("worker ready" if warm_up_thread is None or not warm_up_thread.is_alive()
+                                  else "worker ready, warm-up still running")
             
-            # Give extensions time to load
-            print("Waiting for extensions to load...")
-            time.sleep(10)
-            
-            # Check ControlNet availability
-            check_controlnet_available()
-            get_controlnet_models()
+            threading.Thread(target=a1111_watchdog, name="a1111-watchdog", daemon=True).start()
+            if METRICS_PORT:
+                metrics.start_http_server(METRICS_PORT)
+            if METRICS_LOG_INTERVAL:
+                metrics.start_log_reporter(METRICS_LOG_INTERVAL, shutdown_flag)
             
             print("Starting RunPod serverless handler...")
-            runpod.serverless.start({"handler": handler})
+            if STREAM_HANDLER:
+                runpod.serverless.start({
+                    "handler": stream_handler,
+                    "concurrency_modifier": concurrency_modifier,
+                    "return_aggregate_stream": True
+                })
+            elif ASYNC_HANDLER:
+                runpod.serverless.start({
+                    "handler": async_handler,
+                    "concurrency_modifier": concurrency_modifier
+                })
+            else:
+                runpod.serverless.start({"handler": handler})
         else:
             print("Failed to start A1111 service")
             sys.exit(1)
 
-        # Wait for shutdown signal
-        shutdown_flag.wait()
+        # runpod.serverless.start only returns in local test mode
+        shutdown_flag.set()
         print("Shutdown signal received")
 
     except Exception as e:
@@ -362,13 +2531,5 @@ if __name__ == "__main__":
     
     finally:
         # Clean shutdown
-        if a1111_process and a1111_process.poll() is None:
-            print("Terminating A1111 process...")
-            try:
-                os.killpg(os.getpgid(a1111_process.pid), signal.SIGTERM)
-                a1111_process.wait(timeout=30)
-            except:
-                print("Force killing A1111 process...")
-                os.killpg(os.getpgid(a1111_process.pid), signal.SIGKILL)
-        
-        print("=== RunPod Worker Shutdown Complete ===")
\ No newline at end of file
+        stop_a1111()
+        print("=== RunPod Worker Shutdown Complete ===")
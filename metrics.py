@@ -0,0 +1,149 @@
+"""
+Prometheus-style metrics for the worker.
+
+Counters, gauges and histograms are kept in process. They are exported in the
+Prometheus text format on METRICS_PORT and/or logged as one JSON line every
+METRICS_LOG_INTERVAL seconds. No client library is needed in the image.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in milliseconds
+DEFAULT_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000, 300000, float("inf"))
+
+metrics_lock = threading.Lock()
+counters = {}    # (name, labels) -> value
+gauges = {}      # (name, labels) -> value
+histograms = {}  # (name, labels) -> {"buckets": [counts], "sum": float, "count": int}
+descriptions = {}
+
+def metric_key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in (labels or {}).items())))
+
+def inc(name, amount=1, labels=None, description=None):
+    """Adds to a counter."""
+    key = metric_key(name, labels)
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + amount
+        if description:
+            descriptions.setdefault(name, description)
+
+def set_gauge(name, value, labels=None, description=None):
+    """Sets a gauge to the given value."""
+    with metrics_lock:
+        gauges[metric_key(name, labels)] = value
+        if description:
+            descriptions.setdefault(name, description)
+
+def observe(name, value, labels=None, description=None):
+    """Records one observation in a histogram."""
+    key = metric_key(name, labels)
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+                break
+        histogram["sum"] += value
+        histogram["count"] += 1
+        if description:
+            descriptions.setdefault(name, description)
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with metrics_lock:
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in series}):
+                if name in descriptions:
+                    lines.append(f"# HELP {name} {descriptions[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            if name in descriptions:
+                lines.append(f"# HELP {name} {descriptions[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), histogram in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(DEFAULT_BUCKETS, histogram["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def histogram_quantile(histogram, q):
+    """Upper bucket bound containing the q-quantile (what Prometheus' histogram_quantile approximates)."""
+    target = q * histogram["count"]
+    cumulative = 0
+    for bound, count in zip(DEFAULT_BUCKETS, histogram["buckets"]):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return float("inf")
+
+def snapshot():
+    """Compact dict of all metrics for structured logs."""
+    def series_name(name, labels):
+        return name + format_labels(labels)
+    with metrics_lock:
+        return {
+            "counters": {series_name(*key): value for key, value in counters.items()},
+            "gauges": {series_name(*key): value for key, value in gauges.items()},
+            "histograms": {
+                series_name(*key): {
+                    "count": h["count"],
+                    "mean": round(h["sum"] / h["count"], 2) if h["count"] else 0,
+                    "p50_le": histogram_quantile(h, 0.5),
+                    "p95_le": histogram_quantile(h, 0.95),
+                    "p99_le": histogram_quantile(h, 0.99),
+                }
+                for key, h in histograms.items()
+            },
+        }
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_http_server(port):
+    """Serves /metrics on the given port from a daemon thread."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Metrics available on http://0.0.0.0:{port}/metrics")
+    return server
+
+def start_log_reporter(interval, stop_event=None):
+    """Prints a JSON metrics snapshot every interval seconds from a daemon thread."""
+    stop_event = stop_event or threading.Event()
+    def report():
+        while not stop_event.wait(interval):
+            print(f"METRICS {json.dumps(snapshot(), default=str)}")
+    threading.Thread(target=report, name="metrics-log", daemon=True).start()
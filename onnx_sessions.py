@@ -0,0 +1,203 @@
+"""
+ONNX Runtime sessions for the insightface models, with a cache of optimised graphs.
+
+insightface.app.FaceAnalysis builds a session for every .onnx file of a model
+pack, even the ones allowed_modules then throws away. Each build repeats the
+graph optimisation. OnnxSessionFactory does the optimisation once and saves
+the result through SessionOptions.optimized_model_filepath. Later starts load
+the saved graph. Only the hardware-specific layout pass of the "all" level is
+left to run; it is not saved, so a cached graph works on any CPU. The cache key
+holds the model file, the ONNX Runtime version, the providers and the
+optimisation level, so a changed model or runtime never loads a stale graph. FaceModels loads a model
+pack through the factory. It remembers which task each file serves, so
+unneeded models are skipped without building a session.
+
+    factory = OnnxSessionFactory("/root/.cache/onnx-optimized", providers=["CPUExecutionProvider"])
+    models = FaceModels("/root/.insightface/models/buffalo_l", factory, allowed_modules=["detection"])
+    models.prepare(ctx_id=0, det_size=(640, 640))
+    bboxes, kpss = models.det_model.detect(rgb_img, input_size=(640, 640))
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import onnxruntime as ort
+
+DEFAULT_PROVIDERS = ("CUDAExecutionProvider", "CPUExecutionProvider")
+OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+# Levels above "extended" add hardware-specific nodes, which are not cached
+SAVED_LEVELS = {"all": "extended"}
+TASKS_FILE = "tasks.json"
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 2)
+
+class OnnxSessionFactory:
+    """Builds InferenceSessions with shared tuning and reuses optimised graphs from cache_dir.
+
+    cache_dir=None disables the cache. intra_op_threads/inter_op_threads of 0 leave
+    the ONNX Runtime defaults. The thread pool size does not follow OMP_NUM_THREADS.
+    """
+
+    def __init__(self, cache_dir=None, providers=DEFAULT_PROVIDERS, intra_op_threads=0,
+                 inter_op_threads=0, optimization="all"):
+        available = ort.get_available_providers()
+        self.providers = [p for p in providers if p in available] or ["CPUExecutionProvider"]
+        self.cache_dir = cache_dir
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.optimization = optimization
+        self.timings = {}  # model file name -> {"ms": build time, "cached": bool}
+        self.lock = threading.Lock()
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError as e:
+                print(f"ONNX graph cache disabled, cannot use {cache_dir}: {e}")
+                self.cache_dir = None
+
+    def session_options(self, level, optimized_path=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = OPTIMIZATION_LEVELS[level]
+        if self.intra_op_threads:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads:
+            options.inter_op_num_threads = self.inter_op_threads
+        if optimized_path:
+            options.optimized_model_filepath = optimized_path
+        return options
+
+    def cache_path(self, model_path):
+        """Where the optimised graph of a model is kept, or None without a cache."""
+        if not self.cache_dir:
+            return None
+        stat = os.stat(model_path)
+        key = json.dumps([os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns, ort.__version__,
+                          self.providers, self.optimization])
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        return os.path.join(self.cache_dir, f"{name}-{hashlib.sha1(key.encode()).hexdigest()[:16]}.onnx")
+
+    def create(self, model_path):
+        """Returns an InferenceSession for model_path, optimising and caching it on first use."""
+        start = time.perf_counter()
+        cached = self.cache_path(model_path)
+        hit = bool(cached) and os.path.exists(cached)
+        if cached and not hit:
+            self.save_optimized(model_path, cached)
+        if cached and os.path.exists(cached):
+            try:
+                session = ort.InferenceSession(cached, self.session_options(self.optimization), providers=self.providers)
+                self.record(model_path, start, hit)
+                return session
+            except Exception as e:
+                print(f"Discarding cached ONNX graph {cached}: {e}")
+                os.remove(cached)
+        session = ort.InferenceSession(model_path, self.session_options(self.optimization), providers=self.providers)
+        self.record(model_path, start, False)
+        return session
+
+    def save_optimized(self, model_path, cached):
+        """Optimises a model and saves the graph, written under a temporary name so a
+        concurrent start never reads a partial file."""
+        tmp_path = f"{cached}.{uuid.uuid4().hex}.tmp"
+        try:
+            level = SAVED_LEVELS.get(self.optimization, self.optimization)
+            ort.InferenceSession(model_path, self.session_options(level, tmp_path), providers=self.providers)
+            os.replace(tmp_path, cached)
+        except Exception as e:
+            print(f"Could not cache the optimised graph of {model_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def record(self, model_path, start, cached):
+        with self.lock:
+            self.timings[os.path.basename(model_path)] = {"ms": elapsed_ms(start), "cached": cached}
+
+def route_model(model_path, session):
+    """Wraps a session in its insightface model class, like insightface's ModelRouter."""
+    from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+    from insightface.model_zoo.attribute import Attribute
+    from insightface.model_zoo.inswapper import INSwapper
+    from insightface.model_zoo.landmark import Landmark
+    from insightface.model_zoo.retinaface import RetinaFace
+
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    if len(session.get_outputs()) >= 5:
+        return RetinaFace(model_file=model_path, session=session)
+    if input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_path, session=session)
+    if input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_path, session=session)
+    if len(inputs) == 2 and input_shape[2] == 128 and input_shape[3] == 128:
+        return INSwapper(model_file=model_path, session=session)
+    if input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return ArcFaceONNX(model_file=model_path, session=session)
+    return None
+
+class FaceModels:
+    """Drop-in for insightface.app.FaceAnalysis (models, det_model, prepare) built by a session factory."""
+
+    def __init__(self, model_dir, session_factory, allowed_modules=None):
+        self.model_dir = model_dir
+        self.models = {}
+        tasks = self.load_tasks(session_factory.cache_dir)
+        changed = False
+        for model_path in sorted(glob.glob(os.path.join(model_dir, "*.onnx"))):
+            name = os.path.basename(model_path)
+            # Files of unknown task are loaded once to find out what they are
+            if allowed_modules is not None and name in tasks and tasks[name] not in allowed_modules:
+                continue
+            model = route_model(model_path, session_factory.create(model_path))
+            if model is None:
+                continue
+            if tasks.get(name) != model.taskname:
+                tasks[name] = model.taskname
+                changed = True
+            if (allowed_modules is None or model.taskname in allowed_modules) and model.taskname not in self.models:
+                self.models[model.taskname] = model
+        if changed:
+            self.save_tasks(session_factory.cache_dir, tasks)
+        if "detection" not in self.models:
+            raise RuntimeError(f"No detection model in {model_dir}")
+        self.det_model = self.models["detection"]
+
+    def tasks_path(self, cache_dir):
+        key = hashlib.sha1(os.path.abspath(self.model_dir).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f"{key}-{TASKS_FILE}")
+
+    def load_tasks(self, cache_dir):
+        """Task of every model file seen on an earlier start: {file name: taskname}."""
+        if not cache_dir or not os.path.exists(self.tasks_path(cache_dir)):
+            return {}
+        try:
+            with open(self.tasks_path(cache_dir)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_tasks(self, cache_dir, tasks):
+        if not cache_dir:
+            return
+        tmp_path = f"{self.tasks_path(cache_dir)}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(tasks, f)
+        os.replace(tmp_path, self.tasks_path(cache_dir))
+
+    def prepare(self, ctx_id, det_thresh=0.5, det_size=(640, 640)):
+        self.det_thresh = det_thresh
+        self.det_size = det_size
+        for taskname, model in self.models.items():
+            if taskname == "detection":
+                model.prepare(ctx_id, input_size=det_size, det_thresh=det_thresh)
+            else:
+                model.prepare(ctx_id)
@@ -0,0 +1,178 @@
+"""
+Client for a RunPod serverless endpoint, used by the Lambda (lamda.txt).
+
+- One pooled requests.Session per client. Module-level clients keep their
+  connections open across warm Lambda invocations.
+- run() first tries /runsync, which returns the output in the same request
+  when the job finishes within `runsync_wait` seconds. Longer jobs continue on
+  /stream (for workers with STREAM_HANDLER=true) or on /status. Both are polled
+  with a short delay that grows up to `poll_max`, not a fixed 5 s sleep.
+- run_many() submits many jobs and collects their results concurrently.
+- Submissions are retried only when the connection could not be opened, so a
+  transient error never queues the same job twice. Status reads are also
+  retried on 429/5xx.
+
+    client = RunPodClient(endpoint_id, api_key)
+    job = client.run({"prompt": "a portrait"})
+    if job["status"] == "COMPLETED":
+        output = job["output"]
+
+base_url can point at a fake API (benchmarks/fake_runpod.py) for local runs.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+RUNPOD_API_URL = "https://api.runpod.ai/v2"
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+RUNSYNC_WAIT = 90
+JOB_TIMEOUT = 840
+POLL_INITIAL = 0.25
+POLL_FACTOR = 1.5
+POLL_MAX = 5.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CONNECT_RETRIES = 3
+BACKOFF_FACTOR = 0.2
+TERMINAL_STATUSES = ("COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT")
+
+logger = logging.getLogger(__name__)
+
+def backoff_delays(initial=POLL_INITIAL, factor=POLL_FACTOR, maximum=POLL_MAX):
+    """Poll delays: initial, initial * factor, ..., capped at maximum."""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+class RunPodClient:
+    """Pooled connections to one RunPod serverless endpoint."""
+
+    def __init__(self, endpoint_id, api_key, base_url=RUNPOD_API_URL, use_stream=False,
+                 runsync_wait=RUNSYNC_WAIT, job_timeout=JOB_TIMEOUT, poll_initial=POLL_INITIAL,
+                 poll_max=POLL_MAX, pool_size=16):
+        self.endpoint_url = f"{base_url}/{endpoint_id}"
+        self.use_stream = use_stream
+        self.runsync_wait = runsync_wait
+        self.job_timeout = job_timeout
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+
+        # Connect errors happen before the request is sent and are retried for any
+        # method; read errors and 429/5xx statuses only for GET.
+        retries = Retry(
+            total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0, status=CONNECT_RETRIES,
+            backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({"GET"}), raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+
+    def request(self, method, path, read_timeout=READ_TIMEOUT, **kwargs):
+        response = self.session.request(method, f"{self.endpoint_url}/{path}",
+                                        timeout=(CONNECT_TIMEOUT, read_timeout), **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    # --- single calls ---
+
+    def submit(self, job_input):
+        """Queues a job on /run. Returns its id."""
+        return self.request("POST", "run", json={"input": job_input})["id"]
+
+    def run_sync(self, job_input, wait=None):
+        """Runs a job on /runsync. Returns the job, which may still be IN_QUEUE/IN_PROGRESS
+        when it takes longer than `wait` seconds."""
+        wait = self.runsync_wait if wait is None else wait
+        return self.request("POST", "runsync", read_timeout=wait + READ_TIMEOUT,
+                            params={"wait": int(wait * 1000)}, json={"input": job_input})
+
+    def status(self, job_id):
+        return self.request("GET", f"status/{job_id}")
+
+    def stream(self, job_id):
+        """Reads the chunks a streaming worker produced since the last call."""
+        return self.request("GET", f"stream/{job_id}")
+
+    def cancel(self, job_id):
+        try:
+            self.request("POST", f"cancel/{job_id}")
+        except Exception as e:
+            logger.warning(f"Failed to cancel job {job_id}: {e}")
+
+    # --- waiting for results ---
+
+    def wait(self, job_id, deadline=None, on_chunk=None):
+        """Polls a job until it ends. Returns the final job.
+
+        With use_stream, chunks are read from /stream and passed to on_chunk; the
+        last chunk is the job output. The job is cancelled and TimeoutError raised
+        once `deadline` (a time.monotonic() value) passes.
+        """
+        deadline = deadline or time.monotonic() + self.job_timeout
+        delays = backoff_delays(self.poll_initial, maximum=self.poll_max)
+        last_chunk = None
+        while True:
+            job = self.stream(job_id) if self.use_stream else self.status(job_id)
+            chunks = job.get("stream") or []
+            for chunk in chunks:
+                last_chunk = chunk.get("output")
+                if on_chunk:
+                    on_chunk(last_chunk)
+            if job.get("status") in TERMINAL_STATUSES:
+                if self.use_stream and "output" not in job:
+                    job["output"] = last_chunk if last_chunk is not None else self.final_output(self.status(job_id).get("output"))
+                return job
+            if chunks:
+                # The job is running and producing output: check again soon
+                delays = backoff_delays(self.poll_initial, maximum=self.poll_max)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.cancel(job_id)
+                raise TimeoutError(f"RunPod job {job_id} did not finish in time")
+            time.sleep(min(next(delays), remaining))
+
+    def final_output(self, output):
+        """The job output. A streaming worker (return_aggregate_stream) returns the list
+        of its chunks from /runsync and /status; its last chunk is the result."""
+        if self.use_stream and isinstance(output, list):
+            return output[-1] if output else None
+        return output
+
+    def run(self, job_input, on_chunk=None, timeout=None):
+        """Runs a job to completion: /runsync, then /stream or /status. Returns the final job.
+
+        The job is cancelled and TimeoutError raised after `timeout` seconds (at most
+        job_timeout), e.g. the time the caller itself has left.
+        """
+        timeout = self.job_timeout if timeout is None else max(min(timeout, self.job_timeout), 0)
+        deadline = time.monotonic() + timeout
+        job = self.run_sync(job_input, wait=min(self.runsync_wait, timeout))
+        if job.get("status") in TERMINAL_STATUSES:
+            if "output" in job:
+                job["output"] = self.final_output(job["output"])
+            return job
+        logger.info(f"Job {job['id']} still {job.get('status')} after /runsync, polling...")
+        return self.wait(job["id"], deadline, on_chunk)
+
+    def run_many(self, job_inputs, max_workers=None):
+        """Submits every job on /run, then waits for them concurrently. Returns the final
+        jobs in input order; a job that could not be submitted or waited for is returned
+        as {"status": "FAILED", "error": ...}."""
+        if not job_inputs:
+            return []
+        deadline = time.monotonic() + self.job_timeout
+        with ThreadPoolExecutor(max_workers=max_workers or min(len(job_inputs), 16)) as executor:
+            submitted = [executor.submit(self.submit, job_input) for job_input in job_inputs]
+            def collect(submit_future):
+                try:
+                    return self.wait(submit_future.result(), deadline)
+                except Exception as e:
+                    return {"status": "FAILED", "error": str(e)}
+            return list(executor.map(collect, submitted))
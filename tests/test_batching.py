@@ -0,0 +1,56 @@
+import json
+
+import handler
+
+
+def job(seed):
+    payload = {"prompt": "portrait", "steps": 20}
+    if seed is not None:
+        payload["seed"] = seed
+    return (payload, None, None, None)
+
+
+def seeds(runs):
+    return [[handler.payload_seed(job[0]) for job in run] for run in runs]
+
+
+def test_consecutive_seeds_share_a_batch(monkeypatch):
+    monkeypatch.setattr(handler, "MAX_BATCH_SIZE", 4)
+    runs = handler.plan_batches([job(12), job(10), job(11), job(20), job(13), job(14)])
+    assert seeds(runs) == [[10, 11, 12, 13], [14], [20]]
+
+
+def test_random_seeds_are_batched_up_to_the_limit(monkeypatch):
+    monkeypatch.setattr(handler, "MAX_BATCH_SIZE", 2)
+    runs = handler.plan_batches([job(None), job(-1), job(5), job(-1)])
+    assert seeds(runs) == [[-1, -1], [-1], [5]]
+
+
+def test_duplicate_seeds_get_separate_calls(monkeypatch):
+    monkeypatch.setattr(handler, "MAX_BATCH_SIZE", 4)
+    assert seeds(handler.plan_batches([job(7), job(7)])) == [[7], [7]]
+
+
+def test_split_batch_result_gives_each_job_its_image_and_seed():
+    payloads = [dict(job(100 + i)[0]) for i in range(3)]
+    result = {
+        # A grid first, the generated images, then an extension's extra map
+        "images": ["grid", "img0", "img1", "img2", "map"],
+        "info": json.dumps({
+            "seed": 100, "all_seeds": [100, 101, 102], "all_subseeds": [5, 6, 7],
+            "all_prompts": ["portrait"] * 3, "infotexts": ["a", "b", "c"],
+            "index_of_first_image": 1, "batch_size": 3,
+        }),
+        "timings": {"generation_ms": 900},
+    }
+    outputs = handler.split_batch_result(result, payloads)
+
+    assert [output["images"] for output in outputs] == [["img0"], ["img1"], ["img2"]]
+    for i, output in enumerate(outputs):
+        info = json.loads(output["info"])
+        assert info["seed"] == 100 + i and info["all_seeds"] == [100 + i]
+        assert info["subseed"] == 5 + i and info["infotexts"] == ["abc"[i]]
+        assert info["batch_size"] == 1 and info["index_of_first_image"] == 0
+        assert output["parameters"] is payloads[i]
+        assert output["timings"] == {"generation_ms": 900}
+    assert outputs[0]["timings"] is not outputs[1]["timings"]
@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+import pytest
+
+from face_index import EMBEDDING_DIM, FaceIndex
+
+THRESHOLD = 0.6
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = FaceIndex(str(tmp_path), shard_size=4)
+    yield index
+    index.close()
+
+
+def embedding(seed):
+    return np.random.default_rng(seed).standard_normal(EMBEDDING_DIM).astype(np.float32)
+
+
+def test_new_face_is_reserved_until_committed(index):
+    assert index.match_or_add("faces/a.png", embedding(1), THRESHOLD)[0] is None
+    assert len(index) == 0
+    index.commit("faces/a.png")
+    assert len(index) == 1
+    key, similarity = index.match_or_add("faces/b.png", embedding(1) * 3, THRESHOLD)
+    assert key == "faces/a.png" and similarity == pytest.approx(1.0)
+
+
+def test_different_faces_do_not_match(index):
+    for i in range(10):
+        key = f"faces/{i}.png"
+        assert index.match_or_add(key, embedding(i), THRESHOLD)[0] is None
+        index.commit(key)
+    assert len(index) == 10 and len(index.shards) == 3
+
+
+def test_match_on_a_reservation_waits_for_it(index):
+    index.match_or_add("faces/a.png", embedding(1), THRESHOLD)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(index.match_or_add("faces/b.png", embedding(1), THRESHOLD)))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    index.commit("faces/a.png")
+    waiter.join(5)
+    assert results[0][0] == "faces/a.png"
+
+
+def test_removed_reservation_lets_the_waiter_add_itself(index):
+    index.match_or_add("faces/a.png", embedding(1), THRESHOLD)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(index.match_or_add("faces/b.png", embedding(1), THRESHOLD)))
+    waiter.start()
+    waiter.join(0.2)
+    index.remove("faces/a.png")
+    waiter.join(5)
+    assert results[0][0] is None
+    index.commit("faces/b.png")
+    assert index.search(embedding(1))[0] == "faces/b.png"
+
+
+def test_removed_face_never_matches_again(index):
+    index.match_or_add("faces/a.png", embedding(1), THRESHOLD)
+    index.commit("faces/a.png")
+    index.remove("faces/a.png")
+    assert len(index) == 0
+    assert index.match_or_add("faces/b.png", embedding(1), THRESHOLD)[0] is None
+
+
+def test_committed_faces_survive_a_reopen(tmp_path):
+    index = FaceIndex(str(tmp_path), shard_size=4)
+    for i in range(6):
+        index.match_or_add(f"faces/{i}.png", embedding(i), THRESHOLD)
+        index.commit(f"faces/{i}.png")
+    index.match_or_add("faces/uploading.png", embedding(99), THRESHOLD)
+    index.close()
+
+    reopened = FaceIndex(str(tmp_path), shard_size=4)
+    try:
+        assert len(reopened) == 6
+        assert reopened.search(embedding(4))[0] == "faces/4.png"
+        assert reopened.search(embedding(99))[1] < THRESHOLD
+    finally:
+        reopened.close()
+
+
+def test_one_process_owns_a_directory(index):
+    with pytest.raises(BlockingIOError):
+        FaceIndex(index.directory)
@@ -0,0 +1,61 @@
+import base64
+import json
+
+import pytest
+
+from a1111_client import GenerationResponseParser
+
+PNGS = [bytes(range(256)) * 3 + b"\x89PNG", b"a", b"ab", b"abc", b""]
+
+RESPONSE = {
+    "images": [base64.b64encode(png).decode("ascii") for png in PNGS],
+    "parameters": {"prompt": 'a "quoted" prompt, with {braces} and [brackets]', "seed": -1, "tiling": False},
+    "info": json.dumps({"all_seeds": [1, 2], "infotexts": ["x\\y"]}),
+    "html_info": None,
+    "count": 3,
+}
+
+
+def parse(body, chunk_size, decode_images=False):
+    parser = GenerationResponseParser(decode_images=decode_images)
+    for start in range(0, len(body), chunk_size):
+        parser.feed(body[start:start + chunk_size])
+    return parser.result()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 20])
+def test_chunked_body_parses_like_json(chunk_size):
+    body = json.dumps(RESPONSE).encode("utf-8")
+    assert parse(body, chunk_size) == RESPONSE
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1 << 20])
+def test_images_are_decoded_while_they_stream(chunk_size):
+    body = json.dumps(RESPONSE, indent=2).encode("utf-8")
+    result = parse(body, chunk_size, decode_images=True)
+    assert [bytes(image) for image in result["images"]] == PNGS
+    assert result["info"] == RESPONSE["info"]
+
+
+@pytest.mark.parametrize("decode_images", [False, True])
+def test_single_image_and_escaped_slashes(decode_images):
+    png = bytes([0xff, 0xfe, 0xfd]) * 100
+    encoded = base64.b64encode(png).decode("ascii")
+    assert "/" in encoded
+    body = json.dumps({"html_info": "<p/>", "image": encoded}).replace("/", "\\/").encode("utf-8")
+    result = parse(body, 3, decode_images)
+    assert result["html_info"] == "<p/>"
+    assert (bytes(result["image"]) if decode_images else result["image"]) == (png if decode_images else encoded)
+
+
+def test_truncated_body_is_rejected():
+    body = json.dumps(RESPONSE).encode("utf-8")
+    parser = GenerationResponseParser()
+    parser.feed(body[:len(body) // 2])
+    with pytest.raises(ValueError):
+        parser.result()
+
+
+def test_trailing_data_is_rejected():
+    with pytest.raises(ValueError):
+        parse(b'{"images": []} {}', 1 << 20)
@@ -0,0 +1,46 @@
+import pytest
+
+import handler
+
+OPTIONS = {"detect_faces": True, "upscale": None, "det_size": None,
+           "output_mode": "base64", "output_format": "png", "output_quality": 95}
+
+
+@pytest.fixture(autouse=True)
+def cache_enabled(monkeypatch):
+    monkeypatch.setattr(handler, "RESULT_CACHE_MAX_MB", 16)
+
+
+def test_key_ignores_dict_order():
+    payload = {"prompt": "cat", "seed": 5, "override_settings": {"CLIP_stop_at_last_layers": 2, "sd_vae": "auto"}}
+    reordered = {"override_settings": {"sd_vae": "auto", "CLIP_stop_at_last_layers": 2}, "seed": 5, "prompt": "cat"}
+    key = handler.result_cache_key(payload, OPTIONS)
+    assert key == handler.result_cache_key(reordered, dict(reversed(list(OPTIONS.items()))))
+    assert len(key) == 64
+
+
+@pytest.mark.parametrize("change", [
+    {"seed": 6},
+    {"prompt": "dog"},
+    {"override_settings": {"CLIP_stop_at_last_layers": 1}},
+])
+def test_key_changes_with_the_payload(change):
+    payload = {"prompt": "cat", "seed": 5, "override_settings": {"CLIP_stop_at_last_layers": 2}}
+    assert handler.result_cache_key(payload, OPTIONS) != handler.result_cache_key(dict(payload, **change), OPTIONS)
+
+
+def test_key_changes_with_the_options():
+    payload = {"prompt": "cat", "seed": 5}
+    assert handler.result_cache_key(payload, OPTIONS) != handler.result_cache_key(payload, dict(OPTIONS, output_format="webp"))
+
+
+@pytest.mark.parametrize("seed", [None, -1, "-1"])
+def test_random_seeds_are_not_cached(seed):
+    payload = {"prompt": "cat"} if seed is None else {"prompt": "cat", "seed": seed}
+    assert handler.result_cache_key(payload, OPTIONS) is None
+
+
+def test_no_key_when_the_cache_is_off(monkeypatch):
+    monkeypatch.setattr(handler, "RESULT_CACHE_MAX_MB", 0)
+    monkeypatch.setattr(handler, "RESULT_CACHE_S3_BUCKET", None)
+    assert handler.result_cache_key({"prompt": "cat", "seed": 5}, OPTIONS) is None
@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+import handler
+
+
+@pytest.fixture(autouse=True)
+def defaults(monkeypatch):
+    monkeypatch.setattr(handler, "DEFAULT_JOB_PRIORITY", 0)
+    monkeypatch.setattr(handler, "DEFAULT_JOB_DEADLINE", 0)
+    monkeypatch.setattr(handler, "MIN_JOB_PRIORITY", -10)
+    monkeypatch.setattr(handler, "MAX_JOB_PRIORITY", 0)
+
+
+def test_options_are_removed_from_the_input():
+    input_data = {"prompt": "cat", "priority": "-3", "deadline": "1700000000.5"}
+    schedule, error_msg = handler.pop_schedule_options(input_data)
+    assert error_msg is None
+    assert schedule == {"priority": -3, "deadline": 1700000000.5}
+    assert input_data == {"prompt": "cat"}
+
+
+def test_defaults(monkeypatch):
+    assert handler.pop_schedule_options({}) == ({"priority": 0, "deadline": None}, None)
+    monkeypatch.setattr(handler, "DEFAULT_JOB_DEADLINE", 30)
+    schedule, _ = handler.pop_schedule_options({"priority": None})
+    assert schedule["deadline"] == pytest.approx(time.time() + 30, abs=1)
+
+
+@pytest.mark.parametrize("priority, expected", [(-99, -10), (-10, -10), (-4, -4), (0, 0), (10, 0), ("7", 0)])
+def test_priority_is_clamped(priority, expected):
+    schedule, error_msg = handler.pop_schedule_options({"priority": priority})
+    assert error_msg is None and schedule["priority"] == expected
+
+
+@pytest.mark.parametrize("priority", ["high", "1.5", [1], {}])
+def test_priority_must_be_an_integer(priority):
+    assert handler.pop_schedule_options({"priority": priority}) == (None, "priority must be an integer")
+
+
+@pytest.mark.parametrize("deadline", ["soon", "nan", "inf", float("nan"), [1]])
+def test_deadline_must_be_a_number(deadline):
+    assert handler.pop_schedule_options({"deadline": deadline}) == (None, "deadline must be a unix time in seconds")
+
+
+def test_invalid_options_fail_the_job():
+    assert handler.process_job({"input": {"prompt": "cat", "priority": "high"}}) == {"error": "priority must be an integer"}
@@ -0,0 +1,41 @@
+import base64
+
+import cv2
+import numpy as np
+import pytest
+
+import handler
+
+
+def encode(bgr_img):
+    return base64.b64encode(cv2.imencode(".png", bgr_img)[1].tobytes()).decode("ascii")
+
+
+def fake_upscale(tile_b64, scale):
+    """Resizes like A1111's extras: the output size is truncated to whole pixels."""
+    tile = handler.decode_image(base64.b64decode(tile_b64))
+    size = (int(tile.shape[1] * scale), int(tile.shape[0] * scale))
+    return encode(cv2.resize(tile, size, interpolation=cv2.INTER_LINEAR))
+
+
+@pytest.mark.parametrize("scale", [1.25, 1.5, 2.2])
+def test_stitched_tiles_leave_no_black_seams(monkeypatch, scale):
+    monkeypatch.setattr(handler, "UPSCALE_MAX_MEGAPIXELS", 0.5)
+    rng = np.random.default_rng(0)
+    image = rng.integers(100, 200, size=(900, 700, 3), dtype=np.uint8)
+
+    tiles, layout = handler.split_tiles(encode(image), scale)
+    assert layout is not None and len(tiles) > 1
+
+    stitched = handler.decode_image(base64.b64decode(
+        handler.stitch_tiles([fake_upscale(tile, scale) for tile in tiles], layout, scale)))
+    assert stitched.shape[:2] == (int(900 * scale), int(700 * scale))
+    assert not (stitched == 0).all(axis=(1, 2)).any(), "black rows"
+    assert not (stitched == 0).all(axis=(0, 2)).any(), "black columns"
+    assert not (stitched == 0).all(axis=2).any(), "black pixels"
+
+
+def test_small_images_are_not_tiled():
+    image = np.full((64, 64, 3), 128, np.uint8)
+    tiles, layout = handler.split_tiles(encode(image), 2.0)
+    assert layout is None and len(tiles) == 1